@@ -1,5 +1,6 @@
 # admin_commands.py
 import os
+import asyncio
 import logging
 from typing import Optional, Dict, Any
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
@@ -8,6 +9,15 @@ from datetime import datetime, timedelta
 import psycopg2
 from psycopg2.extras import RealDictCursor
 import bot_commands
+import cluster
+import reporting
+import statements
+import outbox
+import symbol_catalog
+import profiling
+import referral_tree
+import startup
+from edit_coalescer import coalescer
 from dotenv import load_dotenv
 
 # Configure logging
@@ -16,7 +26,7 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 
 # === Constants ===
-VALID_TIERS = ['Free', 'Pro', 'VIP']
+VALID_TIERS = bot_commands.VALID_TIERS
 MAX_EXPIRY_DAYS = 365
 ADMIN_USER_ID = os.getenv("ADMIN_USER_ID")
 
@@ -59,7 +69,7 @@ async def validate_user_exists(user_id: int) -> bool:
                 cur.execute("SELECT 1 FROM users WHERE user_id = %s", (user_id,))
                 return cur.fetchone() is not None
     except Exception as e:
-        logger.error(f"Error validating user existence: {e}")
+        logger.error("Error validating user existence: %s", e)
         return False
 
 # === Admin Command Handlers ===
@@ -78,6 +88,11 @@ async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     keyboard = [
         [InlineKeyboardButton("📈 Get Bot Stats", callback_data="admin_stats")],
         [InlineKeyboardButton("🚀 Upgrade User Plan", callback_data="admin_upgrade_flow")],
+        [InlineKeyboardButton("💵 Revenue Report", callback_data="admin_revenue")],
+        [InlineKeyboardButton("👥 Cohort Report", callback_data="admin_cohorts")],
+        [InlineKeyboardButton("🔄 Reload Symbol Catalog", callback_data="admin_reload_symbols")],
+        [InlineKeyboardButton("🌳 Referral Trees", callback_data="admin_tree")],
+        [InlineKeyboardButton("🩺 Diagnostics", callback_data="admin_diagnostics")],
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text("Admin Menu:", reply_markup=reply_markup)
@@ -93,13 +108,21 @@ async def handle_admin_menu_callback(update: Update, context: ContextTypes.DEFAU
     await query.answer()
 
     if not is_admin(query.from_user.id):
-        await query.edit_message_text("⛔️ You are not authorized to use this command.")
+        await coalescer.edit_now(query, "⛔️ You are not authorized to use this command.")
         return
 
     if query.data == "admin_stats":
         await admin_stats(update, context, is_callback=True)
     elif query.data == "admin_upgrade_flow":
         await admin_upgrade_start(update, context)
+    elif query.data in ("admin_revenue", "admin_cohorts"):
+        await admin_report(update, context, query.data)
+    elif query.data == "admin_reload_symbols":
+        await admin_reload_symbols(update, context)
+    elif query.data.startswith("admin_diag"):
+        await admin_diagnostics(update, context, query.data)
+    elif query.data.startswith("admin_tree"):
+        await admin_referral_trees(update, context, query.data)
 
 async def admin_upgrade_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Starts the conversation flow for admin upgrade.
@@ -111,7 +134,8 @@ async def admin_upgrade_start(update: Update, context: ContextTypes.DEFAULT_TYPE
     Returns:
         Conversation state
     """
-    await update.callback_query.edit_message_text(
+    await coalescer.edit_now(
+        update.callback_query,
         "✍️ Please provide the User ID, Tier, and (optional) duration in days, separated by spaces.\n\n"
         f"Usage: `<user_id> <tier> [days]`\n"
         f"Valid tiers: {', '.join(VALID_TIERS)}\n"
@@ -162,30 +186,33 @@ async def admin_upgrade_complete(update: Update, context: ContextTypes.DEFAULT_T
         return ConversationHandler.END
         
     try:
-        bot_commands.log_upgrade(target_user_id, new_tier, 'Admin Upgrade', expiry_days)
+        # The upgrade and the user's notification commit together
+        with bot_commands.get_db_conn() as conn:
+            with conn.cursor() as cur:
+                upgraded = bot_commands.apply_upgrade(cur, target_user_id, new_tier, 'Admin Upgrade', expiry_days)
+                if upgraded:
+                    outbox.enqueue(
+                        cur, target_user_id,
+                        f"🎉 You have been upgraded to the {new_tier} plan by an administrator!"
+                        f"{f' This upgrade expires in {expiry_days} days.' if expiry_days else ''}"
+                    )
+            conn.commit()
+        if not upgraded:
+            await update.message.reply_text(f"❌ User {target_user_id} does not exist in the database.")
+            return ConversationHandler.END
+        outbox.wake()
         
         # Notify the admin
         await update.message.reply_text(
             f"✅ Successfully upgraded user {target_user_id} to '{new_tier}'."
             f"{f' Trial will expire in {expiry_days} days.' if expiry_days else ''}"
         )
-        
-        # Notify the upgraded user
-        try:
-            await context.bot.send_message(
-                chat_id=target_user_id,
-                text=f"🎉 You have been upgraded to the {new_tier} plan by an administrator!"
-                f"{f' This upgrade expires in {expiry_days} days.' if expiry_days else ''}"
-            )
-        except Exception as notification_error:
-            logger.warning(f"Could not notify user {target_user_id}: {notification_error}")
-            await update.message.reply_text("⚠️ User upgraded successfully but notification failed.")
             
     except psycopg2.Error as db_error:
-        logger.error(f"Database error in admin upgrade for user {target_user_id}: {db_error}")
+        logger.error("Database error in admin upgrade for user %s: %s", target_user_id, db_error)
         await update.message.reply_text("❌ Database error occurred. Please try again.")
     except Exception as e:
-        logger.error(f"Unexpected error in admin upgrade for user {target_user_id}: {e}")
+        logger.error("Unexpected error in admin upgrade for user %s: %s", target_user_id, e)
         await update.message.reply_text("❌ An unexpected error occurred. Check logs for details.")
     
     return ConversationHandler.END
@@ -201,7 +228,7 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE, is_cal
     if not is_admin(update.effective_user.id):
         error_message = "⛔️ You are not authorized to use this command."
         if is_callback:
-            await update.callback_query.edit_message_text(error_message)
+            await coalescer.edit_now(update.callback_query, error_message)
         else:
             await update.message.reply_text(error_message)
         return
@@ -232,8 +259,9 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE, is_cal
                 # Signal statistics
                 cur.execute("""
                     SELECT 
-                        COUNT(CASE WHEN status = 'Open' THEN 1 END) as active_signals,
-                        COUNT(CASE WHEN status = 'Closed' THEN 1 END) as closed_signals,
+                        COUNT(CASE WHEN status IN ('Open', 'T1 Hit', 'T2 Hit') THEN 1 END) as active_signals,
+                        COUNT(CASE WHEN status IN ('T3 Hit', 'Completed') THEN 1 END) as completed_signals,
+                        COUNT(CASE WHEN status = 'Stopped' THEN 1 END) as stopped_signals,
                         COUNT(CASE WHEN status = 'Cancelled' THEN 1 END) as cancelled_signals
                     FROM signals
                 """)
@@ -241,7 +269,8 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE, is_cal
                 
                 stats_text += f"📈 Signal Statistics:\n"
                 stats_text += f"  - Active: {signal_stats['active_signals']}\n"
-                stats_text += f"  - Closed: {signal_stats['closed_signals']}\n"
+                stats_text += f"  - All targets hit: {signal_stats['completed_signals']}\n"
+                stats_text += f"  - Stopped: {signal_stats['stopped_signals']}\n"
                 stats_text += f"  - Cancelled: {signal_stats['cancelled_signals']}\n\n"
                     
                 # Top Referrers
@@ -260,12 +289,16 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE, is_cal
                         stats_text += f"  - User {row['user_id']}: {row['referrals']} referrals\n"
                 else:
                     stats_text += "🏆 No referrals yet\n"
+
+                stats_text += f"\n{cluster.status_text()}\n"
+                stats_text += f"\n{startup.timings_text()}"
+                stats_text += f"\n{statements.stats_text()}"
                         
     except psycopg2.Error as db_error:
-        logger.error(f"Database error retrieving admin stats: {db_error}")
+        logger.error("Database error retrieving admin stats: %s", db_error)
         stats_text = "❌ Database error occurred while retrieving stats."
     except Exception as e:
-        logger.error(f"Unexpected error retrieving admin stats: {e}")
+        logger.error("Unexpected error retrieving admin stats: %s", e)
         stats_text = "❌ Failed to retrieve stats. Check logs for details."
     
     if is_callback:
@@ -273,6 +306,132 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE, is_cal
     else:
         await update.message.reply_text(stats_text)
 
+async def admin_report(update: Update, context: ContextTypes.DEFAULT_TYPE, report: str) -> None:
+    """Sends a revenue or cohort report rendered from the pre-aggregated rollups.
+    
+    Args:
+        update: Telegram update object
+        context: Bot context
+        report: Either 'admin_revenue' or 'admin_cohorts'
+    """
+    try:
+        render = reporting.revenue_report if report == "admin_revenue" else reporting.cohort_report
+        report_text = await asyncio.to_thread(render)
+    except psycopg2.Error as db_error:
+        logger.error("Database error rendering %s: %s", report, db_error)
+        report_text = "❌ Database error occurred while building the report."
+    except Exception as e:
+        logger.error("Unexpected error rendering %s: %s", report, e)
+        report_text = "❌ Failed to build the report. Check logs for details."
+
+    await update.callback_query.message.reply_text(report_text)
+
+async def admin_reload_symbols(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Reloads the symbol catalog from its file or exchange snapshot without a restart.
+    
+    Args:
+        update: Telegram update object
+        context: Bot context
+    """
+    try:
+        summary = await asyncio.to_thread(symbol_catalog.reload)
+        reply_text = f"✅ Symbol catalog reloaded: {summary}."
+    except Exception as e:
+        logger.error("Failed to reload symbol catalog: %s", e)
+        reply_text = "❌ Failed to reload the symbol catalog; the previous one is still in use."
+
+    await update.callback_query.message.reply_text(reply_text)
+
+async def _send_profile(bot, chat_id: int, seconds: int) -> None:
+    """Runs a CPU profile in the background and sends the report when it ends."""
+    try:
+        report = await profiling.run_profile(seconds)
+        document, filename = profiling.report_file("cpu_profile", report)
+        await bot.send_document(chat_id=chat_id, document=document, filename=filename, caption="🔬 CPU profile")
+    except Exception as e:
+        logger.error("CPU profile failed: %s", e)
+        await bot.send_message(chat_id=chat_id, text="❌ CPU profile failed. Check logs for details.")
+
+async def admin_diagnostics(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str) -> None:
+    """Shows the diagnostics menu or runs one of its actions.
+    
+    Profiles and memory traces are only active between their start and stop
+    actions, so the bot carries no profiling overhead otherwise.
+    
+    Args:
+        update: Telegram update object
+        context: Bot context
+        action: Callback data of the pressed button
+    """
+    message = update.callback_query.message
+    if action == "admin_diagnostics":
+        keyboard = [
+            [InlineKeyboardButton(f"🔬 CPU Profile {s}s", callback_data=f"admin_diag_cpu_{s}") for s in (10, 60)],
+            [InlineKeyboardButton("⏹ Stop CPU Profile", callback_data="admin_diag_cpu_stop")],
+            [InlineKeyboardButton("🧠 Memory Snapshot", callback_data="admin_diag_mem")],
+            [InlineKeyboardButton("🧹 Stop Memory Tracing", callback_data="admin_diag_mem_stop")],
+            [InlineKeyboardButton("🧵 Tasks & Loop Lag", callback_data="admin_diag_tasks")],
+        ]
+        await message.reply_text("🩺 Diagnostics:", reply_markup=InlineKeyboardMarkup(keyboard))
+    elif action == "admin_diag_cpu_stop":
+        if profiling.stop_profile():
+            await message.reply_text("⏹ Stopping the CPU profile; the report will follow.")
+        else:
+            await message.reply_text("ℹ️ No CPU profile is running.")
+    elif action.startswith("admin_diag_cpu_"):
+        if profiling.is_profiling():
+            await message.reply_text("⚠️ A CPU profile is already running.")
+            return
+        seconds = int(action.rsplit("_", 1)[1])
+        asyncio.create_task(_send_profile(context.bot, message.chat_id, seconds))
+        await message.reply_text(f"🔬 CPU profile started for {seconds}s. The report will be sent when it ends.")
+    elif action == "admin_diag_mem":
+        ready, report = await asyncio.to_thread(profiling.memory_snapshot)
+        if ready:
+            document, filename = profiling.report_file("memory", report)
+            await message.reply_document(document=document, filename=filename, caption="🧠 Memory snapshot")
+        else:
+            await message.reply_text(report)
+    elif action == "admin_diag_mem_stop":
+        if profiling.stop_memory_tracing():
+            await message.reply_text("🧹 Memory tracing stopped.")
+        else:
+            await message.reply_text("ℹ️ Memory tracing is not running.")
+    elif action == "admin_diag_tasks":
+        report = await profiling.task_dump()
+        document, filename = profiling.report_file("tasks", report)
+        await message.reply_document(document=document, filename=filename, caption="🧵 Tasks and event-loop lag")
+
+async def admin_referral_trees(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str) -> None:
+    """Shows the largest referral subtrees, or rebuilds the tree from `referrals`.
+    
+    Args:
+        update: Telegram update object
+        context: Bot context
+        action: Either 'admin_tree' or 'admin_tree_rebuild'
+    """
+    message = update.callback_query.message
+    if action == "admin_tree_rebuild":
+        try:
+            paths = await asyncio.to_thread(referral_tree.rebuild)
+            await message.reply_text(f"✅ Referral tree rebuilt: {paths} paths.")
+        except Exception as e:
+            logger.error("Failed to rebuild referral tree: %s", e)
+            await message.reply_text("❌ Failed to rebuild the referral tree. Check logs for details.")
+        return
+
+    try:
+        report_text = await asyncio.to_thread(referral_tree.top_subtrees_report)
+    except psycopg2.Error as db_error:
+        logger.error("Database error rendering referral trees: %s", db_error)
+        report_text = "❌ Database error occurred while building the report."
+    except Exception as e:
+        logger.error("Unexpected error rendering referral trees: %s", e)
+        report_text = "❌ Failed to build the report. Check logs for details."
+
+    keyboard = [[InlineKeyboardButton("🔁 Rebuild From Referrals", callback_data="admin_tree_rebuild")]]
+    await message.reply_text(report_text, reply_markup=InlineKeyboardMarkup(keyboard))
+
 # === Conversation Handler Registration ===
 admin_upgrade_conv_handler = ConversationHandler(
     entry_points=[CallbackQueryHandler(admin_upgrade_start, pattern="^admin_upgrade_flow$")],
@@ -1,129 +1,431 @@
 # bot_commands.py
 import os
+import json
+import asyncio
+import time
+import hashlib
 import logging
+import threading
+from contextlib import ExitStack, contextmanager
 import psycopg2
+import psycopg2.pool
+import psycopg2.extensions
 from psycopg2.extras import RealDictCursor
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+import statements
+import storage
 
 # === Environment & Logging ===
 DB_URL = os.getenv("DATABASE_URL1")
 logger = logging.getLogger(__name__)
 
+# Signal lifecycle: Open -> T1 Hit -> T2 Hit -> T3 Hit, or Stopped / Cancelled at any point.
+# A signal with fewer than three targets ends as Completed once its last target is hit.
+SIGNAL_OPEN = 'Open'
+SIGNAL_TARGET_STATUSES = ('T1 Hit', 'T2 Hit', 'T3 Hit')
+SIGNAL_COMPLETED = 'Completed'
+SIGNAL_STOPPED = 'Stopped'
+SIGNAL_CANCELLED = 'Cancelled'
+# Signals in these states are still being evaluated against the market.
+ACTIVE_SIGNAL_STATUSES = (SIGNAL_OPEN, 'T1 Hit', 'T2 Hit')
+
+# Plans a user can be on; throttle.py needs a quota multiplier for each.
+VALID_TIERS = ['Free', 'Pro', 'VIP']
+
+# LISTEN/NOTIFY channel carrying compact change events for in-memory caches.
+CHANGES_CHANNEL = "targethawk_changes"
+
+# Smoothed time spent waiting for a database connection, used for load shedding.
+DB_WAIT_SMOOTHING = 0.2
+# Samples older than this are ignored, so shedding cannot lock itself in once traffic stops.
+DB_WAIT_STALE_SECONDS = 10
+_db_wait_ewma = 0.0
+_db_wait_sampled_at = 0.0
+
+# === Connection Pool ===
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT_SECONDS = 10
+# Connections reserved for handlers running on the event loop. The loop runs one
+# handler step at a time and never awaits while holding a connection, so it needs
+# at most one per nested get_db_conn and must never wait for worker threads.
+DB_LOOP_SLOTS = 2
+DB_WORKER_SLOTS = max(1, DB_POOL_MAX - DB_LOOP_SLOTS)
+_pool = None
+_pool_lock = threading.Lock()
+# ThreadedConnectionPool raises instead of waiting when exhausted; the semaphore makes worker threads queue.
+_pool_slots = threading.BoundedSemaphore(DB_WORKER_SLOTS)
+_loop_slots = threading.BoundedSemaphore(DB_LOOP_SLOTS)
+
+class PooledConnection(psycopg2.extensions.connection):
+    """Connection that remembers which named statements have been prepared on it."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = psycopg2.pool.ThreadedConnectionPool(
+                    DB_POOL_MIN, DB_WORKER_SLOTS + DB_LOOP_SLOTS, DB_URL,
+                    connection_factory=PooledConnection, cursor_factory=RealDictCursor
+                )
+                logger.info("✅ Database pool created (%s-%s connections).", DB_POOL_MIN, DB_WORKER_SLOTS + DB_LOOP_SLOTS)
+    return _pool
+
+def connect_direct(**kwargs):
+    """Opens a dedicated, unpooled connection (e.g. for LISTEN); PostgreSQL only."""
+    return psycopg2.connect(DB_URL, **kwargs)
+
 # === Database Functions ===
+@contextmanager
 def get_db_conn():
     """
-    Establishes and returns a database connection using RealDictCursor.
+    Borrows a pooled database connection that uses RealDictCursor.
     This ensures that database query results are returned as dictionaries,
     allowing access by column name (e.g., row['column_name']).
+    Use it as `with get_db_conn() as conn:`; the transaction is committed
+    (or rolled back on error) and the connection returned to the pool on exit.
+    On the embedded SQLite engine the connection offers the same API.
+    Coroutines must not await while holding the connection: on the event loop
+    it comes from a small reserved set and checkout never blocks.
     """
+    if storage.is_sqlite():
+        with storage.sqlite_connection() as conn:
+            yield conn
+        return
+    started = time.monotonic()
+    if _on_event_loop():
+        # Blocking here would freeze every update; the loop has its own slots instead.
+        slots = _loop_slots
+        if not slots.acquire(blocking=False):
+            # Counted as a full timeout so load shedding reacts to a starved event loop too.
+            _record_db_wait(DB_POOL_TIMEOUT_SECONDS)
+            logger.error("❌ No database connection free for the event loop (held across an await?).")
+            raise psycopg2.OperationalError("No pooled database connection free for the event loop")
+    else:
+        slots = _pool_slots
+        if not slots.acquire(timeout=DB_POOL_TIMEOUT_SECONDS):
+            _record_db_wait(time.monotonic() - started)
+            logger.error("❌ Timed out waiting for a database connection.")
+            raise psycopg2.OperationalError("Timed out waiting for a pooled database connection")
+        _record_db_wait(time.monotonic() - started)
+    pool = _get_pool()
     try:
-        conn = psycopg2.connect(DB_URL, cursor_factory=RealDictCursor)
-        logger.info("✅ Database connection successful.")
-        return conn
+        conn = pool.getconn()
     except psycopg2.OperationalError as e:
-        logger.error(f"❌ Database connection failed: {e}")
+        slots.release()
+        logger.error("❌ Database connection failed: %s", e)
         raise
     except Exception as e:
-        logger.error(f"❌ An unexpected error occurred during DB connection: {e}")
+        slots.release()
+        logger.error("❌ An unexpected error occurred during DB connection: %s", e)
         raise
 
-def init_db():
-    """Initializes the database by creating tables if they don't exist."""
-    conn = None
+    discard = False
     try:
-        conn = get_db_conn()
-        cur = conn.cursor()
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id BIGINT PRIMARY KEY,
-                tier VARCHAR(50) DEFAULT 'Free',
-                username VARCHAR(255),
-                ref_by_id BIGINT,
-                created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                referrals INTEGER DEFAULT 0,
-                trial_expiry TIMESTAMP WITH TIME ZONE
-            );
-            CREATE TABLE IF NOT EXISTS upgrades (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT REFERENCES users(user_id),
-                tier VARCHAR(50),
-                source VARCHAR(255),
-                duration_days INTEGER,
-                upgraded_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-            );
-            CREATE TABLE IF NOT EXISTS signals (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT REFERENCES users(user_id),
-                symbol VARCHAR(20) NOT NULL,
-                entry_price NUMERIC(10, 4) NOT NULL,
-                target_price_1 NUMERIC(10, 4),
-                target_price_2 NUMERIC(10, 4),
-                target_price_3 NUMERIC(10, 4),
-                stop_loss NUMERIC(10, 4),
-                status VARCHAR(50) DEFAULT 'Open',
-                created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                tags VARCHAR(255) DEFAULT ''
-            );
-            CREATE TABLE IF NOT EXISTS referrals (
-                id SERIAL PRIMARY KEY,
-                referrer_id BIGINT NOT NULL,
-                referred_id BIGINT NOT NULL,
-                referred_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE (referrer_id, referred_id)
-            );
-        """)
+        yield conn
         conn.commit()
-        logger.info("Database schema initialized successfully.")
     except Exception as e:
-        logger.error(f"Error initializing database: {e}")
+        # Broken connections must not go back into the pool.
+        discard = conn.closed or isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+        if not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        raise
     finally:
-        if conn:
-            conn.close()
+        pool.putconn(conn, close=discard or bool(conn.closed))
+        slots.release()
+
+def _on_event_loop():
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+def warm_pool(connections=1):
+    """
+    Opens up to `connections` pooled connections at once and prepares the hot
+    statements on each, ahead of the first requests. Returns how many were opened.
+    """
+    count = min(connections, DB_WORKER_SLOTS)
+    with ExitStack() as stack:
+        for _ in range(count):
+            conn = stack.enter_context(get_db_conn())
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+                statements.prepare_all(cur)
+    return count
+
+def close_pool():
+    """Closes every pooled connection; called on shutdown."""
+    global _pool
+    if storage.is_sqlite():
+        storage.close_sqlite()
+        return
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+def _record_db_wait(seconds):
+    """Folds one connection wait into the moving average."""
+    global _db_wait_ewma, _db_wait_sampled_at
+    _db_wait_ewma += DB_WAIT_SMOOTHING * (seconds - _db_wait_ewma)
+    _db_wait_sampled_at = time.monotonic()
+
+def db_wait_seconds():
+    """Returns the smoothed time recent callers waited for a database connection.
+
+    Worker threads report how long they queued; a checkout on the event loop
+    that finds no free slot reports DB_POOL_TIMEOUT_SECONDS.
+    """
+    if time.monotonic() - _db_wait_sampled_at > DB_WAIT_STALE_SECONDS:
+        return 0.0
+    return _db_wait_ewma
+
+# === Schema ===
+# PostgreSQL DDL; the SQLite engine translates it (see storage.translate_ddl).
+SCHEMA_DDL = """
+    CREATE TABLE IF NOT EXISTS users (
+        user_id BIGINT PRIMARY KEY,
+        tier VARCHAR(50) DEFAULT 'Free',
+        username VARCHAR(255),
+        ref_by_id BIGINT,
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+        referrals INTEGER DEFAULT 0,
+        trial_expiry TIMESTAMP WITH TIME ZONE
+    );
+    CREATE TABLE IF NOT EXISTS upgrades (
+        id SERIAL PRIMARY KEY,
+        user_id BIGINT REFERENCES users(user_id),
+        tier VARCHAR(50),
+        source VARCHAR(255),
+        duration_days INTEGER,
+        upgraded_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE IF NOT EXISTS signals (
+        id SERIAL PRIMARY KEY,
+        user_id BIGINT REFERENCES users(user_id),
+        symbol VARCHAR(20) NOT NULL,
+        entry_price NUMERIC(10, 4) NOT NULL,
+        target_price_1 NUMERIC(10, 4),
+        target_price_2 NUMERIC(10, 4),
+        target_price_3 NUMERIC(10, 4),
+        stop_loss NUMERIC(10, 4),
+        status VARCHAR(50) DEFAULT 'Open',
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+        tags VARCHAR(255) DEFAULT ''
+    );
+    ALTER TABLE users ADD COLUMN IF NOT EXISTS digest_seconds INTEGER DEFAULT 0;
+    ALTER TABLE signals ADD COLUMN IF NOT EXISTS last_price NUMERIC(18, 8);
+    ALTER TABLE signals ADD COLUMN IF NOT EXISTS last_level SMALLINT DEFAULT 0;
+    ALTER TABLE signals ADD COLUMN IF NOT EXISTS evaluated_at TIMESTAMP WITH TIME ZONE;
+    CREATE INDEX IF NOT EXISTS idx_signals_active ON signals (symbol)
+        WHERE status IN ('Open', 'T1 Hit', 'T2 Hit');
+    CREATE TABLE IF NOT EXISTS signal_events (
+        id BIGSERIAL PRIMARY KEY,
+        signal_id INTEGER NOT NULL,
+        from_status VARCHAR(50),
+        to_status VARCHAR(50) NOT NULL,
+        price NUMERIC(18, 8),
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_signal_events_signal ON signal_events (signal_id);
+    CREATE TABLE IF NOT EXISTS payment_events (
+        event_id VARCHAR(255) PRIMARY KEY,
+        provider VARCHAR(50),
+        event_type VARCHAR(100),
+        user_id BIGINT,
+        tier VARCHAR(50),
+        duration_days INTEGER,
+        payload JSONB,
+        status VARCHAR(50) DEFAULT 'pending',
+        received_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+        processed_at TIMESTAMP WITH TIME ZONE
+    );
+    CREATE INDEX IF NOT EXISTS idx_payment_events_pending ON payment_events (received_at)
+        WHERE processed_at IS NULL;
+    CREATE TABLE IF NOT EXISTS referrals (
+        id SERIAL PRIMARY KEY,
+        referrer_id BIGINT NOT NULL,
+        referred_id BIGINT NOT NULL,
+        referred_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (referrer_id, referred_id)
+    );
+    CREATE TABLE IF NOT EXISTS referral_paths (
+        ancestor_id BIGINT NOT NULL,
+        descendant_id BIGINT NOT NULL,
+        depth SMALLINT NOT NULL,
+        PRIMARY KEY (ancestor_id, descendant_id)
+    );
+    CREATE INDEX IF NOT EXISTS idx_referral_paths_descendant ON referral_paths (descendant_id);
+    CREATE TABLE IF NOT EXISTS referral_downline (
+        user_id BIGINT NOT NULL,
+        depth SMALLINT NOT NULL,
+        members INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, depth)
+    );
+    CREATE TABLE IF NOT EXISTS cluster_instances (
+        instance_id VARCHAR(255) PRIMARY KEY,
+        hostname VARCHAR(255),
+        pid INTEGER,
+        started_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+        heartbeat_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE IF NOT EXISTS cluster_leases (
+        name VARCHAR(255) PRIMARY KEY,
+        owner_id VARCHAR(255) NOT NULL,
+        expires_at TIMESTAMP WITH TIME ZONE NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS report_daily (
+        day DATE NOT NULL,
+        metric VARCHAR(50) NOT NULL,
+        dimension VARCHAR(255) NOT NULL DEFAULT '',
+        value INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, metric, dimension)
+    );
+    CREATE TABLE IF NOT EXISTS report_cohorts (
+        cohort_day DATE PRIMARY KEY,
+        signups INTEGER NOT NULL DEFAULT 0,
+        converted INTEGER NOT NULL DEFAULT 0,
+        churned INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS report_state (
+        name VARCHAR(50) PRIMARY KEY,
+        watermark DATE NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS outbox (
+        id BIGSERIAL PRIMARY KEY,
+        chat_id BIGINT NOT NULL,
+        text TEXT NOT NULL,
+        critical BOOLEAN NOT NULL DEFAULT FALSE,
+        status VARCHAR(20) NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        last_error TEXT,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (next_attempt_at) WHERE status = 'pending';
+    CREATE INDEX IF NOT EXISTS idx_outbox_digest ON outbox (chat_id, next_attempt_at) WHERE status = 'digest';
+    CREATE TABLE IF NOT EXISTS schema_meta (
+        name VARCHAR(50) PRIMARY KEY,
+        fingerprint VARCHAR(64) NOT NULL,
+        applied_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+# Stored in schema_meta once the DDL above has been applied; any edit to it changes the fingerprint.
+SCHEMA_FINGERPRINT = hashlib.sha256(SCHEMA_DDL.encode()).hexdigest()
+
+def _stored_fingerprint(cur):
+    try:
+        cur.execute("SELECT fingerprint FROM schema_meta WHERE name = 'schema'")
+    except psycopg2.Error:
+        # First start on this database: schema_meta does not exist yet.
+        return None
+    row = cur.fetchone()
+    return row['fingerprint'] if row else None
+
+def init_db():
+    """
+    Initializes the database by creating tables if they don't exist.
+    The DDL only runs when the stored schema fingerprint differs from
+    SCHEMA_FINGERPRINT, so a restart with an unchanged schema costs one query.
+    """
+    try:
+        with get_db_conn() as conn:
+            with conn.cursor() as cur:
+                if _stored_fingerprint(cur) == SCHEMA_FINGERPRINT:
+                    logger.info("Database schema is current (fingerprint %s); skipping DDL.", SCHEMA_FINGERPRINT[:12])
+                    return
+            conn.rollback()
+            with conn.cursor() as cur:
+                if storage.is_sqlite():
+                    cur.executescript_ddl(SCHEMA_DDL)
+                else:
+                    # Instances deploying at the same time apply the DDL one after another.
+                    cur.execute("SELECT pg_advisory_xact_lock(hashtext('schema_ddl'))")
+                    cur.execute(SCHEMA_DDL)
+                cur.execute("""
+                    INSERT INTO schema_meta (name, fingerprint) VALUES ('schema', %s)
+                    ON CONFLICT (name) DO UPDATE SET fingerprint = EXCLUDED.fingerprint, applied_at = CURRENT_TIMESTAMP
+                """, (SCHEMA_FINGERPRINT,))
+            conn.commit()
+        logger.info("Database schema initialized successfully (fingerprint %s).", SCHEMA_FINGERPRINT[:12])
+    except Exception as e:
+        logger.error("Error initializing database: %s", e)
+
+def publish_change(cur, event):
+    """
+    Publishes a compact change event on the current transaction.
+    Postgres delivers it to listeners only if and when the transaction commits;
+    the SQLite engine hands it to in-process listeners after commit instead.
+    """
+    if storage.is_sqlite():
+        cur.connection.queue_event(event)
+        return
+    cur.execute("SELECT pg_notify(%s, %s)", (CHANGES_CHANNEL, json.dumps(event, separators=(',', ':'))))
+
+def apply_upgrade(cur, user_id, tier, source, expiry_days=None):
+    """
+    Updates a user's tier and expiry date and logs the upgrade, inside the
+    caller's transaction. Returns False if the user does not exist.
+    """
+    # First, get current user data (locked so concurrent upgrades extend expiry correctly)
+    cur.execute("SELECT tier, trial_expiry FROM users WHERE user_id = %s FOR UPDATE", (user_id,))
+    user_data = cur.fetchone()
+    if not user_data:
+        return False
+
+    # Calculate new expiry date if a duration is given
+    if expiry_days:
+        now = datetime.now(timezone.utc)
+        current_expiry = user_data['trial_expiry'] if user_data['trial_expiry'] and user_data['trial_expiry'] > now else now
+        new_expiry = current_expiry + timedelta(days=expiry_days)
+        cur.execute(
+            "UPDATE users SET tier = %s, trial_expiry = %s WHERE user_id = %s",
+            (tier, new_expiry, user_id)
+        )
+    else:
+        cur.execute(
+            "UPDATE users SET tier = %s WHERE user_id = %s",
+            (tier, user_id)
+        )
+
+    # Log the upgrade in the upgrades table
+    cur.execute(
+        "INSERT INTO upgrades (user_id, tier, source, duration_days) VALUES (%s, %s, %s, %s)",
+        (user_id, tier, source, expiry_days)
+    )
+    publish_change(cur, {"k": "tier", "u": user_id, "t": tier})
+    return True
 
 def log_upgrade(user_id, tier, source, expiry_days=None):
     """Logs an upgrade and updates user's tier and expiry date."""
     try:
         with get_db_conn() as conn:
             with conn.cursor() as cur:
-                # First, get current user data
-                cur.execute("SELECT tier, trial_expiry FROM users WHERE user_id = %s", (user_id,))
-                user_data = cur.fetchone()
-
-                # Calculate new expiry date if a duration is given
-                if expiry_days:
-                    current_expiry = user_data['trial_expiry'] if user_data and user_data['trial_expiry'] and user_data['trial_expiry'] > datetime.utcnow() else datetime.utcnow()
-                    new_expiry = current_expiry + timedelta(days=expiry_days)
-                    cur.execute(
-                        "UPDATE users SET tier = %s, trial_expiry = %s WHERE user_id = %s",
-                        (tier, new_expiry, user_id)
-                    )
-                else:
-                    cur.execute(
-                        "UPDATE users SET tier = %s WHERE user_id = %s",
-                        (tier, user_id)
-                    )
-
-                # Log the upgrade in the upgrades table
-                cur.execute(
-                    "INSERT INTO upgrades (user_id, tier, source, duration_days) VALUES (%s, %s, %s, %s)",
-                    (user_id, tier, source, expiry_days)
-                )
+                if not apply_upgrade(cur, user_id, tier, source, expiry_days):
+                    logger.warning("Upgrade skipped: user %s does not exist", user_id)
             conn.commit()
     except Exception as e:
-        logger.error(f"Failed to log upgrade for user {user_id}: {e}")
+        logger.error("Failed to log upgrade for user %s: %s", user_id, e)
 
 async def list_user_signals(user_id):
     """Retrieves all signals for a specific user."""
     try:
         with get_db_conn() as conn:
             with conn.cursor() as cur:
-                cur.execute(
-                    "SELECT id, symbol, status FROM signals WHERE user_id = %s ORDER BY created_at DESC",
-                    (user_id,)
-                )
+                statements.execute(cur, "list_user_signals", (user_id,))
                 signals = cur.fetchall()
                 return [(signal['id'], signal['symbol'], signal['status']) for signal in signals]
     except Exception as e:
-        logger.error(f"Failed to list signals for user {user_id}: {e}")
+        logger.error("Failed to list signals for user %s: %s", user_id, e)
         return []
 
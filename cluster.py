@@ -0,0 +1,205 @@
+# cluster.py
+import os
+import socket
+import asyncio
+import logging
+import time
+import zlib
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+import bot_commands
+import storage
+
+logger = logging.getLogger(__name__)
+
+# === Cluster Configuration ===
+CLUSTER_MODE = os.getenv("CLUSTER_MODE", "0").lower() in ("1", "true", "yes")
+INSTANCE_ID = os.getenv("INSTANCE_ID") or f"{socket.gethostname()}:{os.getpid()}"
+SHARD_COUNT = int(os.getenv("CLUSTER_SHARDS", "16"))
+HEARTBEAT_SECONDS = 5
+LEASE_TTL_SECONDS = 20
+# Instances silent for this long are removed from the registry entirely.
+INSTANCE_PURGE_SECONDS = LEASE_TTL_SECONDS * 10
+
+SHARD_PREFIX = "shard:"
+JOB_PREFIX = "job:"
+UPDATES_JOB = "updates"
+
+# === Local Ownership State ===
+_jobs: Dict[str, Optional[Callable[[bool], Awaitable[None]]]] = {}
+_owned: Set[str] = set()
+_owned_until = 0.0
+_live_instances: List[str] = []
+_task: Optional[asyncio.Task] = None
+
+def shard_for(symbol: str) -> int:
+    """Maps a symbol to its shard number (stable across processes)."""
+    return zlib.crc32(symbol.upper().encode()) % SHARD_COUNT
+
+def _leases_valid() -> bool:
+    return time.monotonic() < _owned_until
+
+def owns_symbol(symbol: str) -> bool:
+    """True if this instance is responsible for evaluating the given symbol."""
+    if not CLUSTER_MODE:
+        return True
+    return _leases_valid() and f"{SHARD_PREFIX}{shard_for(symbol)}" in _owned
+
+def owns_job(name: str) -> bool:
+    """True if this instance should run the named singleton job."""
+    if not CLUSTER_MODE:
+        return True
+    return _leases_valid() and f"{JOB_PREFIX}{name}" in _owned
+
+def is_sole_instance() -> bool:
+    """True outside cluster mode, or if no other instance was live at the last heartbeat."""
+    if not CLUSTER_MODE:
+        return True
+    return _live_instances in ([], [INSTANCE_ID])
+
+def register_job(name: str, on_change: Optional[Callable[[bool], Awaitable[None]]] = None) -> None:
+    """Declares a singleton job so exactly one instance holds its lease.
+
+    Args:
+        name: Job name, e.g. 'expiry_sweep'
+        on_change: Optional coroutine called after every heartbeat with the
+            current ownership flag, so the job can start or stop itself
+    """
+    _jobs[name] = on_change
+
+def _desired_leases(instances: List[str]) -> List[str]:
+    """Spreads shards and jobs deterministically over the sorted live instances."""
+    if INSTANCE_ID not in instances:
+        return []
+    count = len(instances)
+    index = instances.index(INSTANCE_ID)
+    desired = [f"{SHARD_PREFIX}{shard}" for shard in range(SHARD_COUNT) if shard % count == index]
+    desired += [
+        f"{JOB_PREFIX}{name}" for name in sorted(_jobs)
+        if zlib.crc32(name.encode()) % count == index
+    ]
+    return desired
+
+def _heartbeat() -> Set[str]:
+    """Registers this instance, rebalances leases and returns the ones it holds."""
+    global _live_instances
+    with bot_commands.get_db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO cluster_instances (instance_id, hostname, pid)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (instance_id) DO UPDATE SET heartbeat_at = CURRENT_TIMESTAMP
+                """,
+                (INSTANCE_ID, socket.gethostname(), os.getpid())
+            )
+            cur.execute(
+                "DELETE FROM cluster_instances WHERE heartbeat_at < CURRENT_TIMESTAMP - make_interval(secs => %s)",
+                (INSTANCE_PURGE_SECONDS,)
+            )
+            cur.execute(
+                "SELECT instance_id FROM cluster_instances WHERE heartbeat_at >= CURRENT_TIMESTAMP - make_interval(secs => %s) ORDER BY instance_id",
+                (LEASE_TTL_SECONDS,)
+            )
+            instances = [row['instance_id'] for row in cur.fetchall()]
+            desired = _desired_leases(instances)
+
+            # Hand back anything that now belongs to another instance.
+            cur.execute(
+                "DELETE FROM cluster_leases WHERE owner_id = %s AND NOT (name = ANY(%s))",
+                (INSTANCE_ID, desired)
+            )
+            # Renew our leases and take over free or expired ones in a single statement.
+            cur.execute(
+                """
+                INSERT INTO cluster_leases (name, owner_id, expires_at)
+                SELECT name, %s, CURRENT_TIMESTAMP + make_interval(secs => %s) FROM unnest(%s::text[]) AS name
+                ON CONFLICT (name) DO UPDATE SET owner_id = EXCLUDED.owner_id, expires_at = EXCLUDED.expires_at
+                WHERE cluster_leases.owner_id = EXCLUDED.owner_id OR cluster_leases.expires_at < CURRENT_TIMESTAMP
+                RETURNING name
+                """,
+                (INSTANCE_ID, LEASE_TTL_SECONDS, desired)
+            )
+            owned = {row['name'] for row in cur.fetchall()}
+        conn.commit()
+    _live_instances = instances
+    return owned
+
+def _leave() -> None:
+    """Drops this instance's leases and registration so others rebalance immediately."""
+    with bot_commands.get_db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM cluster_leases WHERE owner_id = %s", (INSTANCE_ID,))
+            cur.execute("DELETE FROM cluster_instances WHERE instance_id = %s", (INSTANCE_ID,))
+        conn.commit()
+
+async def _tick() -> None:
+    global _owned, _owned_until
+    started = time.monotonic()
+    try:
+        owned = await asyncio.to_thread(_heartbeat)
+    except Exception as e:
+        logger.error("Cluster heartbeat failed for %s: %s", INSTANCE_ID, e)
+    else:
+        if owned != _owned:
+            logger.info("Instance %s now holds %s leases across %s live instances.", INSTANCE_ID, len(owned), len(_live_instances))
+        _owned = owned
+        # Stop trusting our leases a little before they could expire in the database.
+        _owned_until = started + LEASE_TTL_SECONDS - HEARTBEAT_SECONDS
+
+    for name, on_change in list(_jobs.items()):
+        if on_change is None:
+            continue
+        try:
+            await on_change(owns_job(name))
+        except Exception as e:
+            logger.error("Cluster job callback for '%s' failed: %s", name, e)
+
+async def _run() -> None:
+    while True:
+        await _tick()
+        await asyncio.sleep(HEARTBEAT_SECONDS)
+
+async def start(app) -> None:
+    """Joins the cluster and starts the heartbeat loop (no-op outside cluster mode)."""
+    global _task
+    if not CLUSTER_MODE:
+        return
+    if storage.is_sqlite():
+        raise RuntimeError("Cluster mode requires PostgreSQL; the SQLite engine is single-node only")
+    await _tick()
+    _task = asyncio.create_task(_run())
+    logger.info("Cluster mode enabled: instance %s, %s shards.", INSTANCE_ID, SHARD_COUNT)
+
+async def stop(app) -> None:
+    """Stops the heartbeat loop and releases all leases held by this instance."""
+    global _task, _owned, _owned_until
+    if not CLUSTER_MODE:
+        return
+    if _task:
+        _task.cancel()
+        _task = None
+    _owned = set()
+    _owned_until = 0.0
+    for name, on_change in list(_jobs.items()):
+        if on_change is not None:
+            try:
+                await on_change(False)
+            except Exception as e:
+                logger.error("Cluster job callback for '%s' failed during shutdown: %s", name, e)
+    try:
+        await asyncio.to_thread(_leave)
+    except Exception as e:
+        logger.error("Failed to leave cluster cleanly: %s", e)
+
+def status_text() -> str:
+    """Human-readable summary of cluster state for the admin panel."""
+    if not CLUSTER_MODE:
+        return "🖧 Cluster mode: off (single instance)"
+    shards = sorted(int(name[len(SHARD_PREFIX):]) for name in _owned if name.startswith(SHARD_PREFIX))
+    jobs = sorted(name[len(JOB_PREFIX):] for name in _owned if name.startswith(JOB_PREFIX))
+    return (
+        f"🖧 Cluster instance: {INSTANCE_ID}\n"
+        f"  - Live instances: {len(_live_instances)}\n"
+        f"  - Shards: {', '.join(map(str, shards)) or 'none'} of {SHARD_COUNT}\n"
+        f"  - Jobs: {', '.join(jobs) or 'none'}"
+    )
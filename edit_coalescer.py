@@ -0,0 +1,150 @@
+# edit_coalescer.py
+import asyncio
+import logging
+from typing import Dict, Optional, Tuple
+from telegram import CallbackQuery, InlineKeyboardMarkup
+from telegram.error import BadRequest
+
+logger = logging.getLogger(__name__)
+
+# === Constants ===
+DEFAULT_DEBOUNCE_SECONDS = 0.6
+MAX_TRACKED_MESSAGES = 1000
+
+class EditCoalescer:
+    """Coalesces rapid message edits from callback-driven screens.
+
+    Only the latest desired text/markup per message is kept; it is sent once
+    the debounce window has passed without a newer edit. Callback queries
+    must still be answered by the handler straight away.
+    """
+
+    def __init__(self, debounce_seconds: float = DEFAULT_DEBOUNCE_SECONDS):
+        self.debounce_seconds = debounce_seconds
+        self._pending: Dict[Tuple[int, int], Tuple[CallbackQuery, str, Optional[InlineKeyboardMarkup]]] = {}
+        self._timers: Dict[Tuple[int, int], asyncio.Task] = {}
+        self._last_sent: Dict[Tuple[int, int], Tuple[str, Optional[InlineKeyboardMarkup]]] = {}
+        # Bumped by every schedule/edit_now/discard; a send whose number is outdated is dropped.
+        self._seq: Dict[Tuple[int, int], int] = {}
+        # Serializes sends per message, so an in-flight flush finishes before a final edit goes out.
+        self._locks: Dict[Tuple[int, int], asyncio.Lock] = {}
+        self._lock_users: Dict[Tuple[int, int], int] = {}
+
+    @staticmethod
+    def _key(query: CallbackQuery) -> Tuple[int, int]:
+        message = query.message
+        return (message.chat_id, message.message_id)
+
+    def schedule(self, query: CallbackQuery, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None) -> None:
+        """Records the desired state of the query's message and (re)starts its debounce timer.
+
+        Args:
+            query: The callback query whose message should be edited
+            text: New message text
+            reply_markup: New inline keyboard, if any
+        """
+        key = self._key(query)
+        self._bump(key)
+        self._pending[key] = (query, text, reply_markup)
+
+        timer = self._timers.get(key)
+        if timer and not timer.done():
+            timer.cancel()
+        self._timers[key] = asyncio.create_task(self._flush_later(key))
+
+    async def edit_now(self, query: CallbackQuery, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None) -> None:
+        """Drops any pending edit for the message and applies this one immediately.
+
+        Use this for final screens (confirm/cancel) so a late flush cannot overwrite them:
+        a flush already being sent completes first, and one not yet sent is dropped.
+        """
+        self.discard(query)
+        key = self._key(query)
+        self._bump(key)
+        await self._send_serialized(key, self._seq[key], query, text, reply_markup)
+
+    def discard(self, query: CallbackQuery) -> None:
+        """Forgets any pending edit for the query's message."""
+        key = self._key(query)
+        if key in self._lock_users:
+            # Invalidates a send that is in flight or waiting for the lock.
+            self._bump(key)
+        else:
+            self._seq.pop(key, None)
+        self._pending.pop(key, None)
+        self._last_sent.pop(key, None)
+        timer = self._timers.pop(key, None)
+        if timer and not timer.done() and timer is not asyncio.current_task():
+            timer.cancel()
+
+    async def flush(self, query: CallbackQuery) -> None:
+        """Sends the pending edit for the query's message right away, if there is one."""
+        key = self._key(query)
+        timer = self._timers.pop(key, None)
+        if timer and not timer.done():
+            timer.cancel()
+        await self._flush_key(key)
+
+    async def flush_all(self) -> None:
+        """Sends every pending edit; intended for shutdown."""
+        for key in list(self._pending):
+            timer = self._timers.pop(key, None)
+            if timer and not timer.done():
+                timer.cancel()
+            await self._flush_key(key)
+
+    async def _flush_later(self, key: Tuple[int, int]) -> None:
+        try:
+            await asyncio.sleep(self.debounce_seconds)
+        except asyncio.CancelledError:
+            return
+        self._timers.pop(key, None)
+        await self._flush_key(key)
+
+    async def _flush_key(self, key: Tuple[int, int]) -> None:
+        pending = self._pending.pop(key, None)
+        if not pending:
+            return
+        query, text, reply_markup = pending
+        if self._last_sent.get(key) == (text, reply_markup):
+            return
+        await self._send_serialized(key, self._seq.get(key, 0), query, text, reply_markup)
+
+    def _bump(self, key: Tuple[int, int]) -> None:
+        self._seq[key] = self._seq.get(key, 0) + 1
+
+    async def _send_serialized(self, key: Tuple[int, int], seq: int, query: CallbackQuery, text: str,
+                               reply_markup: Optional[InlineKeyboardMarkup]) -> None:
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._lock_users[key] = self._lock_users.get(key, 0) + 1
+        try:
+            async with lock:
+                if self._seq.get(key, 0) != seq:
+                    # A newer edit or a discard arrived while this one waited.
+                    return
+                await self._send(key, query, text, reply_markup)
+        finally:
+            self._lock_users[key] -= 1
+            if not self._lock_users[key]:
+                del self._lock_users[key]
+                del self._locks[key]
+                if key not in self._pending:
+                    self._seq.pop(key, None)
+
+    async def _send(self, key: Tuple[int, int], query: CallbackQuery, text: str, reply_markup: Optional[InlineKeyboardMarkup]) -> None:
+        try:
+            await query.edit_message_text(text, reply_markup=reply_markup)
+            self._last_sent.pop(key, None)
+            self._last_sent[key] = (text, reply_markup)
+            if len(self._last_sent) > MAX_TRACKED_MESSAGES:
+                # Forget the oldest message; at worst it gets one redundant edit later.
+                self._last_sent.pop(next(iter(self._last_sent)))
+        except BadRequest as e:
+            # Telegram rejects edits that do not change anything; that is not an error for us.
+            if "not modified" not in str(e).lower():
+                logger.warning("Coalesced edit failed for message %s: %s", key, e)
+        except Exception as e:
+            logger.error("Unexpected error during coalesced edit for message %s: %s", key, e)
+
+# Shared instance used by the signal list, edit and delete flows, the plans screen and admin screens.
+coalescer = EditCoalescer()
@@ -0,0 +1,166 @@
+# export.py
+import os
+import csv
+import gzip
+import json
+import asyncio
+import logging
+import tempfile
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+from telegram import Update
+from telegram.ext import ContextTypes
+import bot_commands
+import admin_commands
+
+logger = logging.getLogger(__name__)
+
+# === Constants ===
+EXPORT_FORMATS = ('csv', 'json')
+EXPORT_COLUMNS = [
+    'id', 'user_id', 'symbol', 'entry_price', 'target_price_1', 'target_price_2',
+    'target_price_3', 'stop_loss', 'status', 'tags', 'created_at'
+]
+CURSOR_ITERSIZE = 2000
+# Telegram bots cannot upload documents larger than 50 MB.
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+
+USAGE = (
+    "Usage: /export [csv|json] [from=YYYY-MM-DD] [to=YYYY-MM-DD] [status=<status>] [tag=<tag>]"
+)
+
+def parse_export_args(args) -> Tuple[str, Dict[str, object]]:
+    """Parses the export format and filters from command arguments.
+
+    Args:
+        args: Command arguments, e.g. ['json', 'from=2024-01-01', 'tag=scalp']
+
+    Returns:
+        Tuple of (format, filters)
+
+    Raises:
+        ValueError: If an argument is not recognised or a date is malformed
+    """
+    fmt = 'csv'
+    filters: Dict[str, object] = {}
+    for arg in args:
+        lowered = arg.lower()
+        if lowered in EXPORT_FORMATS:
+            fmt = lowered
+            continue
+        key, sep, value = arg.partition('=')
+        key = key.lower()
+        if not sep or not value:
+            raise ValueError(f"Unrecognised argument '{arg}'")
+        if key == 'from':
+            filters['from'] = datetime.strptime(value, "%Y-%m-%d")
+        elif key == 'to':
+            # Inclusive end date
+            filters['to'] = datetime.strptime(value, "%Y-%m-%d") + timedelta(days=1)
+        elif key == 'status':
+            filters['status'] = value
+        elif key == 'tag':
+            filters['tag'] = value
+        else:
+            raise ValueError(f"Unknown filter '{key}'")
+    return fmt, filters
+
+def _build_query(user_id: Optional[int], filters: Dict[str, object]) -> Tuple[str, list]:
+    clauses, params = [], []
+    if user_id is not None:
+        clauses.append("user_id = %s")
+        params.append(user_id)
+    if 'from' in filters:
+        clauses.append("created_at >= %s")
+        params.append(filters['from'])
+    if 'to' in filters:
+        clauses.append("created_at < %s")
+        params.append(filters['to'])
+    if 'status' in filters:
+        clauses.append("LOWER(status) = LOWER(%s)")
+        params.append(filters['status'])
+    if 'tag' in filters:
+        clauses.append("tags ILIKE %s")
+        params.append(f"%{filters['tag']}%")
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    sql = f"SELECT {', '.join(EXPORT_COLUMNS)} FROM signals {where} ORDER BY id"
+    return sql, params
+
+def write_export(path: str, fmt: str, user_id: Optional[int], filters: Dict[str, object]) -> int:
+    """Streams matching signals into a gzip-compressed file and returns the row count.
+
+    Rows are pulled through a server-side cursor in batches of CURSOR_ITERSIZE and
+    written as they arrive, so memory use does not grow with the number of rows.
+    """
+    sql, params = _build_query(user_id, filters)
+    count = 0
+    with bot_commands.get_db_conn() as conn:
+        # A named cursor keeps the result set on the server.
+        with conn.cursor(name=f"export_{os.getpid()}_{id(path)}") as cur:
+            cur.itersize = CURSOR_ITERSIZE
+            cur.execute(sql, params)
+            with gzip.open(path, 'wt', encoding='utf-8', newline='') as out:
+                if fmt == 'csv':
+                    writer = csv.DictWriter(out, fieldnames=EXPORT_COLUMNS)
+                    writer.writeheader()
+                    for row in cur:
+                        writer.writerow(row)
+                        count += 1
+                else:
+                    out.write("[")
+                    for row in cur:
+                        out.write(",\n" if count else "\n")
+                        out.write(json.dumps(row, default=str))
+                        count += 1
+                    out.write("\n]\n")
+        conn.commit()
+    return count
+
+async def _send_export(update: Update, user_id: Optional[int], args, label: str) -> None:
+    try:
+        fmt, filters = parse_export_args(args)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}.\n{USAGE}")
+        return
+
+    fd, path = tempfile.mkstemp(prefix="targethawk_export_", suffix=f".{fmt}.gz")
+    os.close(fd)
+    try:
+        await update.message.reply_text("⏳ Preparing your export...")
+        # The export runs in a worker thread so the event loop keeps serving other users.
+        count = await asyncio.to_thread(write_export, path, fmt, user_id, filters)
+        if count == 0:
+            await update.message.reply_text("ℹ️ No signals match those filters.")
+            return
+        if os.path.getsize(path) > MAX_UPLOAD_BYTES:
+            await update.message.reply_text("❌ The export is too large to upload. Please narrow it down with filters.")
+            return
+
+        filename = f"signals_{label}_{datetime.utcnow():%Y%m%d_%H%M%S}.{fmt}.gz"
+        with open(path, 'rb') as document:
+            await update.message.reply_document(
+                document=document,
+                filename=filename,
+                caption=f"📦 Exported {count} signal(s)."
+            )
+        logger.info("Exported %s signals (%s) for %s", count, fmt, label)
+    except Exception as e:
+        logger.error("Failed to export signals for %s: %s", label, e)
+        await update.message.reply_text("❌ Failed to export signals. Please try again later.")
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+async def export_signals(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Exports the user's own signal history as a compressed CSV/JSON document."""
+    user_id = update.effective_user.id
+    await _send_export(update, user_id, context.args, f"user{user_id}")
+
+async def export_all_signals(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin-only: exports every user's signals as a compressed CSV/JSON document."""
+    if not admin_commands.is_admin(update.effective_user.id):
+        await update.message.reply_text("⛔️ You are not authorized to use this command.")
+        return
+    await _send_export(update, None, context.args, "all")
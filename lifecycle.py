@@ -0,0 +1,349 @@
+# lifecycle.py
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, List, Optional, Set, Tuple
+import httpx
+import bot_commands
+import storage
+import cluster
+import state_cache
+import outbox
+
+logger = logging.getLogger(__name__)
+
+# === Constants ===
+PRICE_API_URL = os.getenv("PRICE_API_URL", "https://api.binance.com/api/v3/ticker/price")
+EVALUATION_INTERVAL_SECONDS = 15
+# Last-seen prices of signals without a transition are persisted this often.
+CHECKPOINT_SECONDS = 300
+DEFAULT_QUOTE = "USDT"
+
+class SignalState:
+    """Evaluation state of one active signal.
+
+    `level` is the number of targets already hit, so only `targets[level]`
+    (the next target) and the stop-loss need to be compared on each tick.
+    """
+
+    __slots__ = ('id', 'user_id', 'symbol', 'direction', 'targets', 'stop_loss', 'level', 'status', 'last_price', 'dirty')
+
+    def __init__(self, row: dict):
+        self.id = row['id']
+        self.user_id = row['user_id']
+        self.symbol = row['symbol']
+        entry = float(row['entry_price'])
+        self.targets = tuple(
+            float(row[f'target_price_{n}']) if row[f'target_price_{n}'] is not None else None
+            for n in (1, 2, 3)
+        )
+        self.stop_loss = float(row['stop_loss']) if row['stop_loss'] is not None else None
+        first_target = self.targets[0]
+        if first_target is not None:
+            self.direction = 1 if first_target >= entry else -1
+        else:
+            self.direction = 1 if self.stop_loss is None or self.stop_loss <= entry else -1
+        self.level = row['last_level'] or 0
+        self.status = row['status']
+        self.last_price = float(row['last_price']) if row['last_price'] is not None else None
+        self.dirty = False
+
+    def evaluate(self, price: float) -> List[Tuple[str, str]]:
+        """Advances the state for a new price and returns (from_status, to_status) transitions."""
+        transitions = []
+        if price != self.last_price:
+            self.last_price = price
+            self.dirty = True
+        if not self.targets_done:
+            if self.stop_loss is not None and (price - self.stop_loss) * self.direction <= 0:
+                transitions.append((self.status, bot_commands.SIGNAL_STOPPED))
+                self.status = bot_commands.SIGNAL_STOPPED
+                return transitions
+            # A gap can cross several targets at once; each one is recorded.
+            while self.level < 3:
+                target = self.targets[self.level]
+                if target is None or (price - target) * self.direction < 0:
+                    break
+                new_status = bot_commands.SIGNAL_TARGET_STATUSES[self.level]
+                transitions.append((self.status, new_status))
+                self.status = new_status
+                self.level += 1
+        if self.targets_done and self.active:
+            # The last target set was hit; T3 Hit is terminal already.
+            transitions.append((self.status, bot_commands.SIGNAL_COMPLETED))
+            self.status = bot_commands.SIGNAL_COMPLETED
+        return transitions
+
+    @property
+    def targets_done(self) -> bool:
+        """True once every target that was set has been hit."""
+        return self.level > 0 and (self.level == 3 or self.targets[self.level] is None)
+
+    @property
+    def active(self) -> bool:
+        return self.status in bot_commands.ACTIVE_SIGNAL_STATUSES
+
+# === In-memory Book ===
+# symbol -> signal id -> state; holds every active signal, only owned shards are evaluated.
+_book: Dict[str, Dict[int, SignalState]] = {}
+_index: Dict[int, SignalState] = {}
+_refresh_ids: Set[int] = set()
+_needs_full_load = True
+_last_checkpoint = 0.0
+_task: Optional[asyncio.Task] = None
+
+SIGNAL_COLUMNS = "id, user_id, symbol, entry_price, target_price_1, target_price_2, target_price_3, stop_loss, status, last_level, last_price"
+
+def _add(state: SignalState) -> None:
+    _remove(state.id)
+    if state.active:
+        _book.setdefault(state.symbol, {})[state.id] = state
+        _index[state.id] = state
+
+def _remove(signal_id: int) -> None:
+    state = _index.pop(signal_id, None)
+    if state:
+        symbol_signals = _book.get(state.symbol, {})
+        symbol_signals.pop(signal_id, None)
+        if not symbol_signals:
+            _book.pop(state.symbol, None)
+
+def _on_change(event: dict) -> None:
+    global _needs_full_load
+    if event.get('k') == 'reload':
+        _needs_full_load = True
+    elif event.get('k') == 'sig':
+        if event['op'] == 'del':
+            for signal_id in event['ids']:
+                _remove(signal_id)
+                _refresh_ids.discard(signal_id)
+        else:
+            # Fetched in one batch on the next tick (targets or stop may have changed).
+            _refresh_ids.add(event['id'])
+
+state_cache.subscribe(_on_change)
+
+def _load_signals(ids: Optional[List[int]] = None) -> List[dict]:
+    with bot_commands.get_db_conn() as conn:
+        with conn.cursor() as cur:
+            if ids is None:
+                cur.execute(
+                    f"SELECT {SIGNAL_COLUMNS} FROM signals WHERE status IN %s",
+                    (bot_commands.ACTIVE_SIGNAL_STATUSES,)
+                )
+            else:
+                cur.execute(f"SELECT {SIGNAL_COLUMNS} FROM signals WHERE id = ANY(%s)", (ids,))
+            return cur.fetchall()
+
+async def _sync_book() -> None:
+    global _needs_full_load, _book, _index
+    if _needs_full_load:
+        _needs_full_load = False
+        _refresh_ids.clear()
+        rows = await asyncio.to_thread(_load_signals)
+        _book, _index = {}, {}
+        for row in rows:
+            _add(SignalState(row))
+        logger.info("Signal book loaded: %s active signals across %s symbols.", len(_index), len(_book))
+    elif _refresh_ids:
+        ids = list(_refresh_ids)
+        _refresh_ids.clear()
+        rows = await asyncio.to_thread(_load_signals, ids)
+        found = set()
+        for row in rows:
+            found.add(row['id'])
+            _add(SignalState(row))
+        for signal_id in set(ids) - found:
+            _remove(signal_id)
+
+# === Prices ===
+async def fetch_prices(client: httpx.AsyncClient) -> Dict[str, float]:
+    """Fetches the latest price of every listed pair in one request."""
+    response = await client.get(PRICE_API_URL)
+    response.raise_for_status()
+    return {item['symbol']: float(item['price']) for item in response.json()}
+
+def _price_for(symbol: str, prices: Dict[str, float]) -> Optional[float]:
+    price = prices.get(symbol)
+    if price is None:
+        price = prices.get(f"{symbol}{DEFAULT_QUOTE}")
+    return price
+
+# === Evaluation ===
+def evaluate_prices(prices: Dict[str, float]) -> List[Tuple[SignalState, str, str, float]]:
+    """Runs one evaluation tick over the owned symbols and returns all transitions."""
+    transitions = []
+    for symbol, signals in list(_book.items()):
+        if not cluster.owns_symbol(symbol):
+            continue
+        price = _price_for(symbol, prices)
+        if price is None:
+            continue
+        for state in list(signals.values()):
+            for from_status, to_status in state.evaluate(price):
+                transitions.append((state, from_status, to_status, price))
+            if not state.active:
+                _remove(state.id)
+    return transitions
+
+def persist_transitions(transitions: List[Tuple[SignalState, str, str, float]], checkpoint: List[SignalState]) -> List[int]:
+    """Writes events, grouped status updates, price checkpoints and alerts in one transaction.
+
+    Each status update only applies while the row still has the status and
+    level the transitions were computed from, so a concurrent cancel or edit is
+    never overwritten. Events and alerts are written only for applied rows.
+
+    Returns:
+        Ids of signals whose row had changed; their in-memory state must be reloaded
+    """
+    stale: List[int] = []
+    with bot_commands.get_db_conn() as conn:
+        with conn.cursor() as cur:
+            if transitions:
+                final: Dict[int, SignalState] = {}
+                expected: Dict[int, Tuple[str, int]] = {}
+                for state, from_status, to_status, _ in transitions:
+                    final[state.id] = state
+                    if state.id not in expected:
+                        targets_hit = sum(1 for t in transitions if t[0] is state and t[2] in bot_commands.SIGNAL_TARGET_STATUSES)
+                        expected[state.id] = (from_status, state.level - targets_hit)
+                # One UPDATE per (expected status, level, new status, level) group rather than one per signal.
+                groups: Dict[Tuple[str, int, str, int], List[int]] = {}
+                for state in final.values():
+                    groups.setdefault(expected[state.id] + (state.status, state.level), []).append(state.id)
+                applied = set()
+                for (from_status, from_level, status, level), ids in groups.items():
+                    cur.execute(
+                        """
+                        UPDATE signals SET status = %s, last_level = %s, evaluated_at = CURRENT_TIMESTAMP
+                        WHERE id = ANY(%s) AND status = %s AND COALESCE(last_level, 0) = %s
+                        RETURNING id
+                        """,
+                        (status, level, ids, from_status, from_level)
+                    )
+                    applied.update(row['id'] for row in cur.fetchall())
+                stale = [signal_id for signal_id in final if signal_id not in applied]
+                transitions = [t for t in transitions if t[0].id in applied]
+
+                if transitions:
+                    storage.execute_values(
+                        cur,
+                        "INSERT INTO signal_events (signal_id, from_status, to_status, price) VALUES %s",
+                        [(state.id, from_status, to_status, price) for state, from_status, to_status, price in transitions]
+                    )
+                for signal_id in applied:
+                    state = final[signal_id]
+                    bot_commands.publish_change(cur, {"k": "sig", "op": "upsert", "id": state.id, "u": state.user_id, "s": state.symbol, "st": state.status})
+                # Stop-loss hits bypass the user's digest window; completion follows a target alert already sent.
+                outbox.enqueue_many(cur, [
+                    (state.user_id, _transition_text(state, to_status, price), to_status == bot_commands.SIGNAL_STOPPED)
+                    for state, _, to_status, price in transitions
+                    if to_status != bot_commands.SIGNAL_COMPLETED
+                ])
+            if checkpoint:
+                # Rows whose status moved on (cancelled, or a transition skipped above) are left alone.
+                storage.execute_values(
+                    cur,
+                    """
+                    UPDATE signals AS s SET last_price = v.price, evaluated_at = CURRENT_TIMESTAMP
+                    FROM (VALUES %s) AS v (id, price, status)
+                    WHERE s.id = v.id AND s.status = v.status
+                    """,
+                    [(state.id, state.last_price, state.status) for state in checkpoint]
+                )
+        conn.commit()
+    return stale
+
+def _transition_text(state: SignalState, to_status: str, price: float) -> str:
+    if to_status == bot_commands.SIGNAL_STOPPED:
+        return f"🛑 {state.symbol} signal #{state.id} hit its stop-loss at {price:g}."
+    return f"🎯 {state.symbol} signal #{state.id}: {to_status} at {price:g}!"
+
+async def _tick(app, client: httpx.AsyncClient) -> None:
+    global _last_checkpoint, _needs_full_load
+    await _sync_book()
+    if not _book:
+        return
+    prices = await fetch_prices(client)
+    transitions = evaluate_prices(prices)
+
+    due: Dict[int, SignalState] = {}
+    now = time.monotonic()
+    if now - _last_checkpoint >= CHECKPOINT_SECONDS:
+        _last_checkpoint = now
+        due = {state.id: state for state in _index.values() if state.dirty}
+    # Signals that just transitioned get their price written along with the status.
+    for state, _, _, _ in transitions:
+        if state.dirty:
+            due[state.id] = state
+    checkpoint = list(due.values())
+
+    # Signals changed by their owner since the book was synced are re-read instead of persisted.
+    changed = [t for t in transitions if t[0].id in _refresh_ids]
+    if changed:
+        transitions = [t for t in transitions if t[0].id not in _refresh_ids]
+        checkpoint = [state for state in checkpoint if state.id not in _refresh_ids]
+
+    stale: List[int] = []
+    if transitions or checkpoint:
+        try:
+            stale = await asyncio.to_thread(persist_transitions, transitions, checkpoint)
+        except Exception:
+            # In-memory states ran ahead of the database; rebuild from it and re-evaluate.
+            _needs_full_load = True
+            raise
+        for state in checkpoint:
+            state.dirty = False
+    if stale or changed:
+        _refresh_ids.update(stale)
+        skipped = {t[0].id for t in changed} | set(stale)
+        logger.info("Signal evaluation: transitions of %s signals skipped after concurrent changes.", len(skipped))
+    if transitions:
+        logger.info("Signal evaluation: %s transitions.", len(transitions))
+        outbox.wake()
+
+async def _run(app) -> None:
+    async with httpx.AsyncClient(timeout=10) as client:
+        while True:
+            started = time.monotonic()
+            try:
+                await _tick(app, client)
+            except Exception as e:
+                logger.error("Signal evaluation tick failed: %s", e)
+            await asyncio.sleep(max(0.0, EVALUATION_INTERVAL_SECONDS - (time.monotonic() - started)))
+
+async def start(app) -> None:
+    """Starts the periodic signal evaluator."""
+    global _task
+    _task = asyncio.create_task(_run(app))
+
+async def stop(app) -> None:
+    """Stops the periodic signal evaluator."""
+    global _task
+    if _task:
+        _task.cancel()
+        _task = None
+
+def cancel_signal(user_id: int, signal_id: int) -> bool:
+    """Moves one of the user's active signals to Cancelled; returns False if none matched."""
+    with bot_commands.get_db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT symbol, status FROM signals WHERE id = %s AND user_id = %s FOR UPDATE",
+                (signal_id, user_id)
+            )
+            row = cur.fetchone()
+            if not row or row['status'] not in bot_commands.ACTIVE_SIGNAL_STATUSES:
+                return False
+            cur.execute(
+                "UPDATE signals SET status = %s, evaluated_at = CURRENT_TIMESTAMP WHERE id = %s",
+                (bot_commands.SIGNAL_CANCELLED, signal_id)
+            )
+            cur.execute(
+                "INSERT INTO signal_events (signal_id, from_status, to_status) VALUES (%s, %s, %s)",
+                (signal_id, row['status'], bot_commands.SIGNAL_CANCELLED)
+            )
+            bot_commands.publish_change(cur, {"k": "sig", "op": "upsert", "id": signal_id, "u": user_id, "s": row['symbol'], "st": bot_commands.SIGNAL_CANCELLED})
+        conn.commit()
+    return True
@@ -0,0 +1,217 @@
+# logging_setup.py
+import os
+import sys
+import copy
+import json
+import time
+import queue
+import atexit
+import logging
+import logging.handlers
+import threading
+import contextvars
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple
+from telegram import Update
+from telegram.ext import ContextTypes
+
+logger = logging.getLogger(__name__)
+
+# === Constants ===
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# "json" (one object per line, for the log pipeline) or "text" (for local development).
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+# Records waiting for the writer thread; beyond this they are dropped instead of blocking.
+QUEUE_SIZE = 10000
+# Each distinct message template may log this many times per window; further ones are sampled.
+SAMPLE_BURST = 20
+SAMPLE_WINDOW_SECONDS = 60
+SAMPLE_EVERY = 100
+SLOW_UPDATE_SECONDS = 1.0
+# Noisy third-party loggers are capped at WARNING.
+QUIET_LOGGERS = ("httpx", "httpcore", "telegram.ext", "apscheduler")
+
+# Per-update fields, set by the middleware and copied onto every record logged while handling it.
+_update_context: contextvars.ContextVar[Optional[Dict]] = contextvars.ContextVar("log_update_context", default=None)
+_listener: Optional[logging.handlers.QueueListener] = None
+
+# === Record Enrichment ===
+class ContextFilter(logging.Filter):
+    """Copies the current update's user_id, handler and elapsed latency onto the record."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        ctx = _update_context.get()
+        if ctx is not None:
+            record.user_id = ctx['user_id']
+            record.handler = ctx['handler']
+            record.update_id = ctx['update_id']
+            record.latency_ms = round((time.monotonic() - ctx['started']) * 1000, 1)
+        return True
+
+class SamplingFilter(logging.Filter):
+    """Limits high-volume messages per template, keeping a burst and then 1 in SAMPLE_EVERY.
+
+    Templates are the unformatted `record.msg`, which is why log calls pass
+    arguments separately instead of pre-formatting them. Warnings and errors
+    are never sampled.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._windows: Dict[Tuple[str, str], list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        key = (record.name, str(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= SAMPLE_WINDOW_SECONDS:
+                suppressed = window[2] if window else 0
+                self._windows[key] = window = [now, 0, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+                if len(self._windows) > QUEUE_SIZE:
+                    self._windows.clear()
+            window[1] += 1
+            if window[1] <= SAMPLE_BURST or window[1] % SAMPLE_EVERY == 0:
+                if window[2]:
+                    record.suppressed = window[2]
+                    window[2] = 0
+                return True
+            window[2] += 1
+            return False
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of blocking when the writer falls behind."""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Merge the arguments once; the traceback is rendered here so no frames are kept alive.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        dropped = self.dropped
+        if dropped:
+            record.dropped = dropped
+        try:
+            self.queue.put_nowait(record)
+            self.dropped -= dropped
+        except queue.Full:
+            self.dropped += 1
+
+# === Formatting ===
+_STANDARD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+class JsonFormatter(logging.Formatter):
+    """Renders each record as one JSON object, including any extra fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class TextFormatter(logging.Formatter):
+    """Human-readable format for local runs, with the update fields appended when present."""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        if getattr(record, 'user_id', None) is not None:
+            text += f" [user={record.user_id} handler={record.handler} {record.latency_ms}ms]"
+        return text
+
+# === Setup ===
+def configure() -> None:
+    """Routes all logging through a bounded queue drained by a background writer thread.
+
+    Callers only filter and enqueue; formatting and writing to stdout happen on
+    the writer thread, so a stalled stream never blocks the event loop.
+    """
+    global _listener
+    if _listener is not None:
+        return
+    log_queue: queue.Queue = queue.Queue(QUEUE_SIZE)
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter())
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL)
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(max(logging.WARNING, root.level))
+
+    _listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown)
+
+def shutdown() -> None:
+    """Writes out queued records and stops the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+# === Update Middleware ===
+def _describe(update: Update) -> str:
+    if update.callback_query:
+        return f"callback:{(update.callback_query.data or '').split(':')[0][:32]}"
+    if update.inline_query:
+        return "inline_query"
+    message = update.message
+    if message and message.text and message.text.startswith('/'):
+        command = (message.text[1:].split() or [''])[0]
+        return "/" + command.split('@')[0].lower()
+    return "message"
+
+async def bind_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Runs first for every update; binds its fields to all records logged while it is handled."""
+    user = update.effective_user
+    _update_context.set({
+        'user_id': user.id if user else None,
+        'handler': _describe(update),
+        'update_id': update.update_id,
+        'started': time.monotonic(),
+    })
+
+async def finish_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Runs last for every update that was not stopped early; logs its total latency."""
+    ctx = _update_context.get()
+    if ctx is None:
+        return
+    elapsed = time.monotonic() - ctx['started']
+    if elapsed >= SLOW_UPDATE_SECONDS:
+        logger.warning("Slow update %s took %.0f ms", ctx['handler'], elapsed * 1000)
+    else:
+        logger.debug("Update %s handled", ctx['handler'])
+    _update_context.set(None)
@@ -1,4 +1,9 @@
 import os
+import time
+# Taken before the heavier imports below, for the startup 'imports' phase.
+_IMPORTS_STARTED = time.perf_counter()
+import asyncio
+import signal
 import logging
 import psycopg2
 from psycopg2.extras import RealDictCursor
@@ -6,16 +11,31 @@ import re
 from datetime import datetime, timedelta
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
-    ApplicationBuilder, CommandHandler, ContextTypes, CallbackQueryHandler
+    ApplicationBuilder, CommandHandler, ContextTypes, CallbackQueryHandler, InlineQueryHandler, TypeHandler
 )
 from dotenv import load_dotenv
 
+import startup
 import start_commands
 import user_commands
 import signal_management
 import admin_commands
 import bot_commands # Import the bot_commands file
 import structure # Import the structure module
+import cluster
+import state_cache
+import export
+import throttle
+import reporting
+import statements
+import lifecycle
+import payment_webhook
+import notifications
+import outbox
+import symbol_catalog
+import referral_tree
+import logging_setup
+from edit_coalescer import coalescer
 
 load_dotenv()
 
@@ -33,7 +53,10 @@ async def track_signal(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Usage: /track <symbol> <entry_price> <target_price_1> <stop_loss> [tags]")
         return
     
-    symbol = args[0].upper()
+    symbol = symbol_catalog.normalize(args[0])
+    if not symbol:
+        await update.message.reply_text(symbol_catalog.unknown_symbol_text(args[0]))
+        return
     try:
         entry_price = float(args[1])
         target_price_1 = float(args[2])
@@ -47,16 +70,17 @@ async def track_signal(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         with bot_commands.get_db_conn() as conn:
             with conn.cursor() as cur:
-                cur.execute(
-                    "INSERT INTO signals (user_id, symbol, entry_price, target_price_1, stop_loss, status, tags) VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id",
+                statements.execute(
+                    cur, "insert_signal",
                     (user_id, symbol, entry_price, target_price_1, stop_loss, "Open", tags)
                 )
                 signal_id = cur.fetchone()['id']
+                bot_commands.publish_change(cur, {"k": "sig", "op": "upsert", "id": signal_id, "u": user_id, "s": symbol, "st": "Open"})
             conn.commit()
 
         await update.message.reply_text(f"✅ Signal for {symbol} created with ID: {signal_id}. It is now being tracked.")
     except Exception as e:
-        logger.error(f"Failed to add signal: {e}")
+        logger.error("Failed to add signal: %s", e)
         await update.message.reply_text("❌ Failed to add signal. Please check your input and try again.")
         
 async def list_signals_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -78,6 +102,10 @@ async def list_signals_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 def register_handlers(app):
     """Registers all the command handlers with the Telegram bot application."""
     
+    # 0. Log context binding, then per-user throttling and load shedding, run before every other handler
+    app.add_handler(TypeHandler(Update, logging_setup.bind_update), group=-2)
+    app.add_handler(TypeHandler(Update, throttle.check_update), group=-1)
+
     # 1. Register all basic command handlers
     app.add_handler(CommandHandler("start", start_commands.start_with_ref))
     app.add_handler(CommandHandler("plans", user_commands.plans))
@@ -86,6 +114,10 @@ def register_handlers(app):
     app.add_handler(CommandHandler("status", user_commands.status))
     app.add_handler(CommandHandler("leaderboard", user_commands.leaderboard))
     app.add_handler(CommandHandler("track", track_signal))
+    app.add_handler(CommandHandler("export", export.export_signals))
+    app.add_handler(CommandHandler("digest", notifications.digest))
+    app.add_handler(CommandHandler("search", symbol_catalog.search_command))
+    app.add_handler(InlineQueryHandler(symbol_catalog.inline_query))
     
     # 2. Register the main signals menu command
     app.add_handler(CommandHandler("signals", list_signals_menu))
@@ -101,6 +133,7 @@ def register_handlers(app):
     # 4. Register the admin commands
     # The 'admin_menu' command handles the main entry point for all admin actions.
     app.add_handler(CommandHandler("admin", admin_commands.admin_menu))
+    app.add_handler(CommandHandler("export_all", export.export_all_signals))
     # This handler processes all the buttons from the admin menu.
     app.add_handler(CallbackQueryHandler(admin_commands.handle_admin_menu_callback))
     # This is the conversation handler for the admin upgrade flow.
@@ -110,24 +143,100 @@ def register_handlers(app):
     app.add_handler(CallbackQueryHandler(start_commands.show_plans_callback, pattern="^show_plans$"))
     app.add_handler(CallbackQueryHandler(start_commands.show_signals_callback, pattern="^show_signals_list$"))
     
-    # 6. Log a message to confirm registration is complete
+    # 6. Log each update's total latency after all other handlers have run
+    app.add_handler(TypeHandler(Update, logging_setup.finish_update), group=100)
+
+    # 7. Log a message to confirm registration is complete
     logger.info("All command and callback handlers registered successfully.")
 
+async def on_startup(app) -> None:
+    """Starts background services once the application is initialized.
+
+    Caches and pooled connections are warmed in the background, so updates are
+    accepted as soon as the services below have started.
+    """
+    with startup.phase("services"):
+        await cluster.start(app)
+        await state_cache.start(app)
+        await symbol_catalog.start(app)
+        await notifications.start(app)
+        await outbox.start(app)
+        await reporting.start(app)
+        await referral_tree.start(app)
+        await lifecycle.start(app)
+        await payment_webhook.start(app)
+    await startup.start(app)
+    startup.mark_ready()
+
+async def on_stop(app) -> None:
+    """Flushes in-flight state and stops background services before the bot stops."""
+    await startup.stop(app)
+    await coalescer.flush_all()
+    await payment_webhook.stop(app)
+    await lifecycle.stop(app)
+    await outbox.flush()
+    await outbox.stop(app)
+    await notifications.stop(app)
+    await referral_tree.stop(app)
+    await reporting.stop(app)
+    await symbol_catalog.stop(app)
+    await state_cache.stop(app)
+    await cluster.stop(app)
+    bot_commands.close_pool()
+
+async def run_cluster_node(app) -> None:
+    """Runs the bot as one cluster instance.
+
+    Telegram allows a single getUpdates consumer per token, so update intake is
+    itself a singleton job: only the instance holding the 'updates' lease polls.
+    """
+    async def sync_polling(owned: bool) -> None:
+        if owned and not app.updater.running:
+            await app.updater.start_polling()
+            logger.info("Instance %s took over update polling.", cluster.INSTANCE_ID)
+        elif not owned and app.updater.running:
+            await app.updater.stop()
+            logger.info("Instance %s handed off update polling.", cluster.INSTANCE_ID)
+
+    cluster.register_job(cluster.UPDATES_JOB, sync_polling)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await app.initialize()
+    await on_startup(app)
+    await app.start()
+    try:
+        await stop_event.wait()
+    finally:
+        await on_stop(app)
+        await app.stop()
+        await app.shutdown()
+
 def main() -> None:
     """Entry point for the bot application."""
+    logging_setup.configure()
+    startup.mark_imports_done(_IMPORTS_STARTED)
     TOKEN = os.getenv("TELEGRAM_BOT_TOKEN1")
     if not TOKEN:
         logger.error("❌ TELEGRAM_BOT_TOKEN environment variable is not set.")
         return
 
-    bot_commands.init_db()
+    with startup.phase("schema"):
+        bot_commands.init_db()
 
-    app = ApplicationBuilder().token(TOKEN).build()
-    register_handlers(app)
+    with startup.phase("handlers"):
+        app = ApplicationBuilder().token(TOKEN).post_init(on_startup).post_stop(on_stop).build()
+        register_handlers(app)
 
     # Start the bot
     logger.info("🚀 Bot is starting...")
-    app.run_polling()
+    if cluster.CLUSTER_MODE:
+        asyncio.run(run_cluster_node(app))
+    else:
+        app.run_polling()
 
 if __name__ == '__main__':
     main()
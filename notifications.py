@@ -0,0 +1,110 @@
+# notifications.py
+import asyncio
+import logging
+from typing import List
+from telegram import Update
+from telegram.ext import ContextTypes
+import bot_commands
+import state_cache
+import outbox
+
+logger = logging.getLogger(__name__)
+
+# === Constants ===
+MAX_DIGEST_MINUTES = 60
+# Telegram rejects messages longer than 4096 characters.
+MAX_MESSAGE_LENGTH = 4000
+
+_bot = None
+
+def _chunks(header: str, lines: List[str]) -> List[str]:
+    messages, current = [], header
+    for line in lines:
+        if len(current) + len(line) + 1 > MAX_MESSAGE_LENGTH and current != header:
+            messages.append(current)
+            current = header
+        current += f"\n{line}"
+    messages.append(current)
+    return messages
+
+async def _send(user_id: int, text: str) -> None:
+    if _bot is None:
+        raise RuntimeError("Notifications have not been started")
+    await _bot.send_message(chat_id=user_id, text=text)
+
+async def notify(user_id: int, text: str) -> None:
+    """Sends one notification now; failures propagate to the caller (the outbox)."""
+    await _send(user_id, text)
+
+async def send_digest(user_id: int, lines: List[str]) -> None:
+    """Sends buffered notifications as one combined message (split at Telegram's length limit).
+
+    Digest buffering itself lives in the outbox, so pending digests survive
+    restarts; a failure propagates and the whole digest is retried.
+    """
+    header = f"📬 Digest: {len(lines)} update(s)" if len(lines) > 1 else "📬 Update"
+    for message in _chunks(header, lines):
+        await _send(user_id, message)
+
+async def start(app) -> None:
+    """Binds the notifier to the application's bot."""
+    global _bot
+    _bot = app.bot
+
+async def stop(app) -> None:
+    """Unbinds the bot; on shutdown outbox.flush() has already sent buffered digests."""
+    global _bot
+    _bot = None
+
+def set_digest_window(user_id: int, seconds: int) -> bool:
+    """Stores a user's digest window; returns False if the user is not registered."""
+    with bot_commands.get_db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("UPDATE users SET digest_seconds = %s WHERE user_id = %s RETURNING user_id", (seconds, user_id))
+            if not cur.fetchone():
+                return False
+            bot_commands.publish_change(cur, {"k": "digest", "u": user_id, "w": seconds})
+            if not seconds:
+                outbox.release_digest(cur, user_id)
+        conn.commit()
+    return True
+
+async def digest(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Shows or changes the user's alert digest window: /digest <minutes>|off."""
+    user_id = update.effective_user.id
+    args = context.args
+    if not args:
+        window = state_cache.digest_window(user_id)
+        current = f"every {window // 60} minute(s)" if window else "off"
+        await update.message.reply_text(
+            f"📬 Alert digest: {current}\n"
+            f"Usage: /digest <minutes> (1-{MAX_DIGEST_MINUTES}) or /digest off\n"
+            "Stop-loss alerts are always sent immediately."
+        )
+        return
+
+    if args[0].lower() == 'off':
+        minutes = 0
+    else:
+        try:
+            minutes = int(args[0])
+        except ValueError:
+            minutes = -1
+        if not 1 <= minutes <= MAX_DIGEST_MINUTES:
+            await update.message.reply_text(f"❌ Minutes must be between 1 and {MAX_DIGEST_MINUTES}, or 'off'.")
+            return
+
+    try:
+        updated = await asyncio.to_thread(set_digest_window, user_id, minutes * 60)
+    except Exception as e:
+        logger.error("Failed to update digest window for user %s: %s", user_id, e)
+        await update.message.reply_text("❌ Failed to update your digest setting.")
+        return
+    if not updated:
+        await update.message.reply_text("❌ You are not registered. Please use /start first.")
+        return
+    if minutes:
+        await update.message.reply_text(f"✅ Alerts will be grouped into one message every {minutes} minute(s).")
+    else:
+        outbox.wake()
+        await update.message.reply_text("✅ Digest mode off. Alerts will be sent immediately.")
@@ -0,0 +1,273 @@
+# outbox.py
+import asyncio
+import logging
+from typing import Dict, List, Optional, Sequence, Tuple
+from telegram.error import BadRequest, Forbidden, RetryAfter
+import bot_commands
+import cluster
+import storage
+import notifications
+import state_cache
+
+logger = logging.getLogger(__name__)
+
+# === Constants ===
+BATCH_SIZE = 100
+POLL_INTERVAL_SECONDS = 2
+# A claimed row becomes due again after this long, so a crash mid-send cannot lose it.
+CLAIM_TIMEOUT_SECONDS = 120
+MAX_ATTEMPTS = 6
+BASE_RETRY_SECONDS = 5
+MAX_RETRY_SECONDS = 3600
+# Users whose digests are sent per drain pass; a digest goes out early once it holds this many rows.
+DIGEST_CHATS_PER_BATCH = 20
+MAX_DIGEST_ROWS = 50
+# Upper bound on the final drain at shutdown.
+FLUSH_TIMEOUT_SECONDS = 10
+
+_wakeup: Optional[asyncio.Event] = None
+_task: Optional[asyncio.Task] = None
+
+# === Writing ===
+def enqueue(cur, chat_id: int, text: str, critical: bool = False) -> None:
+    """Adds a notification to the outbox inside the caller's transaction.
+
+    It is sent only if the transaction commits, and no connection is held while sending.
+    """
+    cur.execute(
+        "INSERT INTO outbox (chat_id, text, critical) VALUES (%s, %s, %s)",
+        (chat_id, text, critical)
+    )
+
+def enqueue_many(cur, rows: Sequence[Tuple[int, str, bool]]) -> None:
+    """Adds several (chat_id, text, critical) notifications in one statement."""
+    if rows:
+        storage.execute_values(cur, "INSERT INTO outbox (chat_id, text, critical) VALUES %s", list(rows))
+
+def wake() -> None:
+    """Asks the drainer to look for new entries now instead of at the next poll."""
+    if _wakeup is not None:
+        _wakeup.set()
+
+# === Draining ===
+def claim_batch() -> List[dict]:
+    """Claims due entries for this drainer; other instances skip rows claimed here."""
+    with bot_commands.get_db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE outbox SET attempts = attempts + 1,
+                                  next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+                WHERE id IN (
+                    SELECT id FROM outbox
+                    WHERE status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP
+                    ORDER BY id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, chat_id, text, critical, attempts
+                """,
+                (CLAIM_TIMEOUT_SECONDS, BATCH_SIZE)
+            )
+            rows = cur.fetchall()
+        conn.commit()
+    return sorted(rows, key=lambda row: row['id'])
+
+def claim_digests() -> List[dict]:
+    """Claims every buffered row of users whose digest is due, for one combined message each."""
+    with bot_commands.get_db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE outbox SET attempts = attempts + 1,
+                                  next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+                WHERE id IN (
+                    SELECT id FROM outbox
+                    WHERE status = 'digest' AND chat_id IN (
+                        SELECT chat_id FROM outbox
+                        WHERE status = 'digest' AND next_attempt_at <= CURRENT_TIMESTAMP
+                        LIMIT %s
+                    )
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, chat_id, text, attempts
+                """,
+                (CLAIM_TIMEOUT_SECONDS, DIGEST_CHATS_PER_BATCH)
+            )
+            rows = cur.fetchall()
+        conn.commit()
+    return sorted(rows, key=lambda row: row['id'])
+
+def release_digest(cur, chat_id: int) -> None:
+    """Makes a user's buffered digest due now (e.g. when digest mode is turned off)."""
+    cur.execute(
+        "UPDATE outbox SET next_attempt_at = CURRENT_TIMESTAMP WHERE chat_id = %s AND status = 'digest'",
+        (chat_id,)
+    )
+
+def release_all_digests() -> int:
+    """Makes every buffered digest due now; returns the number of rows released."""
+    with bot_commands.get_db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("UPDATE outbox SET next_attempt_at = CURRENT_TIMESTAMP WHERE status = 'digest'")
+            released = cur.rowcount
+        conn.commit()
+    return released
+
+def settle_batch(sent_ids: List[int], failures: List[Tuple[int, str, float, str]],
+                 deferred: Sequence[Tuple[int, int]] = ()) -> None:
+    """Deletes sent entries, reschedules or dead-letters failed ones and buffers digest rows, in bulk.
+
+    Args:
+        sent_ids: Outbox ids that were delivered
+        failures: (id, status, retry delay in seconds, error) where status is 'pending', 'digest' or 'dead'
+        deferred: (id, digest window in seconds) of rows to hold for the user's next digest
+    """
+    with bot_commands.get_db_conn() as conn:
+        with conn.cursor() as cur:
+            if sent_ids:
+                cur.execute("DELETE FROM outbox WHERE id = ANY(%s)", (sent_ids,))
+            if failures:
+                storage.execute_values(
+                    cur,
+                    """
+                    UPDATE outbox AS o SET status = v.status,
+                                           next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => v.delay),
+                                           last_error = v.error
+                    FROM (VALUES %s) AS v (id, status, delay, error)
+                    WHERE o.id = v.id
+                    """,
+                    failures
+                )
+            if deferred:
+                # A row joins the digest already buffered for its user, or starts a new one.
+                storage.execute_values(
+                    cur,
+                    """
+                    UPDATE outbox AS o SET status = 'digest', attempts = 0,
+                                           next_attempt_at = COALESCE(
+                                               (SELECT MIN(d.next_attempt_at) FROM outbox d
+                                                WHERE d.chat_id = o.chat_id AND d.status = 'digest'),
+                                               CURRENT_TIMESTAMP + make_interval(secs => v.delay))
+                    FROM (VALUES %s) AS v (id, delay)
+                    WHERE o.id = v.id
+                    """,
+                    deferred
+                )
+                cur.execute(
+                    """
+                    UPDATE outbox SET next_attempt_at = CURRENT_TIMESTAMP
+                    WHERE status = 'digest' AND chat_id IN (
+                        SELECT chat_id FROM outbox
+                        WHERE status = 'digest' AND chat_id IN (SELECT chat_id FROM outbox WHERE id = ANY(%s))
+                        GROUP BY chat_id HAVING COUNT(*) >= %s
+                    )
+                    """,
+                    ([row_id for row_id, _ in deferred], MAX_DIGEST_ROWS)
+                )
+        conn.commit()
+
+def _retry_delay(attempts: int) -> float:
+    return min(BASE_RETRY_SECONDS * 2 ** (attempts - 1), MAX_RETRY_SECONDS)
+
+def _failures(ids: List[int], attempts: int, error: Exception, retry_status: str) -> List[Tuple[int, str, float, str]]:
+    if isinstance(error, (Forbidden, BadRequest)):
+        # The user blocked the bot or the chat is gone; retrying cannot help.
+        status, delay = 'dead', 0
+    elif isinstance(error, RetryAfter):
+        status = retry_status
+        delay = error.retry_after.total_seconds() if hasattr(error.retry_after, 'total_seconds') else float(error.retry_after)
+    else:
+        status = 'dead' if attempts >= MAX_ATTEMPTS else retry_status
+        delay = _retry_delay(attempts)
+    return [(row_id, status, delay, str(error)[:500]) for row_id in ids]
+
+async def drain_once(defer: bool = True) -> int:
+    """Sends one batch of due entries and due digests; returns how many rows were claimed.
+
+    Non-critical rows for users in digest mode are not sent but held as
+    'digest' rows, and deleted only once the digest containing them is delivered.
+    With `defer` off (the final drain at shutdown) they are sent right away.
+    """
+    rows = await asyncio.to_thread(claim_batch)
+    digests = await asyncio.to_thread(claim_digests)
+    if not rows and not digests:
+        return 0
+    sent_ids, failures, deferred = [], [], []
+    for row in rows:
+        window = 0 if row['critical'] or not defer else state_cache.digest_window(row['chat_id'])
+        if window:
+            deferred.append((row['id'], window))
+            continue
+        try:
+            await notifications.notify(row['chat_id'], row['text'])
+            sent_ids.append(row['id'])
+        except Exception as e:
+            failures.extend(_failures([row['id']], row['attempts'], e, 'pending'))
+
+    by_chat: Dict[int, List[dict]] = {}
+    for row in digests:
+        by_chat.setdefault(row['chat_id'], []).append(row)
+    for chat_id, group in by_chat.items():
+        ids = [row['id'] for row in group]
+        try:
+            await notifications.send_digest(chat_id, [row['text'] for row in group])
+            sent_ids.extend(ids)
+        except Exception as e:
+            failures.extend(_failures(ids, max(row['attempts'] for row in group), e, 'digest'))
+
+    await asyncio.to_thread(settle_batch, sent_ids, failures, deferred)
+    dead = sum(1 for failure in failures if failure[1] == 'dead')
+    if failures:
+        logger.warning("Outbox: %s sent, %s to retry, %s dead-lettered.", len(sent_ids), len(failures) - dead, dead)
+    return len(rows) + len(digests)
+
+async def _run() -> None:
+    while True:
+        try:
+            claimed = await drain_once()
+        except Exception as e:
+            logger.error("Outbox drain failed: %s", e)
+            claimed = 0
+        if claimed >= BATCH_SIZE:
+            continue
+        try:
+            await asyncio.wait_for(_wakeup.wait(), POLL_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        _wakeup.clear()
+
+async def start(app) -> None:
+    """Starts the background outbox drainer."""
+    global _wakeup, _task
+    _wakeup = asyncio.Event()
+    _task = asyncio.create_task(_run())
+
+async def flush() -> None:
+    """Delivers buffered digests and everything due before shutdown.
+
+    In cluster mode digests are left to the other live instances, which keep
+    sending them on schedule. Whatever cannot be sent within
+    FLUSH_TIMEOUT_SECONDS stays in the outbox for the next run.
+    """
+    async def drain() -> None:
+        if cluster.is_sole_instance():
+            released = await asyncio.to_thread(release_all_digests)
+            if released:
+                logger.info("Flushing %s buffered digest row(s) before shutdown.", released)
+        while await drain_once(defer=False):
+            pass
+
+    try:
+        await asyncio.wait_for(drain(), FLUSH_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        logger.warning("Outbox flush did not finish within %ss; the rest is sent on the next run.", FLUSH_TIMEOUT_SECONDS)
+    except Exception as e:
+        logger.error("Outbox flush failed: %s", e)
+
+async def stop(app) -> None:
+    """Stops the drainer; undelivered entries stay in the outbox for the next run."""
+    global _task
+    if _task:
+        _task.cancel()
+        _task = None
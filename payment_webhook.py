@@ -0,0 +1,341 @@
+# payment_webhook.py
+import os
+import sys
+import hmac
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import urllib.request
+from typing import Dict, List, Optional, Tuple
+from psycopg2.extras import Json
+import bot_commands
+import cluster
+import outbox
+
+logger = logging.getLogger(__name__)
+
+# === Configuration ===
+WEBHOOK_HOST = os.getenv("PAYMENT_WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("PAYMENT_WEBHOOK_PORT", "8081"))
+WEBHOOK_PATH = "/payments/webhook"
+WEBHOOK_SECRET = os.getenv("PAYMENT_WEBHOOK_SECRET")
+# Signed timestamps older than this are rejected to stop replays.
+SIGNATURE_TOLERANCE_SECONDS = 300
+MAX_BODY_BYTES = 64 * 1024
+HEADER_TIMEOUT_SECONDS = 10
+BATCH_SIZE = 50
+QUEUE_SIZE = 10000
+RECOVERY_INTERVAL_SECONDS = 60
+UPGRADE_EVENT_TYPES = ('payment.succeeded',)
+PAID_TIERS = [tier for tier in bot_commands.VALID_TIERS if tier != 'Free']
+# The port is fixed, so in cluster mode only the instance holding this job listens.
+WEBHOOK_JOB = "payment_webhook"
+
+_queue: Optional[asyncio.Queue] = None
+_server: Optional[asyncio.AbstractServer] = None
+_worker: Optional[asyncio.Task] = None
+
+# === Signatures ===
+def sign(body: bytes, timestamp: int, secret: str) -> str:
+    """Builds the `X-Signature` header value for a payload: `t=<unix>,v1=<hex hmac-sha256>`."""
+    digest = hmac.new(secret.encode(), f"{timestamp}.".encode() + body, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={digest}"
+
+def verify_signature(body: bytes, header: Optional[str], secret: str, now: Optional[float] = None) -> bool:
+    """Checks an `X-Signature` header against the payload and shared secret."""
+    if not header:
+        return False
+    parts = dict(item.split('=', 1) for item in header.split(',') if '=' in item)
+    try:
+        timestamp = int(parts['t'])
+    except (KeyError, ValueError):
+        return False
+    now = time.time() if now is None else now
+    if abs(now - timestamp) > SIGNATURE_TOLERANCE_SECONDS:
+        return False
+    expected = sign(body, timestamp, secret).split('v1=', 1)[1]
+    return hmac.compare_digest(expected, parts.get('v1', ''))
+
+# === Ingestion ===
+def parse_event(body: bytes) -> dict:
+    """Validates a payment event payload.
+
+    Raises:
+        ValueError: If required fields are missing or invalid
+    """
+    event = json.loads(body)
+    if not isinstance(event, dict) or not event.get('id') or not event.get('type'):
+        raise ValueError("Event must have 'id' and 'type'")
+    if event['type'] in UPGRADE_EVENT_TYPES:
+        user_id = event.get('user_id')
+        if not isinstance(user_id, int) or isinstance(user_id, bool):
+            raise ValueError("'user_id' must be an integer")
+        if event.get('tier') not in PAID_TIERS:
+            raise ValueError(f"'tier' must be one of {', '.join(PAID_TIERS)}")
+        days = event.get('duration_days')
+        if days is not None and (not isinstance(days, int) or isinstance(days, bool) or days <= 0):
+            raise ValueError("'duration_days' must be a positive integer")
+    return event
+
+def record_event(event: dict) -> bool:
+    """Stores an event exactly once, keyed by its id. Returns False for duplicates."""
+    with bot_commands.get_db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO payment_events (event_id, provider, event_type, user_id, tier, duration_days, payload, status)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (event_id) DO NOTHING
+                RETURNING event_id
+                """,
+                (
+                    str(event['id']), event.get('provider', 'unknown'), event['type'], event.get('user_id'),
+                    event.get('tier'), event.get('duration_days'), Json(event),
+                    'pending' if event['type'] in UPGRADE_EVENT_TYPES else 'ignored'
+                )
+            )
+            created = cur.fetchone() is not None
+        conn.commit()
+    return created
+
+async def _respond(writer: asyncio.StreamWriter, status: int, payload: dict) -> None:
+    reasons = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found", 413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+    body = json.dumps(payload).encode()
+    writer.write(
+        f"HTTP/1.1 {status} {reasons.get(status, 'Error')}\r\n"
+        f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+
+async def _read_request(reader: asyncio.StreamReader) -> Tuple[str, str, Dict[str, str], bytes]:
+    request_line = (await reader.readline()).decode('latin-1').strip()
+    method, path, _ = request_line.split(' ', 2)
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1').strip()
+        if not line:
+            break
+        key, _, value = line.partition(':')
+        headers[key.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', '0'))
+    if length > MAX_BODY_BYTES:
+        raise OverflowError(length)
+    body = await reader.readexactly(length) if length else b""
+    return method, path, headers, body
+
+async def _handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        try:
+            method, path, headers, body = await asyncio.wait_for(_read_request(reader), HEADER_TIMEOUT_SECONDS)
+        except OverflowError:
+            await _respond(writer, 413, {"error": "payload too large"})
+            return
+        except (ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            await _respond(writer, 400, {"error": "malformed request"})
+            return
+
+        if method != "POST" or path.split('?', 1)[0] != WEBHOOK_PATH:
+            await _respond(writer, 404, {"error": "not found"})
+            return
+        if not verify_signature(body, headers.get('x-signature'), WEBHOOK_SECRET):
+            logger.warning("Rejected payment webhook with an invalid signature")
+            await _respond(writer, 401, {"error": "invalid signature"})
+            return
+        try:
+            event = parse_event(body)
+        except ValueError as e:
+            await _respond(writer, 400, {"error": str(e)})
+            return
+
+        try:
+            created = await asyncio.to_thread(record_event, event)
+        except Exception as e:
+            logger.error("Failed to record payment event %s: %s", event.get('id'), e)
+            # A non-2xx reply makes the provider retry later.
+            await _respond(writer, 500, {"error": "storage failure"})
+            return
+
+        if created and event['type'] in UPGRADE_EVENT_TYPES:
+            try:
+                _queue.put_nowait(str(event['id']))
+            except asyncio.QueueFull:
+                # The event is stored as pending and will be picked up on the next recovery pass.
+                logger.warning("Payment queue full; event %s deferred", event['id'])
+        await _respond(writer, 200, {"status": "accepted" if created else "duplicate"})
+    except Exception as e:
+        logger.error("Unexpected error in payment webhook: %s", e)
+    finally:
+        writer.close()
+
+# === Processing ===
+def process_batch(event_ids: List[str]) -> List[Tuple[int, str, Optional[int]]]:
+    """Applies a batch of pending upgrade events in one transaction.
+
+    Rows already processed or locked by another worker are skipped, so an event
+    can never be applied twice; the user's confirmation is queued in the outbox in the
+    same transaction. Returns (user_id, tier, duration_days) of applied upgrades.
+    """
+    applied = []
+    with bot_commands.get_db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT event_id, provider, user_id, tier, duration_days FROM payment_events
+                WHERE event_id = ANY(%s) AND processed_at IS NULL
+                ORDER BY received_at
+                FOR UPDATE SKIP LOCKED
+                """,
+                (event_ids,)
+            )
+            events = cur.fetchall()
+            outcomes: Dict[str, List[str]] = {}
+            for event in events:
+                source = f"{(event['provider'] or 'unknown').title()} Payment"
+                if bot_commands.apply_upgrade(cur, event['user_id'], event['tier'], source, event['duration_days']):
+                    applied.append((event['user_id'], event['tier'], event['duration_days']))
+                    days = event['duration_days']
+                    outbox.enqueue(
+                        cur, event['user_id'],
+                        f"✅ Payment received! Your plan is now {event['tier']}."
+                        f"{f' It is valid for {days} days.' if days else ''}"
+                    )
+                    outcomes.setdefault('applied', []).append(event['event_id'])
+                else:
+                    logger.warning("Payment event %s references unknown user %s", event['event_id'], event['user_id'])
+                    outcomes.setdefault('unknown_user', []).append(event['event_id'])
+            for status, ids in outcomes.items():
+                cur.execute(
+                    "UPDATE payment_events SET status = %s, processed_at = CURRENT_TIMESTAMP WHERE event_id = ANY(%s)",
+                    (status, ids)
+                )
+        conn.commit()
+    return applied
+
+def pending_event_ids() -> List[str]:
+    """Returns events recorded but never processed (e.g. after a crash)."""
+    with bot_commands.get_db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT event_id FROM payment_events WHERE processed_at IS NULL AND status = 'pending' ORDER BY received_at LIMIT %s",
+                (QUEUE_SIZE,)
+            )
+            return [row['event_id'] for row in cur.fetchall()]
+
+async def _requeue_pending() -> None:
+    for event_id in await asyncio.to_thread(pending_event_ids):
+        if _queue.full():
+            break
+        _queue.put_nowait(event_id)
+
+async def _work() -> None:
+    while True:
+        try:
+            batch = [await asyncio.wait_for(_queue.get(), RECOVERY_INTERVAL_SECONDS)]
+        except asyncio.TimeoutError:
+            # Idle: sweep up events deferred by a full queue or a failed batch.
+            try:
+                await _requeue_pending()
+            except Exception as e:
+                logger.error("Payment recovery pass failed: %s", e)
+            continue
+        while len(batch) < BATCH_SIZE and not _queue.empty():
+            batch.append(_queue.get_nowait())
+        try:
+            applied = await asyncio.to_thread(process_batch, batch)
+        except Exception as e:
+            logger.error("Failed to process payment batch of %s: %s", len(batch), e)
+            # Left pending in the database; retried by the next recovery pass.
+            await asyncio.sleep(5)
+            continue
+        if applied:
+            logger.info("Applied %s payment upgrade(s).", len(applied))
+            outbox.wake()
+
+async def _open() -> None:
+    """Binds the endpoint and starts the worker; a failed bind disables the endpoint."""
+    global _queue, _server, _worker
+    if _server:
+        return
+    try:
+        _server = await asyncio.start_server(_handle_connection, WEBHOOK_HOST, WEBHOOK_PORT)
+    except OSError as e:
+        logger.error("Payment webhook could not listen on %s:%s, endpoint disabled: %s", WEBHOOK_HOST, WEBHOOK_PORT, e)
+        return
+    _queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    try:
+        await _requeue_pending()
+    except Exception as e:
+        # The worker's recovery pass picks these up once the database answers.
+        logger.error("Failed to requeue pending payment events: %s", e)
+    _worker = asyncio.create_task(_work())
+    logger.info("Payment webhook listening on http://%s:%s%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+
+async def _close() -> None:
+    global _queue, _server, _worker
+    if _server:
+        _server.close()
+        await _server.wait_closed()
+        _server = None
+    if _worker:
+        _worker.cancel()
+        _worker = None
+    _queue = None
+
+async def _sync_endpoint(owned: bool) -> None:
+    if owned and not _server:
+        await _open()
+    elif not owned and _server:
+        await _close()
+        logger.info("Instance %s handed off the payment webhook.", cluster.INSTANCE_ID)
+
+if WEBHOOK_SECRET:
+    cluster.register_job(WEBHOOK_JOB, _sync_endpoint)
+
+async def start(app) -> None:
+    """Starts the webhook endpoint and the upgrade worker (requires PAYMENT_WEBHOOK_SECRET).
+
+    In cluster mode the endpoint follows the payment_webhook job lease instead.
+    """
+    if not WEBHOOK_SECRET:
+        logger.info("PAYMENT_WEBHOOK_SECRET not set; payment webhook disabled.")
+        return
+    if not cluster.CLUSTER_MODE:
+        await _open()
+
+async def stop(app) -> None:
+    """Stops accepting webhooks and stops the worker; unprocessed events stay pending."""
+    await _close()
+
+# === Local Stand-in ===
+def post_fake_event(user_id: int, tier: str, duration_days: Optional[int] = None, event_id: Optional[str] = None) -> str:
+    """Posts a signed fake payment event to the local endpoint and returns the response body."""
+    event = {
+        "id": event_id or f"evt_local_{int(time.time() * 1000)}",
+        "type": "payment.succeeded",
+        "provider": "local",
+        "user_id": user_id,
+        "tier": tier,
+        "duration_days": duration_days,
+    }
+    body = json.dumps(event).encode()
+    request = urllib.request.Request(
+        f"http://{WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}",
+        data=body,
+        headers={"Content-Type": "application/json", "X-Signature": sign(body, int(time.time()), WEBHOOK_SECRET)},
+        method="POST",
+    )
+    with urllib.request.urlopen(request) as response:
+        return response.read().decode()
+
+if __name__ == '__main__':
+    # Usage: python payment_webhook.py <user_id> <tier> [days] [event_id]
+    if len(sys.argv) < 3 or not WEBHOOK_SECRET:
+        print("Usage: PAYMENT_WEBHOOK_SECRET=... python payment_webhook.py <user_id> <tier> [days] [event_id]")
+        sys.exit(1)
+    print(post_fake_event(
+        int(sys.argv[1]), sys.argv[2],
+        int(sys.argv[3]) if len(sys.argv) > 3 else None,
+        sys.argv[4] if len(sys.argv) > 4 else None,
+    ))
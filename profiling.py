@@ -0,0 +1,228 @@
+# profiling.py
+import io
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# === Constants ===
+SAMPLE_INTERVAL_SECONDS = 0.005
+MAX_PROFILE_SECONDS = 300
+MAX_STACK_DEPTH = 64
+LAG_PROBE_SECONDS = 0.05
+TASK_DUMP_LAG_WINDOW_SECONDS = 1.0
+TRACEMALLOC_FRAMES = 10
+TOP_ENTRIES = 30
+
+# Nothing below runs, and no hooks are installed, until an admin starts a profile or a memory trace.
+_stop_requested: Optional[asyncio.Event] = None
+_last_snapshot: Optional[tracemalloc.Snapshot] = None
+
+# === Sampling CPU Profiler ===
+class _Sampler(threading.Thread):
+    """Background thread that periodically records the stack of every other thread."""
+
+    def __init__(self, interval: float):
+        super().__init__(name="profiler-sampler", daemon=True)
+        self.interval = interval
+        self.halt = threading.Event()
+        self.samples = 0
+        self.own = Counter()         # innermost frame -> samples
+        self.cumulative = Counter()  # any frame on the stack -> samples
+        self.stacks = Counter()      # collapsed root;...;leaf stack -> samples (flame graph input)
+        self.threads = Counter()     # thread name -> samples
+
+    def run(self) -> None:
+        while not self.halt.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.ident:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                    frame = frame.f_back
+                if not stack:
+                    continue
+                stack.reverse()
+                self.own[stack[-1]] += 1
+                for entry in set(stack):
+                    self.cumulative[entry] += 1
+                self.stacks[";".join(stack)] += 1
+                self.threads[names.get(thread_id, str(thread_id))] += 1
+            self.samples += 1
+
+async def _measure_lag(halt: asyncio.Event, lags: List[float]) -> None:
+    loop = asyncio.get_running_loop()
+    while not halt.is_set():
+        started = loop.time()
+        await asyncio.sleep(LAG_PROBE_SECONDS)
+        lags.append(max(0.0, loop.time() - started - LAG_PROBE_SECONDS))
+
+def _lag_summary(lags: List[float]) -> str:
+    if not lags:
+        return "Event-loop lag: no samples\n"
+    ordered = sorted(lags)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    return (
+        f"Event-loop lag ({len(lags)} probes every {LAG_PROBE_SECONDS * 1000:.0f} ms): "
+        f"avg {sum(lags) / len(lags) * 1000:.1f} ms, p95 {p95 * 1000:.1f} ms, max {ordered[-1] * 1000:.1f} ms\n"
+    )
+
+def _table(title: str, counter: Counter, total: int) -> str:
+    text = f"\n== {title} ==\n"
+    for entry, count in counter.most_common(TOP_ENTRIES):
+        text += f"{count / total * 100:6.1f}%  {count:7d}  {entry}\n"
+    return text
+
+def is_profiling() -> bool:
+    """True while a CPU profile is running."""
+    return _stop_requested is not None
+
+async def run_profile(seconds: int) -> str:
+    """Samples all threads for up to `seconds` (or until stopped) and returns a text report.
+
+    Raises RuntimeError if a profile is already running.
+    """
+    global _stop_requested
+    if _stop_requested is not None:
+        raise RuntimeError("A profile is already running")
+    seconds = max(1, min(seconds, MAX_PROFILE_SECONDS))
+    _stop_requested = asyncio.Event()
+    sampler = _Sampler(SAMPLE_INTERVAL_SECONDS)
+    lags: List[float] = []
+    lag_halt = asyncio.Event()
+    started = time.monotonic()
+    sampler.start()
+    lag_task = asyncio.create_task(_measure_lag(lag_halt, lags))
+    logger.info("CPU profile started for up to %ss", seconds)
+    try:
+        await asyncio.wait_for(_stop_requested.wait(), seconds)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        sampler.halt.set()
+        lag_halt.set()
+        await asyncio.to_thread(sampler.join)
+        await lag_task
+        _stop_requested = None
+    elapsed = time.monotonic() - started
+    logger.info("CPU profile finished after %.1fs with %s samples", elapsed, sampler.samples)
+
+    total = max(1, sum(sampler.threads.values()))
+    report = (
+        f"CPU profile taken {datetime.utcnow():%Y-%m-%d %H:%M:%S} UTC, pid {os.getpid()}\n"
+        f"Duration {elapsed:.1f}s, {sampler.samples} sampling rounds every {SAMPLE_INTERVAL_SECONDS * 1000:.0f} ms, "
+        f"{total} thread stacks\n"
+    )
+    report += _lag_summary(lags)
+    report += _table("Samples per thread", sampler.threads, total)
+    report += _table("Own time (innermost frame)", sampler.own, total)
+    report += _table("Cumulative time (frame anywhere on stack)", sampler.cumulative, total)
+    report += "\n== Collapsed stacks (flamegraph.pl / speedscope input) ==\n"
+    for stack, count in sampler.stacks.most_common():
+        report += f"{stack} {count}\n"
+    return report
+
+def stop_profile() -> bool:
+    """Ends the running profile early; returns False if none is running."""
+    if _stop_requested is None:
+        return False
+    _stop_requested.set()
+    return True
+
+# === Memory ===
+def memory_snapshot() -> Tuple[bool, str]:
+    """Takes a tracemalloc snapshot, starting tracing on first use.
+
+    Returns (report ready, text): the first call only starts tracing; later calls
+    report the top allocation sites and the difference since the previous snapshot.
+    """
+    global _last_snapshot
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        _last_snapshot = tracemalloc.take_snapshot()
+        logger.info("tracemalloc tracing started")
+        return False, "🧠 Memory tracing started. Take another snapshot later to see top allocations and growth."
+
+    filters = [
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<unknown>"),
+    ]
+    snapshot = tracemalloc.take_snapshot().filter_traces(filters)
+    current, peak = tracemalloc.get_traced_memory()
+    report = (
+        f"Memory snapshot taken {datetime.utcnow():%Y-%m-%d %H:%M:%S} UTC, pid {os.getpid()}\n"
+        f"Traced memory: current {current / 1024 / 1024:.1f} MiB, peak {peak / 1024 / 1024:.1f} MiB\n"
+    )
+    report += "\n== Top allocation sites ==\n"
+    for stat in snapshot.statistics('lineno')[:TOP_ENTRIES]:
+        report += f"{stat.size / 1024:10.1f} KiB  {stat.count:8d} blocks  {stat.traceback}\n"
+    if _last_snapshot is not None:
+        report += "\n== Growth since previous snapshot ==\n"
+        for stat in snapshot.compare_to(_last_snapshot.filter_traces(filters), 'lineno')[:TOP_ENTRIES]:
+            report += f"{stat.size_diff / 1024:+10.1f} KiB  {stat.count_diff:+8d} blocks  {stat.traceback}\n"
+        biggest = snapshot.statistics('traceback')[:3]
+        report += "\n== Tracebacks of the three largest sites ==\n"
+        for stat in biggest:
+            report += f"\n{stat.size / 1024:.1f} KiB in {stat.count} blocks\n"
+            report += "\n".join(stat.traceback.format()) + "\n"
+    _last_snapshot = snapshot
+    return True, report
+
+def stop_memory_tracing() -> bool:
+    """Stops tracemalloc and drops the stored snapshot; returns False if it was not running."""
+    global _last_snapshot
+    _last_snapshot = None
+    if not tracemalloc.is_tracing():
+        return False
+    tracemalloc.stop()
+    logger.info("tracemalloc tracing stopped")
+    return True
+
+# === Tasks ===
+async def task_dump() -> str:
+    """Returns every asyncio task with its current stack, plus a short event-loop lag measurement."""
+    lags: List[float] = []
+    halt = asyncio.Event()
+    probe = asyncio.create_task(_measure_lag(halt, lags))
+    await asyncio.sleep(TASK_DUMP_LAG_WINDOW_SECONDS)
+    halt.set()
+    await probe
+
+    tasks = sorted(asyncio.all_tasks(), key=lambda t: t.get_name())
+    report = (
+        f"Task dump taken {datetime.utcnow():%Y-%m-%d %H:%M:%S} UTC, pid {os.getpid()}\n"
+        f"{len(tasks)} tasks, {threading.active_count()} threads\n"
+    )
+    report += _lag_summary(lags)
+    by_coro = Counter(getattr(t.get_coro(), '__qualname__', repr(t.get_coro())) for t in tasks)
+    report += _table("Tasks per coroutine", by_coro, max(1, len(tasks)))
+    for task in tasks:
+        state = "done" if task.done() else "pending"
+        report += f"\n== {task.get_name()} ({state}) ==\n"
+        buffer = io.StringIO()
+        task.print_stack(limit=MAX_STACK_DEPTH, file=buffer)
+        report += buffer.getvalue()
+    report += "\n== Thread stacks ==\n"
+    names = {t.ident: t.name for t in threading.enumerate()}
+    for thread_id, frame in sys._current_frames().items():
+        report += f"\n-- {names.get(thread_id, thread_id)} --\n"
+        report += "".join(traceback.format_stack(frame, limit=MAX_STACK_DEPTH))
+    return report
+
+def report_file(kind: str, report: str) -> Tuple[io.BytesIO, str]:
+    """Wraps a report as an in-memory document and its filename for reply_document."""
+    filename = f"{kind}_{datetime.utcnow():%Y%m%d_%H%M%S}_{os.getpid()}.txt"
+    return io.BytesIO(report.encode("utf-8")), filename
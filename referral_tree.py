@@ -0,0 +1,197 @@
+# referral_tree.py
+import time
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+import bot_commands
+import cluster
+import storage
+import outbox
+
+logger = logging.getLogger(__name__)
+
+# === Constants ===
+RECONCILE_JOB = "referral_tree"
+RECONCILE_INTERVAL_SECONDS = 6 * 3600
+OWNERSHIP_CHECK_SECONDS = 60
+# Paths deeper than this are not tracked, which bounds the rows written per signup.
+MAX_DEPTH = 10
+# Depth shown in /refer and the admin view; direct (depth 1) bonuses stay in start_commands.
+REPORTED_DEPTH = 3
+TOP_SUBTREES = 10
+# depth -> {downline size at that depth: (tier, days, message)}; VIP ancestors are never downgraded.
+LEVEL_REWARDS: Dict[int, Dict[int, Tuple[str, int, str]]] = {
+    2: {10: ('Pro', 14, "🌱 Your network reached 10 second-level referrals! You've earned 14 days of Pro.")},
+    3: {25: ('Pro', 30, "🌳 Your network reached 25 third-level referrals! You've earned 30 days of Pro.")},
+}
+
+_task: Optional[asyncio.Task] = None
+
+cluster.register_job(RECONCILE_JOB)
+
+# === Maintenance ===
+def record_referral(cur, referrer_id: int, referred_id: int) -> List[dict]:
+    """Adds a new user's paths and downline counts inside the caller's transaction.
+
+    The new user has no referrals yet, so its paths are the referrer plus the
+    referrer's own ancestors, one level further away. Level milestone rewards
+    (LEVEL_REWARDS) are granted and their notifications queued in the same
+    transaction.
+
+    Returns:
+        The updated downline rows ({'user_id', 'depth', 'members'}) of every ancestor
+    """
+    cur.execute("""
+        INSERT INTO referral_paths (ancestor_id, descendant_id, depth)
+        SELECT %s, %s, 1
+        UNION ALL
+        SELECT ancestor_id, %s, depth + 1 FROM referral_paths
+        WHERE descendant_id = %s AND depth < %s
+    """, (referrer_id, referred_id, referred_id, referrer_id, MAX_DEPTH))
+    # Ordered so concurrent signups lock shared ancestors' rows in the same order.
+    cur.execute("""
+        INSERT INTO referral_downline (user_id, depth, members)
+        SELECT ancestor_id, depth, 1 FROM referral_paths
+        WHERE descendant_id = %s
+        ORDER BY ancestor_id
+        ON CONFLICT (user_id, depth) DO UPDATE SET members = referral_downline.members + 1
+        RETURNING user_id, depth, members
+    """, (referred_id,))
+    rows = cur.fetchall()
+
+    for row in rows:
+        reward = LEVEL_REWARDS.get(row['depth'], {}).get(row['members'])
+        if not reward:
+            continue
+        tier, days, message = reward
+        cur.execute("SELECT tier FROM users WHERE user_id = %s", (row['user_id'],))
+        ancestor = cur.fetchone()
+        if ancestor and ancestor['tier'] != 'VIP':
+            bot_commands.apply_upgrade(cur, row['user_id'], tier, 'Referral Bonus', expiry_days=days)
+            outbox.enqueue(cur, row['user_id'], message)
+    return rows
+
+def rebuild() -> int:
+    """Rebuilds the closure and downline tables from `referrals` in bulk.
+
+    Returns:
+        The number of paths written
+    """
+    with bot_commands.get_db_conn() as conn:
+        with conn.cursor() as cur:
+            if not storage.is_sqlite():
+                # Holds off new referrals until the rebuilt tables commit; SQLite already has a single writer.
+                cur.execute("LOCK TABLE referrals IN SHARE ROW EXCLUSIVE MODE")
+            cur.execute("DELETE FROM referral_downline")
+            cur.execute("DELETE FROM referral_paths")
+            cur.execute("""
+                INSERT INTO referral_paths (ancestor_id, descendant_id, depth)
+                WITH RECURSIVE tree (ancestor_id, descendant_id, depth) AS (
+                    SELECT referrer_id, referred_id, 1 FROM referrals
+                    UNION ALL
+                    SELECT t.ancestor_id, r.referred_id, t.depth + 1
+                    FROM tree t JOIN referrals r ON r.referrer_id = t.descendant_id
+                    WHERE t.depth < %s
+                )
+                SELECT ancestor_id, descendant_id, MIN(depth) FROM tree
+                WHERE ancestor_id <> descendant_id
+                GROUP BY ancestor_id, descendant_id
+            """, (MAX_DEPTH,))
+            paths = cur.rowcount
+            cur.execute("""
+                INSERT INTO referral_downline (user_id, depth, members)
+                SELECT ancestor_id, depth, COUNT(*) FROM referral_paths
+                GROUP BY ancestor_id, depth
+            """)
+        conn.commit()
+    return paths
+
+def reconcile(force: bool = False) -> Optional[int]:
+    """Rebuilds the tree if it has drifted from `referrals` (or always, when forced).
+
+    Returns:
+        The number of paths written, or None if the tree was consistent
+    """
+    if not force:
+        with bot_commands.get_db_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT (SELECT COUNT(*) FROM referrals) AS referrals,
+                           (SELECT COUNT(*) FROM referral_paths WHERE depth = 1) AS direct,
+                           (SELECT COUNT(*) FROM referral_paths) AS paths,
+                           (SELECT COALESCE(SUM(members), 0) FROM referral_downline) AS members
+                """)
+                counts = cur.fetchone()
+        if counts['referrals'] == counts['direct'] and counts['paths'] == counts['members']:
+            return None
+        logger.warning("Referral tree drifted from referrals, rebuilding: %s", dict(counts))
+    return rebuild()
+
+async def _run() -> None:
+    last_run = None
+    while True:
+        due = last_run is None or time.monotonic() - last_run >= RECONCILE_INTERVAL_SECONDS
+        if due and cluster.owns_job(RECONCILE_JOB):
+            last_run = time.monotonic()
+            try:
+                paths = await asyncio.to_thread(reconcile)
+                if paths is not None:
+                    logger.info("Referral tree rebuilt with %s paths.", paths)
+            except Exception as e:
+                logger.error("Referral tree reconciliation failed: %s", e)
+        await asyncio.sleep(OWNERSHIP_CHECK_SECONDS)
+
+async def start(app) -> None:
+    """Starts the periodic reconciliation job; the first run backfills an empty tree."""
+    global _task
+    _task = asyncio.create_task(_run())
+
+async def stop(app) -> None:
+    """Stops the reconciliation job."""
+    global _task
+    if _task:
+        _task.cancel()
+        _task = None
+
+# === Queries ===
+def downline(cur, user_id: int) -> Dict[int, int]:
+    """Returns {depth: members} for a user's downline, one indexed lookup per user."""
+    cur.execute(
+        "SELECT depth, members FROM referral_downline WHERE user_id = %s AND depth <= %s",
+        (user_id, REPORTED_DEPTH)
+    )
+    return {row['depth']: row['members'] for row in cur.fetchall()}
+
+def format_levels(levels: Dict[int, int]) -> str:
+    """Renders downline sizes as 'L1 3 • L2 5 • L3 0'."""
+    return " • ".join(f"L{depth} {levels.get(depth, 0)}" for depth in range(1, REPORTED_DEPTH + 1))
+
+def top_subtrees_report() -> str:
+    """Renders the users with the largest downlines and their per-level sizes."""
+    with bot_commands.get_db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT d.user_id, u.username, SUM(d.members) AS total, MAX(d.depth) AS deepest
+                FROM referral_downline d LEFT JOIN users u ON u.user_id = d.user_id
+                GROUP BY d.user_id, u.username
+                ORDER BY total DESC
+                LIMIT %s
+            """, (TOP_SUBTREES,))
+            top = cur.fetchall()
+            levels: Dict[int, Dict[int, int]] = {}
+            if top:
+                cur.execute(
+                    "SELECT user_id, depth, members FROM referral_downline WHERE user_id IN %s AND depth <= %s",
+                    (tuple(row['user_id'] for row in top), REPORTED_DEPTH)
+                )
+                for row in cur.fetchall():
+                    levels.setdefault(row['user_id'], {})[row['depth']] = row['members']
+
+    if not top:
+        return "🌳 Referral Trees\n\nNo referrals recorded yet."
+    text = f"🌳 Top {len(top)} Referral Trees\n\n"
+    for rank, row in enumerate(top, 1):
+        name = f"@{row['username']}" if row['username'] else str(row['user_id'])
+        text += f"{rank}. {name}: {int(row['total'])} total, {row['deepest']} levels deep\n"
+        text += f"    {format_levels(levels.get(row['user_id'], {}))}\n"
+    return text
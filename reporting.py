@@ -0,0 +1,237 @@
+# reporting.py
+import time
+import asyncio
+import logging
+from datetime import date, timedelta
+from typing import Optional
+import bot_commands
+import cluster
+import storage
+
+logger = logging.getLogger(__name__)
+
+# === Constants ===
+ROLLUP_JOB = "reporting"
+ROLLUP_INTERVAL_SECONDS = 3600
+OWNERSHIP_CHECK_SECONDS = 60
+# Matches the Pro Trial length granted in start_commands.start_with_ref.
+TRIAL_DAYS = 3
+CONVERTED_TIERS = ('Pro', 'VIP')
+# Upgrades from these sources are free; everything else is treated as a payment.
+FREE_SOURCES = ('Referral Bonus', 'Admin Upgrade')
+PLAN_PRICES = {'Pro': 9.99, 'VIP': 49.99}
+REPORT_DAYS = 30
+COHORT_WEEKS = 8
+SQLITE_UNSUPPORTED_TEXT = "ℹ️ Reports are built from PostgreSQL rollups and are not available on the SQLite engine."
+
+_task: Optional[asyncio.Task] = None
+
+cluster.register_job(ROLLUP_JOB)
+
+# === Rollup ===
+def run_rollup() -> date:
+    """Incrementally refreshes the daily summary and cohort tables.
+
+    Only days from the stored watermark onwards (and the cohorts whose trial
+    window overlaps them) are recomputed, so each run touches a bounded slice
+    of the ledger no matter how large it grows.
+
+    Returns:
+        The first day that was recomputed
+    """
+    with bot_commands.get_db_conn() as conn:
+        with conn.cursor() as cur:
+            # Serializes concurrent rollups (e.g. during a lease handoff).
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext('report_rollup'))")
+            cur.execute("SELECT watermark FROM report_state WHERE name = 'daily' FOR UPDATE")
+            row = cur.fetchone()
+            if row:
+                start = row['watermark']
+            else:
+                cur.execute("SELECT COALESCE(MIN(created_at)::date, CURRENT_DATE) AS first_day FROM users")
+                start = cur.fetchone()['first_day']
+            cohort_start = start - timedelta(days=TRIAL_DAYS)
+            trial = TRIAL_DAYS
+
+            cur.execute("DELETE FROM report_daily WHERE day >= %s", (start,))
+            cur.execute("""
+                INSERT INTO report_daily (day, metric, dimension, value)
+                SELECT created_at::date, 'signups', '', COUNT(*)
+                FROM users WHERE created_at >= %s
+                GROUP BY 1
+            """, (start,))
+            cur.execute("""
+                INSERT INTO report_daily (day, metric, dimension, value)
+                SELECT upgraded_at::date, 'upgrades', COALESCE(source, ''), COUNT(*)
+                FROM upgrades WHERE upgraded_at >= %s
+                GROUP BY 1, 3
+            """, (start,))
+            cur.execute("""
+                INSERT INTO report_daily (day, metric, dimension, value)
+                SELECT upgraded_at::date, 'paid_upgrades', COALESCE(tier, ''), COUNT(*)
+                FROM upgrades
+                WHERE upgraded_at >= %s AND COALESCE(source, '') NOT IN %s AND tier <> 'Free'
+                GROUP BY 1, 3
+            """, (start, FREE_SOURCES))
+            # A trial conversion is a user's first Pro/VIP upgrade inside their trial window.
+            cur.execute("""
+                WITH firsts AS (
+                    SELECT u.user_id, MIN(g.upgraded_at) AS first_at
+                    FROM users u
+                    JOIN upgrades g ON g.user_id = u.user_id
+                        AND g.tier IN %s
+                        AND g.upgraded_at < u.created_at + make_interval(days => %s)
+                    WHERE u.created_at >= %s
+                    GROUP BY u.user_id
+                )
+                INSERT INTO report_daily (day, metric, dimension, value)
+                SELECT first_at::date, 'trial_conversions', '', COUNT(*)
+                FROM firsts WHERE first_at >= %s
+                GROUP BY 1
+            """, (CONVERTED_TIERS, trial, cohort_start, start))
+            cur.execute("""
+                INSERT INTO report_daily (day, metric, dimension, value)
+                SELECT (u.created_at + make_interval(days => %s))::date, 'churn', 'trial_expired', COUNT(*)
+                FROM users u
+                WHERE u.created_at + make_interval(days => %s) >= %s
+                  AND u.created_at + make_interval(days => %s) <= CURRENT_TIMESTAMP
+                  AND NOT EXISTS (
+                      SELECT 1 FROM upgrades g
+                      WHERE g.user_id = u.user_id AND g.tier IN %s
+                        AND g.upgraded_at < u.created_at + make_interval(days => %s)
+                  )
+                GROUP BY 1
+            """, (trial, trial, start, trial, CONVERTED_TIERS, trial))
+            cur.execute("""
+                INSERT INTO report_daily (day, metric, dimension, value)
+                SELECT upgraded_at::date, 'churn', 'downgrade', COUNT(*)
+                FROM upgrades WHERE upgraded_at >= %s AND tier = 'Free'
+                GROUP BY 1
+            """, (start,))
+
+            cur.execute("DELETE FROM report_cohorts WHERE cohort_day >= %s", (cohort_start,))
+            cur.execute("""
+                INSERT INTO report_cohorts (cohort_day, signups, converted, churned)
+                SELECT cohort_day, COUNT(*),
+                       COUNT(*) FILTER (WHERE converted),
+                       COUNT(*) FILTER (WHERE NOT converted AND trial_end <= CURRENT_TIMESTAMP)
+                FROM (
+                    SELECT u.created_at::date AS cohort_day,
+                           u.created_at + make_interval(days => %s) AS trial_end,
+                           EXISTS (
+                               SELECT 1 FROM upgrades g
+                               WHERE g.user_id = u.user_id AND g.tier IN %s
+                                 AND g.upgraded_at < u.created_at + make_interval(days => %s)
+                           ) AS converted
+                    FROM users u WHERE u.created_at >= %s
+                ) per_user
+                GROUP BY cohort_day
+            """, (trial, CONVERTED_TIERS, trial, cohort_start))
+
+            # Today is still in progress, so the next run starts from it again.
+            cur.execute("""
+                INSERT INTO report_state (name, watermark) VALUES ('daily', CURRENT_DATE)
+                ON CONFLICT (name) DO UPDATE SET watermark = EXCLUDED.watermark
+            """)
+        conn.commit()
+    return start
+
+async def _run() -> None:
+    last_run = None
+    while True:
+        # Ownership is re-checked often so a lease handoff does not delay the next rollup by an hour.
+        due = last_run is None or time.monotonic() - last_run >= ROLLUP_INTERVAL_SECONDS
+        if due and cluster.owns_job(ROLLUP_JOB):
+            last_run = time.monotonic()
+            try:
+                start = await asyncio.to_thread(run_rollup)
+                logger.info("Reporting rollup refreshed from %s.", start)
+            except Exception as e:
+                logger.error("Reporting rollup failed: %s", e)
+        await asyncio.sleep(OWNERSHIP_CHECK_SECONDS)
+
+async def start(app) -> None:
+    """Starts the periodic rollup job (PostgreSQL only)."""
+    global _task
+    if storage.is_sqlite():
+        logger.info("Reporting rollups require PostgreSQL; disabled on the SQLite engine.")
+        return
+    _task = asyncio.create_task(_run())
+
+async def stop(app) -> None:
+    """Stops the periodic rollup job."""
+    global _task
+    if _task:
+        _task.cancel()
+        _task = None
+
+# === Reports ===
+def revenue_report() -> str:
+    """Renders signups, upgrades by source, conversions, churn and estimated revenue from the rollups."""
+    if storage.is_sqlite():
+        return SQLITE_UNSUPPORTED_TEXT
+    with bot_commands.get_db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT metric, dimension, SUM(value) AS total
+                FROM report_daily WHERE day > CURRENT_DATE - %s
+                GROUP BY metric, dimension
+                ORDER BY metric, total DESC
+            """, (REPORT_DAYS,))
+            rows = cur.fetchall()
+            cur.execute("SELECT watermark FROM report_state WHERE name = 'daily'")
+            state = cur.fetchone()
+
+    totals = {}
+    for row in rows:
+        totals.setdefault(row['metric'], {})[row['dimension']] = int(row['total'])
+
+    signups = sum(totals.get('signups', {}).values())
+    conversions = sum(totals.get('trial_conversions', {}).values())
+    paid = totals.get('paid_upgrades', {})
+    revenue = sum(PLAN_PRICES.get(tier, 0) * count for tier, count in paid.items())
+    churn = totals.get('churn', {})
+
+    text = f"💵 Revenue Report (last {REPORT_DAYS} days)\n\n"
+    text += f"👥 Signups: {signups}\n"
+    text += f"🔁 Trial conversions: {conversions}"
+    text += f" ({conversions / signups:.1%})\n" if signups else "\n"
+    text += "🚀 Upgrades by source:\n"
+    for source, count in totals.get('upgrades', {}).items():
+        text += f"  - {source or 'Unknown'}: {count}\n"
+    if not totals.get('upgrades'):
+        text += "  - None\n"
+    text += "📉 Churn:\n"
+    text += f"  - Trials expired: {churn.get('trial_expired', 0)}\n"
+    text += f"  - Downgrades: {churn.get('downgrade', 0)}\n"
+    text += f"💰 Estimated revenue: ${revenue:,.2f}\n"
+    if state:
+        text += f"\nRollups current through {state['watermark']}."
+    else:
+        text += "\nRollups have not run yet."
+    return text
+
+def cohort_report() -> str:
+    """Renders weekly signup cohorts with their trial conversion and churn rates."""
+    if storage.is_sqlite():
+        return SQLITE_UNSUPPORTED_TEXT
+    with bot_commands.get_db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT date_trunc('week', cohort_day)::date AS week,
+                       SUM(signups) AS signups, SUM(converted) AS converted, SUM(churned) AS churned
+                FROM report_cohorts WHERE cohort_day >= CURRENT_DATE - %s
+                GROUP BY 1 ORDER BY 1 DESC
+            """, (COHORT_WEEKS * 7,))
+            rows = cur.fetchall()
+
+    if not rows:
+        return "👥 Cohort Report\n\nNo cohort data yet."
+    text = f"👥 Cohort Report (last {COHORT_WEEKS} weeks)\n\n"
+    for row in rows:
+        signups = int(row['signups'])
+        converted = int(row['converted'])
+        churned = int(row['churned'])
+        rate = f"{converted / signups:.1%}" if signups else "n/a"
+        text += f"📅 Week of {row['week']}: {signups} signups, {converted} converted ({rate}), {churned} churned\n"
+    return text
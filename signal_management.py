@@ -9,6 +9,9 @@ from telegram.ext import (
 from datetime import datetime, timedelta
 # Import database connection from your main file
 import bot_commands 
+import lifecycle
+import symbol_catalog
+from edit_coalescer import coalescer
 
 logger = logging.getLogger(__name__)
 
@@ -24,7 +27,7 @@ async def handle_signals_menu(update: Update, context: ContextTypes.DEFAULT_TYPE
     await query.answer()
     
     if query.data == "add_new_signal":
-        await query.edit_message_text("Use the /track command to add a new signal.")
+        await coalescer.edit_now(query, "Use the /track command to add a new signal.")
         return
         
     elif query.data == "show_signals_list":
@@ -43,14 +46,14 @@ async def list_and_edit_signals(update: Update, context: ContextTypes.DEFAULT_TY
     signals = await bot_commands.list_user_signals(user_id)
     
     if not signals:
-        await update.callback_query.edit_message_text("You have no signals to edit.")
+        await coalescer.edit_now(update.callback_query, "You have no signals to edit.")
         return ConversationHandler.END
         
     keyboard = [[InlineKeyboardButton(f"🆔 {s[0]} | 📈 {s[1]} | Status: {s[2]}", callback_data=str(s[0]))] for s in signals]
     keyboard.append([InlineKeyboardButton("🔙 Back to menu", callback_data="cancel_edit")])
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await update.callback_query.edit_message_text("Choose a signal to edit:", reply_markup=reply_markup)
+    coalescer.schedule(update.callback_query, "Choose a signal to edit:", reply_markup=reply_markup)
     return EDIT_SIGNAL
 
 async def select_signal_to_edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -66,11 +69,11 @@ async def select_signal_to_edit(update: Update, context: ContextTypes.DEFAULT_TY
         ["target_price_2", "target_price_3", "stop_loss"],
         ["tags", "cancel"]
     ]
-    reply_markup = InlineKeyboardMarkup([
-        [InlineKeyboardButton(text, callback_data=text) for text in row] for row in keyboard
-    ])
+    buttons = [[InlineKeyboardButton(text, callback_data=text) for text in row] for row in keyboard]
+    buttons.append([InlineKeyboardButton("🚫 Cancel this signal", callback_data="cancel_signal")])
+    reply_markup = InlineKeyboardMarkup(buttons)
     
-    await query.edit_message_text(f"⚙️ Which field of signal {signal_id} would you like to edit?", reply_markup=reply_markup)
+    coalescer.schedule(query, f"⚙️ Which field of signal {signal_id} would you like to edit?", reply_markup=reply_markup)
     return EDIT_FIELD
 
 async def select_field_to_edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -82,10 +85,25 @@ async def select_field_to_edit(update: Update, context: ContextTypes.DEFAULT_TYP
     context.user_data['field_to_edit'] = field_to_edit
     
     if field_to_edit == 'cancel':
-        await query.edit_message_text("✅ Edit cancelled.")
+        await coalescer.edit_now(query, "✅ Edit cancelled.")
+        return ConversationHandler.END
+
+    if field_to_edit == 'cancel_signal':
+        signal_id = context.user_data['signal_id']
+        try:
+            cancelled = lifecycle.cancel_signal(update.effective_user.id, signal_id)
+        except Exception as e:
+            logger.error("Failed to cancel signal %s: %s", signal_id, e)
+            await coalescer.edit_now(query, "❌ An error occurred while cancelling the signal.")
+            return ConversationHandler.END
+        if cancelled:
+            await coalescer.edit_now(query, f"🚫 Signal {signal_id} cancelled. It will no longer be tracked.")
+        else:
+            await coalescer.edit_now(query, f"❌ Signal {signal_id} is not active, so it cannot be cancelled.")
+        context.user_data.clear()
         return ConversationHandler.END
         
-    await query.edit_message_text(f"✍️ Please send the new value for '{field_to_edit}'.")
+    await coalescer.edit_now(query, f"✍️ Please send the new value for '{field_to_edit}'.")
     return EDIT_VALUE
 
 async def update_signal_value(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -98,18 +116,27 @@ async def update_signal_value(update: Update, context: ContextTypes.DEFAULT_TYPE
         # Simple validation for numerical fields
         if field_to_edit in ['entry_price', 'target_price_1', 'target_price_2', 'target_price_3', 'stop_loss']:
             new_value = float(new_value)
+        elif field_to_edit == 'symbol':
+            symbol = symbol_catalog.normalize(new_value)
+            if not symbol:
+                await update.message.reply_text(symbol_catalog.unknown_symbol_text(new_value))
+                return ConversationHandler.END
+            new_value = symbol
 
         with bot_commands.get_db_conn() as conn:
             with conn.cursor() as cur:
-                query = f"UPDATE signals SET {field_to_edit} = %s WHERE id = %s"
+                query = f"UPDATE signals SET {field_to_edit} = %s WHERE id = %s RETURNING user_id, symbol, status"
                 cur.execute(query, (new_value, signal_id))
+                row = cur.fetchone()
+                if row:
+                    bot_commands.publish_change(cur, {"k": "sig", "op": "upsert", "id": signal_id, "u": row['user_id'], "s": row['symbol'], "st": row['status']})
             conn.commit()
 
         await update.message.reply_text(f"✅ Successfully updated signal {signal_id}'s {field_to_edit} to '{new_value}'.")
     except ValueError:
         await update.message.reply_text("❌ Invalid input. Please enter a valid number for this field.")
     except Exception as e:
-        logger.error(f"Failed to update signal: {e}")
+        logger.error("Failed to update signal: %s", e)
         await update.message.reply_text("❌ An error occurred while updating the signal.")
     finally:
         context.user_data.clear()
@@ -123,7 +150,7 @@ async def start_delete_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
     signals = await bot_commands.list_user_signals(user_id)
     
     if not signals:
-        await update.callback_query.edit_message_text("You have no signals to delete.")
+        await coalescer.edit_now(update.callback_query, "You have no signals to delete.")
         return ConversationHandler.END
         
     context.user_data['signals_to_delete'] = []
@@ -133,7 +160,7 @@ async def start_delete_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
                      InlineKeyboardButton("❌ Cancel", callback_data="cancel_delete")])
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    await update.callback_query.edit_message_text("Select signals to delete. Use the confirm button when you are done.", reply_markup=reply_markup)
+    coalescer.schedule(update.callback_query, "Select signals to delete. Use the confirm button when you are done.", reply_markup=reply_markup)
     return DELETE_SIGNAL
 
 async def handle_delete_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -152,22 +179,24 @@ async def handle_delete_selection(update: Update, context: ContextTypes.DEFAULT_
         
         selected_ids = context.user_data['signals_to_delete']
         new_text = f"Selected signals for deletion: {selected_ids}\n\nSelect more or confirm."
-        await query.edit_message_text(new_text, reply_markup=query.message.reply_markup)
+        # Rapid toggles are coalesced into a single edit once the user pauses.
+        coalescer.schedule(query, new_text, reply_markup=query.message.reply_markup)
         
     elif data == "confirm_delete":
         await confirm_delete(update, context)
         return ConversationHandler.END
     elif data == "cancel_delete":
-        await query.edit_message_text("✅ Deletion cancelled.")
+        await coalescer.edit_now(query, "✅ Deletion cancelled.")
         return ConversationHandler.END
         
     return DELETE_SIGNAL
 
 async def confirm_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Deletes selected signals from the database."""
+    query = update.callback_query
     signals_to_delete = context.user_data.get('signals_to_delete', [])
     if not signals_to_delete:
-        await update.callback_query.edit_message_text("❌ No signals were selected for deletion.")
+        await coalescer.edit_now(query, "❌ No signals were selected for deletion.")
         return
         
     user_id = update.effective_user.id
@@ -175,13 +204,16 @@ async def confirm_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
         with bot_commands.get_db_conn() as conn:
             with conn.cursor() as cur:
                 # Ensure the user owns the signals before deleting
-                cur.execute("DELETE FROM signals WHERE user_id = %s AND id IN %s", (user_id, tuple(signals_to_delete)))
+                cur.execute("DELETE FROM signals WHERE user_id = %s AND id IN %s RETURNING id", (user_id, tuple(signals_to_delete)))
+                deleted_ids = [row['id'] for row in cur.fetchall()]
+                if deleted_ids:
+                    bot_commands.publish_change(cur, {"k": "sig", "op": "del", "u": user_id, "ids": deleted_ids})
             conn.commit()
         
-        await update.callback_query.edit_message_text(f"✅ Successfully deleted {len(signals_to_delete)} signals.")
+        await coalescer.edit_now(query, f"✅ Successfully deleted {len(signals_to_delete)} signals.")
     except Exception as e:
-        logger.error(f"Failed to delete signals: {e}")
-        await update.callback_query.edit_message_text("❌ An error occurred during deletion.")
+        logger.error("Failed to delete signals: %s", e)
+        await coalescer.edit_now(query, "❌ An error occurred during deletion.")
     finally:
         context.user_data.clear()
         return
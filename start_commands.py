@@ -6,7 +6,11 @@ from datetime import datetime, timedelta
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 import bot_commands
+import statements
+import outbox
+import referral_tree
 import signal_management  # Import the signal_management module
+from edit_coalescer import coalescer
 
 # Configure logging for this module
 logger = logging.getLogger(__name__)
@@ -27,12 +31,12 @@ async def start_with_ref(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             referrer_id = int(args[0])
         except (ValueError, IndexError):
-            logger.warning(f"Invalid referrer ID provided: '{args[0]}'")
+            logger.warning("Invalid referrer ID provided: '%s'", args[0])
 
-    # Use the shared database connection function
+    # The user, the referral, any bonus and the referrer's notifications commit together.
     with bot_commands.get_db_conn() as conn:
         with conn.cursor() as cur:
-            cur.execute("SELECT user_id, tier, trial_expiry FROM users WHERE user_id = %s", (user_id,))
+            statements.execute(cur, "user_lookup", (user_id,))
             user = cur.fetchone()
 
             if not user:
@@ -41,7 +45,7 @@ async def start_with_ref(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     "INSERT INTO users (user_id, username, tier, trial_expiry) VALUES (%s, %s, 'Pro Trial', %s)",
                     (user_id, username, now + timedelta(days=3))
                 )
-                conn.commit()
+                bot_commands.publish_change(cur, {"k": "tier", "u": user_id, "t": "Pro Trial"})
 
                 if referrer_id and referrer_id != user_id:
                     # Check if the referral has already been recorded
@@ -51,28 +55,29 @@ async def start_with_ref(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     if not referral_exists:
                         # Record the referral and update the referrer's count
                         cur.execute("INSERT INTO referrals (referrer_id, referred_id) VALUES (%s, %s)", (referrer_id, user_id))
+                        referral_tree.record_referral(cur, referrer_id, user_id)
                         cur.execute("UPDATE users SET referrals = referrals + 1 WHERE user_id = %s RETURNING referrals, tier", (referrer_id,))
                         ref_info = cur.fetchone()
-                        conn.commit()
 
                         if ref_info:
                             new_count = ref_info['referrals']
                             referrer_tier = ref_info['tier']
-                            
-                            # Send message to referrer
-                            await context.bot.send_message(referrer_id, f"🎉 You received a new referral! You now have {new_count} referrals.")
-                            
+
+                            # Queue the message to the referrer
+                            outbox.enqueue(cur, referrer_id, f"🎉 You received a new referral! You now have {new_count} referrals.")
+
                             # Check for referral tier upgrades
                             if new_count == 3 and referrer_tier not in ['Pro', 'VIP']:
-                                bot_commands.log_upgrade(referrer_id, 'Pro', 'Referral Bonus', expiry_days=30)
-                                await context.bot.send_message(referrer_id, "🎁 Congrats! You've been upgraded to Pro for 1 month!")
+                                bot_commands.apply_upgrade(cur, referrer_id, 'Pro', 'Referral Bonus', expiry_days=30)
+                                outbox.enqueue(cur, referrer_id, "🎁 Congrats! You've been upgraded to Pro for 1 month!")
                             elif new_count == 10 and referrer_tier != 'VIP':
-                                bot_commands.log_upgrade(referrer_id, 'VIP', 'Referral Bonus')
-                                await context.bot.send_message(referrer_id, "🏆 Amazing! You're now a VIP after 10 referrals!")
+                                bot_commands.apply_upgrade(cur, referrer_id, 'VIP', 'Referral Bonus')
+                                outbox.enqueue(cur, referrer_id, "🏆 Amazing! You're now a VIP after 10 referrals!")
             else:
                 # Existing user, just update their username if it's new
                 cur.execute("UPDATE users SET username = %s WHERE user_id = %s", (username, user_id))
-                conn.commit()
+        conn.commit()
+    outbox.wake()
     
     # --- New Welcome Message Logic ---
     welcome_text = (
@@ -103,7 +108,7 @@ async def show_plans_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
     await query.answer()
     
     text = "💰 Plans:\n🔹 Free: Track 1 signal, basic alerts\n🔸 Pro: $9.99/month - Track up to 10 signals, daily stats\n🏆 VIP: $49.99 one-time - Unlimited signals, full analytics"
-    await query.edit_message_text(text)
+    coalescer.schedule(query, text)
     # Note: For full functionality, you should add buttons here
     # to link to the upgrade URLs, similar to the original /upgrade command.
 
@@ -0,0 +1,90 @@
+# startup.py
+import os
+import time
+import asyncio
+import logging
+from contextlib import contextmanager
+from typing import Awaitable, Dict, Optional
+import bot_commands
+import state_cache
+import symbol_catalog
+import user_commands
+
+logger = logging.getLogger(__name__)
+
+# === Constants ===
+WARM_CONNECTIONS = int(os.getenv("DB_POOL_WARM", "4"))
+
+_process_started = time.perf_counter()
+_timings: Dict[str, float] = {}
+_ready_seconds: Optional[float] = None
+_warm_task: Optional[asyncio.Task] = None
+
+# === Phase Timing ===
+def mark_imports_done(imports_started: float) -> None:
+    """Records the time spent importing modules, measured from main.py's first import."""
+    global _process_started
+    _process_started = imports_started
+    _timings['imports'] = time.perf_counter() - imports_started
+
+@contextmanager
+def phase(name: str):
+    """Times a startup phase; the block may await."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _timings[name] = time.perf_counter() - started
+
+def mark_ready() -> None:
+    """Records that update handling can begin; logs time-to-ready."""
+    global _ready_seconds
+    _ready_seconds = time.perf_counter() - _process_started
+    logger.info("Ready to handle updates after %.0f ms (%s).", _ready_seconds * 1000, _format(_timings))
+
+def _format(timings: Dict[str, float]) -> str:
+    return ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in timings.items())
+
+def timings_text() -> str:
+    """Per-phase startup timings for the admin panel."""
+    if _ready_seconds is None:
+        return "⏱ Startup: still starting"
+    text = f"⏱ Startup: ready after {_ready_seconds * 1000:.0f} ms\n"
+    for name, seconds in _timings.items():
+        text += f"  - {name}: {seconds * 1000:.0f} ms\n"
+    if _warm_task is not None and not _warm_task.done():
+        text += "  - warm-up still running\n"
+    return text
+
+# === Warm-up ===
+async def _timed(name: str, step: Awaitable) -> None:
+    started = time.perf_counter()
+    try:
+        await step
+    except Exception as e:
+        logger.error("Startup warm-up step %s failed: %s", name, e)
+    finally:
+        _timings[name] = time.perf_counter() - started
+
+async def _warm_up() -> None:
+    started = time.perf_counter()
+    await asyncio.gather(
+        _timed("warm_pool", asyncio.to_thread(bot_commands.warm_pool, WARM_CONNECTIONS)),
+        _timed("symbol_catalog", symbol_catalog.wait_loaded()),
+        _timed("state_cache", state_cache.wait_loaded()),
+    )
+    # Runs on an already warm connection.
+    await _timed("leaderboard", asyncio.to_thread(user_commands.refresh_leaderboard))
+    logger.info("Startup warm-up finished in %.0f ms (%s).", (time.perf_counter() - started) * 1000, _format(_timings))
+
+async def start(app) -> None:
+    """Starts warming connections and caches in the background."""
+    global _warm_task
+    _warm_task = asyncio.create_task(_warm_up())
+
+async def stop(app) -> None:
+    """Cancels the warm-up if it is still running."""
+    global _warm_task
+    if _warm_task:
+        _warm_task.cancel()
+        _warm_task = None
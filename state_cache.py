@@ -0,0 +1,211 @@
+# state_cache.py
+import json
+import asyncio
+import logging
+from typing import Callable, Dict, List, Optional
+import psycopg2
+import bot_commands
+import storage
+
+logger = logging.getLogger(__name__)
+
+# === Constants ===
+RECONNECT_DELAY_SECONDS = 2
+MAX_RECONNECT_DELAY_SECONDS = 60
+KEEPALIVE_SECONDS = 60
+
+# === Cached State ===
+# All maps are rebuilt wholesale on (re)connect and patched by change events in between.
+_tiers: Dict[int, str] = {}
+# Only users with digest mode on are stored; everyone else has a window of 0.
+_digest_windows: Dict[int, int] = {}
+_ready = False
+_reloading = False
+_buffered: List[dict] = []
+_subscribers: List[Callable[[dict], None]] = []
+_task: Optional[asyncio.Task] = None
+# Set once the first snapshot is in place; startup warm-up waits on it.
+_loaded: Optional[asyncio.Event] = None
+
+# === Read API ===
+def is_ready() -> bool:
+    """True once a full snapshot has been loaded and the listener is running."""
+    return _ready
+
+async def wait_loaded() -> None:
+    """Waits until the first full snapshot has been loaded."""
+    if _loaded is not None:
+        await _loaded.wait()
+
+def get_tier(user_id: int) -> Optional[str]:
+    """Returns the cached tier for a user, or None if unknown or the cache is not ready."""
+    if not _ready:
+        return None
+    return _tiers.get(user_id)
+
+def digest_window(user_id: int) -> int:
+    """Returns the user's alert digest window in seconds (0 = deliver immediately)."""
+    return _digest_windows.get(user_id, 0)
+
+def subscribe(callback: Callable[[dict], None]) -> None:
+    """Registers a callback invoked with every applied change event.
+
+    A synthetic {'k': 'reload'} event is delivered after each full reload.
+    """
+    _subscribers.append(callback)
+
+# === Event Application ===
+def _apply(event: dict) -> None:
+    kind = event.get('k')
+    if kind == 'tier':
+        _tiers[event['u']] = event['t']
+    elif kind == 'digest':
+        if event['w']:
+            _digest_windows[event['u']] = event['w']
+        else:
+            _digest_windows.pop(event['u'], None)
+    elif kind == 'sig':
+        # Not cached here; passed through to subscribers (the lifecycle book).
+        pass
+    else:
+        logger.warning("Ignoring unknown change event: %s", event)
+        return
+
+    for callback in _subscribers:
+        try:
+            callback(event)
+        except Exception as e:
+            logger.error("Change subscriber failed for event %s: %s", event, e)
+
+def _handle_notify(payload: str) -> None:
+    try:
+        event = json.loads(payload)
+    except ValueError:
+        logger.warning("Malformed change notification: %r", payload)
+        return
+    _handle_event(event)
+
+def _handle_event(event: dict) -> None:
+    if _reloading:
+        # Replayed on top of the fresh snapshot once the reload completes.
+        _buffered.append(event)
+    else:
+        _apply(event)
+
+# === Full Reload ===
+def _load_snapshot():
+    with bot_commands.get_db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT user_id, tier, digest_seconds FROM users")
+            tiers, windows = {}, {}
+            for row in cur.fetchall():
+                tiers[row['user_id']] = row['tier']
+                if row['digest_seconds']:
+                    windows[row['user_id']] = row['digest_seconds']
+    return tiers, windows
+
+async def reload() -> None:
+    """Rebuilds the caches from the database, replaying events received meanwhile."""
+    global _tiers, _digest_windows, _ready, _reloading
+    _reloading = True
+    try:
+        tiers, windows = await asyncio.to_thread(_load_snapshot)
+        _tiers, _digest_windows = tiers, windows
+        _ready = True
+        if _loaded is not None:
+            _loaded.set()
+        logger.info("State cache loaded: %s users, %s with digest mode.", len(tiers), len(windows))
+    finally:
+        _reloading = False
+        pending = _buffered[:]
+        _buffered.clear()
+        for event in pending:
+            _apply(event)
+    for callback in _subscribers:
+        try:
+            callback({'k': 'reload'})
+        except Exception as e:
+            logger.error("Change subscriber failed on reload: %s", e)
+
+# === Listener ===
+def _connect_listener():
+    conn = bot_commands.connect_direct()
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    with conn.cursor() as cur:
+        cur.execute(f"LISTEN {bot_commands.CHANGES_CHANNEL}")
+    return conn
+
+async def _listen_once() -> None:
+    """Listens until the connection breaks; raises on failure."""
+    global _ready
+    loop = asyncio.get_running_loop()
+    conn = await asyncio.to_thread(_connect_listener)
+    broken = asyncio.Event()
+
+    def on_readable():
+        try:
+            conn.poll()
+        except psycopg2.Error as e:
+            logger.warning("Change listener connection lost: %s", e)
+            broken.set()
+            return
+        while conn.notifies:
+            _handle_notify(conn.notifies.pop(0).payload)
+
+    loop.add_reader(conn.fileno(), on_readable)
+    try:
+        # LISTEN is already active, so nothing committed after the snapshot is missed.
+        await reload()
+        while not broken.is_set():
+            try:
+                await asyncio.wait_for(broken.wait(), timeout=KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                # Detects half-open TCP connections that would otherwise stay silent forever.
+                await asyncio.to_thread(_keepalive, conn)
+                # Notifications that arrived during the keepalive query are queued on the connection.
+                while conn.notifies:
+                    _handle_notify(conn.notifies.pop(0).payload)
+    finally:
+        _ready = False
+        loop.remove_reader(conn.fileno())
+        conn.close()
+
+def _keepalive(conn) -> None:
+    with conn.cursor() as cur:
+        cur.execute("SELECT 1")
+
+async def _run() -> None:
+    delay = RECONNECT_DELAY_SECONDS
+    while True:
+        try:
+            await _listen_once()
+            delay = RECONNECT_DELAY_SECONDS
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Change listener failed, retrying in %ss: %s", delay, e)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY_SECONDS)
+
+async def start(app) -> None:
+    """Starts the change listener in the background.
+
+    The SQLite engine is single-node, so events come straight from its commits
+    instead of LISTEN; they are applied on the event loop like notifications.
+    Either way the snapshot loads in the background; see wait_loaded().
+    """
+    global _task, _loaded
+    _loaded = asyncio.Event()
+    if storage.is_sqlite():
+        loop = asyncio.get_running_loop()
+        storage.add_commit_listener(lambda event: loop.call_soon_threadsafe(_handle_event, event))
+        _task = asyncio.create_task(reload())
+        return
+    _task = asyncio.create_task(_run())
+
+async def stop(app) -> None:
+    """Stops the change listener."""
+    global _task
+    if _task:
+        _task.cancel()
+        _task = None
@@ -0,0 +1,118 @@
+# statements.py
+import re
+import time
+import logging
+import threading
+from typing import Dict, Sequence
+import psycopg2
+import psycopg2.errors
+
+logger = logging.getLogger(__name__)
+
+# === Statement Registry ===
+class StatementStats:
+    """Call counters and timings for one named statement."""
+
+    __slots__ = ('calls', 'prepares', 'errors', 'total_seconds', 'max_seconds')
+
+    def __init__(self):
+        self.calls = 0
+        self.prepares = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+_registry: Dict[str, tuple] = {}
+_stats: Dict[str, StatementStats] = {}
+_stats_lock = threading.Lock()
+
+def declare(name: str, sql: str) -> None:
+    """Declares a hot query once under a name.
+
+    Args:
+        name: Statement name; must be a valid SQL identifier
+        sql: Query text using psycopg2 `%s` placeholders
+    """
+    if not re.fullmatch(r"[a-z_][a-z0-9_]*", name):
+        raise ValueError(f"Invalid statement name '{name}'")
+    param_count = sql.count('%s')
+    counter = iter(range(1, param_count + 1))
+    server_sql = re.sub(r"%s", lambda _: f"${next(counter)}", sql)
+    _registry[name] = (sql, server_sql, param_count)
+    _stats[name] = StatementStats()
+
+def execute(cur, name: str, params: Sequence = ()) -> None:
+    """Executes a declared statement by name, preparing it on this connection on first use.
+
+    Connections that cannot track prepared statements (e.g. unpooled ones) fall
+    back to sending the plain SQL text.
+    """
+    sql, server_sql, param_count = _registry[name]
+    prepared = getattr(cur.connection, 'prepared', None)
+    started = time.perf_counter()
+    did_prepare = False
+    try:
+        if prepared is None:
+            cur.execute(sql, params)
+        else:
+            if name not in prepared:
+                cur.execute(f"PREPARE {name} AS {server_sql}")
+                prepared.add(name)
+                did_prepare = True
+            placeholders = f" ({', '.join(['%s'] * param_count)})" if param_count else ""
+            cur.execute(f"EXECUTE {name}{placeholders}", params)
+    except psycopg2.Error as e:
+        if prepared is not None and isinstance(e, psycopg2.errors.InvalidSqlStatementName):
+            # The server forgot the statement (e.g. DISCARD ALL); prepare again next time.
+            prepared.discard(name)
+        with _stats_lock:
+            _stats[name].errors += 1
+        raise
+    elapsed = time.perf_counter() - started
+    with _stats_lock:
+        stats = _stats[name]
+        stats.calls += 1
+        stats.prepares += did_prepare
+        stats.total_seconds += elapsed
+        stats.max_seconds = max(stats.max_seconds, elapsed)
+
+def prepare_all(cur) -> int:
+    """Prepares every declared statement not yet prepared on this connection.
+
+    Used to warm pooled connections so the first requests skip the PREPARE
+    round trip. Returns how many statements were prepared.
+    """
+    prepared = getattr(cur.connection, 'prepared', None)
+    if prepared is None:
+        return 0
+    count = 0
+    for name, (_, server_sql, _) in list(_registry.items()):
+        if name in prepared:
+            continue
+        cur.execute(f"PREPARE {name} AS {server_sql}")
+        prepared.add(name)
+        count += 1
+        with _stats_lock:
+            _stats[name].prepares += 1
+    return count
+
+def stats_text() -> str:
+    """Human-readable per-statement call counts and timings for the admin panel."""
+    with _stats_lock:
+        rows = [(name, s.calls, s.prepares, s.errors, s.total_seconds, s.max_seconds) for name, s in _stats.items()]
+    text = "🧮 Prepared Statements:\n"
+    for name, calls, prepares, errors, total, worst in sorted(rows, key=lambda r: r[4], reverse=True):
+        avg_ms = (total / calls * 1000) if calls else 0.0
+        text += f"  - {name}: {calls} calls, avg {avg_ms:.2f} ms, max {worst * 1000:.2f} ms, {prepares} prepares"
+        text += f", {errors} errors\n" if errors else "\n"
+    return text
+
+# === Hot Queries ===
+declare("user_lookup", "SELECT user_id, tier, trial_expiry FROM users WHERE user_id = %s")
+declare("list_user_signals", "SELECT id, symbol, status FROM signals WHERE user_id = %s ORDER BY created_at DESC")
+declare("count_active_signals", "SELECT COUNT(*) FROM signals WHERE user_id = %s AND status IN ('Open', 'T1 Hit', 'T2 Hit')")
+declare(
+    "insert_signal",
+    "INSERT INTO signals (user_id, symbol, entry_price, target_price_1, stop_loss, status, tags) "
+    "VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id"
+)
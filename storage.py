@@ -0,0 +1,358 @@
+# storage.py
+import os
+import re
+import json
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime, timezone
+from typing import Callable, List, Optional, Sequence, Tuple
+import psycopg2
+import psycopg2.extras
+
+logger = logging.getLogger(__name__)
+
+# === Engine Selection ===
+# DATABASE_URL1=sqlite:///path/to/targethawk.db selects the embedded engine; anything else is PostgreSQL.
+DB_URL = os.getenv("DATABASE_URL1") or ""
+SQLITE_PREFIX = "sqlite:///"
+ENGINE = "sqlite" if DB_URL.startswith(SQLITE_PREFIX) else "postgres"
+SQLITE_PATH = DB_URL[len(SQLITE_PREFIX):] if ENGINE == "sqlite" else None
+
+def is_sqlite() -> bool:
+    """True when running on the embedded SQLite engine."""
+    return ENGINE == "sqlite"
+
+# === SQLite Tuning ===
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",       # readers never block the writer
+    "PRAGMA synchronous = NORMAL",     # durable at checkpoints; safe with WAL
+    "PRAGMA foreign_keys = ON",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -32000",      # 32 MiB page cache per connection
+    "PRAGMA mmap_size = 268435456",
+)
+
+# Timestamps are stored as UTC text in CURRENT_TIMESTAMP's format so they compare correctly in SQL.
+def _adapt_datetime(value: datetime) -> str:
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.isoformat(sep=" ")
+
+def _convert_timestamp(value: bytes) -> datetime:
+    parsed = datetime.fromisoformat(value.decode())
+    return parsed.replace(tzinfo=timezone.utc) if parsed.tzinfo is None else parsed
+
+sqlite3.register_adapter(datetime, _adapt_datetime)
+sqlite3.register_adapter(date, lambda value: value.isoformat())
+sqlite3.register_adapter(psycopg2.extras.Json, lambda value: json.dumps(value.adapted))
+sqlite3.register_converter("TIMESTAMP", _convert_timestamp)
+sqlite3.register_converter("TIMESTAMPTZ", _convert_timestamp)
+sqlite3.register_converter("DATE", lambda value: date.fromisoformat(value.decode()))
+
+# === SQL Translation ===
+# Only the PostgreSQL syntax this codebase uses on the shared code paths is translated.
+_PLACEHOLDER = re.compile(r"= ANY\(%s\)|\bIN %s|%s|%%")
+_FOR_UPDATE = re.compile(r"\s+FOR UPDATE(\s+SKIP LOCKED)?", re.IGNORECASE)
+_INTERVAL = re.compile(r"(CURRENT_TIMESTAMP|[\w.]+)\s*([+-])\s*make_interval\((secs|days) => ([^()]+)\)")
+_VALUES_ALIAS = re.compile(r"\(VALUES %s\) AS (\w+) \(([^)]*)\)")
+_FUNCTION_COLUMN = re.compile(r"^(\w+)\(.*\)$", re.DOTALL)
+_ADD_COLUMN = re.compile(r"ALTER TABLE (\w+) ADD COLUMN IF NOT EXISTS (\w+)(.*)", re.IGNORECASE | re.DOTALL)
+_WRITE_VERBS = ("INSERT", "UPDATE", "DELETE", "REPLACE", "CREATE", "ALTER", "DROP")
+
+def _interval(match: re.Match) -> str:
+    base, sign, unit, amount = match.groups()
+    unit = "seconds" if unit == "secs" else "days"
+    return f"datetime({base}, '{sign}' || ({amount.strip()}) || ' {unit}')"
+
+def translate(sql: str, params: Sequence = ()) -> Tuple[str, list]:
+    """Rewrites a psycopg2-style query and its parameters for SQLite.
+
+    `%s` becomes `?`, `= ANY(%s)` and `IN %s` expand their sequence parameter
+    into `IN (?, ...)`, row locks are dropped (the caller takes the write lock
+    instead) and `make_interval` arithmetic becomes `datetime()` modifiers.
+    """
+    params = list(params or ())
+    flat: list = []
+    index = 0
+
+    def placeholder(match: re.Match) -> str:
+        nonlocal index
+        token = match.group(0)
+        if token == "%%":
+            return "%"
+        value = params[index]
+        index += 1
+        if token == "%s":
+            flat.append(value)
+            return "?"
+        values = list(value)
+        flat.extend(values)
+        # An empty list matches nothing, as `= ANY('{}')` does in PostgreSQL.
+        return f"IN ({', '.join('?' * len(values)) or 'NULL'})"
+
+    sql = _PLACEHOLDER.sub(placeholder, sql)
+    sql = _FOR_UPDATE.sub("", sql)
+    sql = _INTERVAL.sub(_interval, sql)
+    sql = re.sub(r"\bILIKE\b", "LIKE", sql)
+    return sql, flat
+
+def translate_ddl(ddl: str) -> List[str]:
+    """Splits a PostgreSQL schema script into SQLite statements."""
+    ddl = re.sub(r"\b(BIG)?SERIAL PRIMARY KEY\b", "INTEGER PRIMARY KEY AUTOINCREMENT", ddl)
+    ddl = re.sub(r"\bJSONB\b", "TEXT", ddl)
+    ddl = re.sub(r"\bTIMESTAMP WITH TIME ZONE\b", "TIMESTAMPTZ", ddl)
+    return [statement.strip() for statement in ddl.split(";") if statement.strip()]
+
+def _column_name(name: str) -> str:
+    # PostgreSQL names an unaliased aggregate after its function (COUNT(*) -> count).
+    match = _FUNCTION_COLUMN.match(name)
+    return match.group(1).lower() if match else name
+
+def _is_write(sql: str, locking: bool) -> bool:
+    return locking or sql.lstrip().split(None, 1)[0].upper() in _WRITE_VERBS or " RETURNING " in sql.upper()
+
+@contextmanager
+def _mapped_errors():
+    # Existing handlers catch psycopg2's DB-API classes, so SQLite errors are re-raised as those.
+    try:
+        yield
+    except sqlite3.IntegrityError as e:
+        raise psycopg2.IntegrityError(str(e)) from e
+    except sqlite3.OperationalError as e:
+        raise psycopg2.OperationalError(str(e)) from e
+    except sqlite3.Error as e:
+        raise psycopg2.DatabaseError(str(e)) from e
+
+# === SQLite Engine ===
+class SqliteCursor:
+    """Cursor with the subset of the psycopg2 RealDictCursor API used by the bot."""
+
+    def __init__(self, connection: "SqliteConnection"):
+        self.connection = connection
+        self._cursor = connection.raw.cursor()
+        self._buffered: Optional[List[dict]] = None
+        self.itersize = 2000
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self) -> None:
+        self._cursor.close()
+
+    @property
+    def rowcount(self) -> int:
+        return self._cursor.rowcount
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def execute(self, sql: str, params: Sequence = ()) -> None:
+        locking = bool(_FOR_UPDATE.search(sql))
+        sql, flat = translate(sql, params)
+        write = _is_write(sql, locking)
+        if write:
+            self.connection.begin_write()
+        with _mapped_errors():
+            self._cursor.execute(sql, flat)
+            # RETURNING rows are drained now: SQLite cannot commit while a write statement is still stepping.
+            self._buffered = self._drain() if write and self._cursor.description else None
+
+    def executescript_ddl(self, ddl: str) -> None:
+        """Runs a PostgreSQL schema script, emulating ADD COLUMN IF NOT EXISTS."""
+        self.connection.begin_write()
+        with _mapped_errors():
+            for statement in translate_ddl(ddl):
+                match = _ADD_COLUMN.match(statement)
+                if match:
+                    table, column, rest = match.groups()
+                    existing = {row[1] for row in self._cursor.execute(f"PRAGMA table_info({table})").fetchall()}
+                    if column in existing:
+                        continue
+                    statement = f"ALTER TABLE {table} ADD COLUMN {column}{rest}"
+                self._cursor.execute(statement)
+
+    def _row(self, row) -> Optional[dict]:
+        if row is None:
+            return None
+        return {_column_name(column[0]): value for column, value in zip(self._cursor.description, row)}
+
+    def _drain(self) -> List[dict]:
+        return [self._row(row) for row in self._cursor.fetchall()]
+
+    def fetchone(self) -> Optional[dict]:
+        if self._buffered is not None:
+            return self._buffered.pop(0) if self._buffered else None
+        with _mapped_errors():
+            return self._row(self._cursor.fetchone())
+
+    def fetchmany(self, size: Optional[int] = None) -> List[dict]:
+        size = size or self.itersize
+        if self._buffered is not None:
+            rows, self._buffered = self._buffered[:size], self._buffered[size:]
+            return rows
+        with _mapped_errors():
+            return [self._row(row) for row in self._cursor.fetchmany(size)]
+
+    def fetchall(self) -> List[dict]:
+        if self._buffered is not None:
+            rows, self._buffered = self._buffered, []
+            return rows
+        with _mapped_errors():
+            return [self._row(row) for row in self._cursor.fetchall()]
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany()
+            if not rows:
+                return
+            yield from rows
+
+class SqliteConnection:
+    """One SQLite connection with psycopg2-like transaction behaviour.
+
+    Reads run in autocommit mode, so each statement sees the latest committed
+    data as under PostgreSQL's default READ COMMITTED. The first write or
+    `FOR UPDATE` read takes the database write lock with BEGIN IMMEDIATE,
+    which also stands in for row locks, and holds it until commit or rollback.
+    """
+
+    # Prepared statements are server-side in PostgreSQL; SQLite caches them itself.
+    prepared = None
+
+    def __init__(self, path: str):
+        self.raw = sqlite3.connect(
+            path, isolation_level=None, check_same_thread=False,
+            detect_types=sqlite3.PARSE_DECLTYPES
+        )
+        for pragma in SQLITE_PRAGMAS:
+            self.raw.execute(pragma)
+        self.closed = False
+        self._events: List[dict] = []
+
+    def cursor(self, name: Optional[str] = None, **kwargs) -> SqliteCursor:
+        # Named (server-side) cursors and cursor factories have no SQLite equivalent; rows are always dicts.
+        return SqliteCursor(self)
+
+    def begin_write(self) -> None:
+        if not self.raw.in_transaction:
+            with _mapped_errors():
+                self.raw.execute("BEGIN IMMEDIATE")
+
+    def queue_event(self, event: dict) -> None:
+        """Holds a change event until the current transaction commits."""
+        self._events.append(event)
+
+    def commit(self) -> None:
+        if self.raw.in_transaction:
+            with _mapped_errors():
+                self.raw.execute("COMMIT")
+        events, self._events = self._events, []
+        for event in events:
+            _dispatch(event)
+
+    def rollback(self) -> None:
+        self._events = []
+        if self.raw.in_transaction:
+            with _mapped_errors():
+                self.raw.execute("ROLLBACK")
+
+    def close(self) -> None:
+        self.closed = True
+        self.raw.close()
+
+# Idle connections; SQLite connections are cheap, so the pool only grows to the peak concurrency.
+_idle: List[SqliteConnection] = []
+_idle_lock = threading.Lock()
+_all: List[SqliteConnection] = []
+_commit_listeners: List[Callable[[dict], None]] = []
+
+def _acquire() -> SqliteConnection:
+    with _idle_lock:
+        if _idle:
+            return _idle.pop()
+    conn = SqliteConnection(SQLITE_PATH)
+    with _idle_lock:
+        _all.append(conn)
+    return conn
+
+def _release(conn: SqliteConnection) -> None:
+    with _idle_lock:
+        if conn.closed:
+            if conn in _all:
+                _all.remove(conn)
+        else:
+            _idle.append(conn)
+
+@contextmanager
+def sqlite_connection():
+    """SQLite counterpart of bot_commands.get_db_conn: commit on success, roll back on error."""
+    conn = _acquire()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            conn.close()
+        raise
+    finally:
+        _release(conn)
+
+def close_sqlite() -> None:
+    """Closes every SQLite connection; called on shutdown."""
+    with _idle_lock:
+        connections = _all[:]
+        _all.clear()
+        _idle.clear()
+    for conn in connections:
+        conn.close()
+
+# === Change Events ===
+def add_commit_listener(callback: Callable[[dict], None]) -> None:
+    """Registers a callback for change events committed on the SQLite engine.
+
+    It stands in for LISTEN/NOTIFY on a single node and runs on the committing thread.
+    """
+    _commit_listeners.append(callback)
+
+def _dispatch(event: dict) -> None:
+    for callback in _commit_listeners:
+        try:
+            callback(event)
+        except Exception as e:
+            logger.error("Commit listener failed for event %s: %s", event, e)
+
+# === Bulk Helpers ===
+def execute_values(cur, sql: str, rows: Sequence[Sequence], page_size: int = 100) -> None:
+    """Engine-neutral psycopg2.extras.execute_values.
+
+    On SQLite the single `VALUES %s` is expanded into explicit row
+    placeholders, and `(VALUES %s) AS v (a, b)` becomes a subquery with named
+    columns, since SQLite cannot alias VALUES columns.
+    """
+    if not isinstance(cur, SqliteCursor):
+        psycopg2.extras.execute_values(cur, sql, rows, page_size=page_size)
+        return
+    rows = [tuple(row) for row in rows]
+    if not rows:
+        return
+    width = len(rows[0])
+    match = _VALUES_ALIAS.search(sql)
+    if match:
+        alias, columns = match.groups()
+        selected = ", ".join(f"column{i + 1} AS {name.strip()}" for i, name in enumerate(columns.split(",")))
+        sql = sql[:match.start()] + f"(SELECT {selected} FROM (VALUES %s)) AS {alias}" + sql[match.end():]
+    before, after = sql.split("VALUES %s", 1)
+    row_placeholder = "(" + ", ".join(["%s"] * width) + ")"
+    for start in range(0, len(rows), page_size):
+        page = rows[start:start + page_size]
+        page_sql = before + "VALUES " + ", ".join([row_placeholder] * len(page)) + after
+        cur.execute(page_sql, [value for row in page for value in row])
@@ -23,13 +23,31 @@ async def code_structure(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "• **upgrade.py** - Logs and processes user upgrades.\n"
             "• **referral.py** - Manages referral tracking and related functionality.\n"
             "• **structure.py** - Provides project structure listing (this file).\n"
+            "• **edit_coalescer.py** - Debounces rapid inline-keyboard message edits.\n"
+            "• **cluster.py** - Instance registry, symbol shard leases and singleton jobs for cluster mode.\n"
+            "• **state_cache.py** - In-memory user tier and digest-window caches kept fresh via LISTEN/NOTIFY.\n"
+            "• **export.py** - Streams signal history into compressed CSV/JSON documents.\n"
+            "• **throttle.py** - Per-user command throttling and database load shedding.\n"
+            "• **reporting.py** - Revenue and cohort rollups and admin reports.\n"
+            "• **statements.py** - Named hot queries prepared per pooled connection, with call stats.\n"
+            "• **lifecycle.py** - Signal lifecycle state machine and incremental price evaluator.\n"
+            "• **payment_webhook.py** - Payment webhook endpoint with idempotent, batched upgrade processing.\n"
+            "• **notifications.py** - User notification delivery and digest rendering.\n"
+            "• **outbox.py** - Transactional notification outbox and its retrying delivery worker.\n"
+            "• **symbol_catalog.py** - Tradable symbol catalog with prefix search and inline autocomplete.\n"
+            "• **profiling.py** - On-demand CPU profiler, memory snapshots and asyncio task dumps.\n"
+            "• **logging_setup.py** - Non-blocking structured logging with per-update context.\n"
+            "• **storage.py** - Storage engine selection and the embedded SQLite engine.\n"
+            "• **referral_tree.py** - Referral closure table, per-level downline counts and level rewards.\n"
+            "• **startup.py** - Background warm-up and per-phase startup timings.\n"
+            "• **tests/** - pytest suite covering the core flows on both storage engines.\n"
             "• **README.md** - Basic project documentation.\n\n"
             "_Use these files to understand the bot's architecture and functionality._"
         )
 
         # Send the formatted message using markdown
         await update.message.reply_text(structure_message, parse_mode="Markdown")
-        logger.info(f"Code structure requested by user {update.effective_user.id}")
+        logger.info("Code structure requested by user %s", update.effective_user.id)
     except Exception as e:
-        logger.error(f"Error while listing project structure: {e}")
+        logger.error("Error while listing project structure: %s", e)
         await update.message.reply_text("❌ An error occurred while listing the project structure.")
@@ -0,0 +1,212 @@
+# symbol_catalog.py
+import os
+import re
+import asyncio
+import logging
+from bisect import bisect_left
+from typing import Dict, FrozenSet, List, Optional, Tuple
+import httpx
+from telegram import Update, InlineQueryResultArticle, InputTextMessageContent
+from telegram.ext import ContextTypes
+
+logger = logging.getLogger(__name__)
+
+# === Constants ===
+# One symbol per line ('#' starts a comment); when the file is missing, an exchange snapshot is used.
+SYMBOLS_FILE = os.getenv("SYMBOLS_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "symbols.txt"))
+SYMBOLS_SNAPSHOT_URL = os.getenv("SYMBOLS_SNAPSHOT_URL", os.getenv("PRICE_API_URL", "https://api.binance.com/api/v3/ticker/price"))
+# Bare base assets (e.g. BTC) resolve to the first quote listed here that the catalog has.
+PREFERRED_QUOTES = ("USDT", "USDC", "BUSD", "BTC", "ETH")
+FILE_CHECK_SECONDS = 60
+SNAPSHOT_REFRESH_SECONDS = 6 * 3600
+MAX_RESULTS = 20
+INLINE_RESULTS = 10
+
+_SEPARATORS = re.compile(r"[\s/\-_:.]+")
+
+class SymbolCatalog:
+    """Immutable set of tradable symbols with a sorted-array prefix index.
+
+    A refresh builds a new catalog and swaps it in with one assignment, so
+    lookups never see a half-built index and need no locking.
+    """
+
+    __slots__ = ('symbols', 'known', 'aliases', 'source')
+
+    def __init__(self, symbols, source: str):
+        self.symbols: Tuple[str, ...] = tuple(sorted({s for s in symbols if s}))
+        self.known: FrozenSet[str] = frozenset(self.symbols)
+        self.source = source
+        aliases: Dict[str, str] = {}
+        for quote in reversed(PREFERRED_QUOTES):
+            for symbol in self.symbols:
+                if symbol.endswith(quote) and len(symbol) > len(quote):
+                    aliases[symbol[:-len(quote)]] = symbol
+        # A listed symbol always wins over an alias with the same spelling.
+        self.aliases = {base: symbol for base, symbol in aliases.items() if base not in self.known}
+
+    def __len__(self) -> int:
+        return len(self.symbols)
+
+    def normalize(self, text: str) -> Optional[str]:
+        """Returns the canonical symbol for user input (BTC, btc/usdt, BTC-USDT → BTCUSDT), or None."""
+        cleaned = _SEPARATORS.sub('', text).upper()
+        if cleaned in self.known:
+            return cleaned
+        return self.aliases.get(cleaned)
+
+    def prefix(self, text: str, limit: int = MAX_RESULTS) -> List[str]:
+        """Returns up to `limit` symbols starting with the cleaned input, in order."""
+        cleaned = _SEPARATORS.sub('', text).upper()
+        start = bisect_left(self.symbols, cleaned)
+        matches = []
+        for symbol in self.symbols[start:start + limit]:
+            if not symbol.startswith(cleaned):
+                break
+            matches.append(symbol)
+        return matches
+
+_catalog = SymbolCatalog((), "empty")
+_file_mtime: Optional[float] = None
+_task: Optional[asyncio.Task] = None
+_initial_load: Optional[asyncio.Task] = None
+
+# === Loading ===
+def _read_file(path: str) -> List[str]:
+    with open(path, encoding="utf-8") as f:
+        return [line.split('#', 1)[0].strip().upper() for line in f]
+
+def _fetch_snapshot() -> List[str]:
+    response = httpx.get(SYMBOLS_SNAPSHOT_URL, timeout=15)
+    response.raise_for_status()
+    data = response.json()
+    # Accepts either a ticker list or an exchangeInfo document.
+    items = data.get('symbols', []) if isinstance(data, dict) else data
+    return [item['symbol'].upper() for item in items if item.get('status', 'TRADING') == 'TRADING']
+
+def reload() -> str:
+    """Rebuilds the catalog from the symbols file, or from an exchange snapshot if there is none.
+
+    Returns a short summary; on failure the current catalog is kept and the error propagates.
+    """
+    global _catalog, _file_mtime
+    if os.path.exists(SYMBOLS_FILE):
+        mtime = os.path.getmtime(SYMBOLS_FILE)
+        catalog = SymbolCatalog(_read_file(SYMBOLS_FILE), os.path.basename(SYMBOLS_FILE))
+        _file_mtime = mtime
+    else:
+        catalog = SymbolCatalog(_fetch_snapshot(), "exchange snapshot")
+        _file_mtime = None
+    if not catalog:
+        raise ValueError(f"Symbol catalog from {catalog.source} is empty")
+    _catalog = catalog
+    summary = f"{len(catalog)} symbols from {catalog.source}"
+    logger.info("Symbol catalog loaded: %s", summary)
+    return summary
+
+def _file_changed() -> bool:
+    if not os.path.exists(SYMBOLS_FILE):
+        return _file_mtime is not None
+    return os.path.getmtime(SYMBOLS_FILE) != _file_mtime
+
+async def _watch() -> None:
+    since_snapshot = 0
+    while True:
+        await asyncio.sleep(FILE_CHECK_SECONDS)
+        since_snapshot += FILE_CHECK_SECONDS
+        stale_snapshot = _file_mtime is None and since_snapshot >= SNAPSHOT_REFRESH_SECONDS
+        if not (_file_changed() or stale_snapshot):
+            continue
+        since_snapshot = 0
+        try:
+            await asyncio.to_thread(reload)
+        except Exception as e:
+            logger.error("Failed to refresh symbol catalog: %s", e)
+
+async def _load_initial() -> None:
+    try:
+        await asyncio.to_thread(reload)
+    except Exception as e:
+        logger.error("Failed to load symbol catalog; symbols will not be validated until it loads: %s", e)
+
+async def start(app) -> None:
+    """Starts loading the catalog in the background and watching the symbols file for changes.
+
+    Until the first load finishes, normalize() passes symbols through unvalidated.
+    """
+    global _task, _initial_load
+    _initial_load = asyncio.create_task(_load_initial())
+    _task = asyncio.create_task(_watch())
+
+async def wait_loaded() -> None:
+    """Waits for the first load started by start() to finish, successfully or not."""
+    if _initial_load is not None:
+        await asyncio.shield(_initial_load)
+
+async def stop(app) -> None:
+    """Stops watching the symbols file."""
+    global _task, _initial_load
+    if _initial_load:
+        _initial_load.cancel()
+        _initial_load = None
+    if _task:
+        _task.cancel()
+        _task = None
+
+# === Lookups ===
+def is_loaded() -> bool:
+    """True once a non-empty catalog has been loaded."""
+    return len(_catalog) > 0
+
+def normalize(text: str) -> Optional[str]:
+    """Canonical symbol for user input, or None if unknown.
+
+    Until a catalog has loaded, input is only cleaned so tracking keeps working.
+    """
+    if not is_loaded():
+        return _SEPARATORS.sub('', text).upper() or None
+    return _catalog.normalize(text)
+
+def search(text: str, limit: int = MAX_RESULTS) -> List[str]:
+    """Symbols starting with the input, e.g. BTC → BTCUSDT, BTCUSDC, ..."""
+    return _catalog.prefix(text, limit)
+
+def unknown_symbol_text(text: str) -> str:
+    """Reply for a symbol that is not in the catalog, with close matches when there are some."""
+    suggestions = search(text[:3], 5) if text else []
+    hint = f" Did you mean: {', '.join(suggestions)}?" if suggestions else " Use /search <prefix> to find it."
+    return f"❌ Unknown symbol '{text}'.{hint}"
+
+# === Handlers ===
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Lists catalog symbols matching a prefix: /search <prefix>."""
+    if not context.args:
+        await update.message.reply_text("❌ Usage: /search <symbol prefix>, e.g. /search BTC")
+        return
+    if not is_loaded():
+        await update.message.reply_text("⏳ The symbol list is not available yet. Please try again shortly.")
+        return
+    query = context.args[0]
+    matches = search(query)
+    if not matches:
+        await update.message.reply_text(f"🔍 No symbols start with '{query.upper()}'.")
+        return
+    more = " (showing first results, type more letters to narrow down)" if len(matches) == MAX_RESULTS else ""
+    await update.message.reply_text(f"🔍 Symbols matching '{query.upper()}'{more}:\n" + "\n".join(matches))
+
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Autocompletes symbols in inline mode (@bot <prefix>)."""
+    text = update.inline_query.query.strip()
+    if not text or not is_loaded():
+        await update.inline_query.answer([], cache_time=5)
+        return
+    results = [
+        InlineQueryResultArticle(
+            id=symbol,
+            title=symbol,
+            description=f"Track with /track {symbol} <entry> <target> <stop>",
+            input_message_content=InputTextMessageContent(symbol),
+        )
+        for symbol in search(text, INLINE_RESULTS)
+    ]
+    await update.inline_query.answer(results, cache_time=60)
@@ -0,0 +1,79 @@
+# conftest.py
+import os
+import sys
+import glob
+import tempfile
+from types import SimpleNamespace
+
+# The engine is chosen from DATABASE_URL1 at import time, so it is set before any bot module loads.
+_DB_DIR = tempfile.mkdtemp(prefix="targethawk_tests_")
+DB_PATH = os.path.join(_DB_DIR, "targethawk.db")
+os.environ["DATABASE_URL1"] = f"sqlite:///{DB_PATH}"
+os.environ.pop("CLUSTER_MODE", None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+import bot_commands
+import storage
+
+# A scratch PostgreSQL database; its public schema is dropped before every test that uses it.
+PG_URL = os.getenv("TEST_POSTGRES_URL")
+
+# === Fixtures ===
+def use_postgres(monkeypatch):
+    """Points the storage layer at TEST_POSTGRES_URL for one test, or skips it."""
+    if not PG_URL:
+        pytest.skip("TEST_POSTGRES_URL not set")
+    bot_commands.close_pool()
+    monkeypatch.setattr(storage, "ENGINE", "postgres")
+    monkeypatch.setattr(bot_commands, "DB_URL", PG_URL)
+    monkeypatch.setattr(bot_commands, "_pool", None)
+
+@pytest.fixture(params=["sqlite", "postgres"])
+def db(request, monkeypatch):
+    """A freshly initialised database on each engine; yields a helper for one-off queries."""
+    if request.param == "postgres":
+        use_postgres(monkeypatch)
+        query("DROP SCHEMA public CASCADE; CREATE SCHEMA public")
+    else:
+        storage.close_sqlite()
+        for path in glob.glob(f"{DB_PATH}*"):
+            os.remove(path)
+    bot_commands.init_db()
+    yield query
+    bot_commands.close_pool()
+
+def query(sql, params=()):
+    """Runs one statement in its own transaction and returns the rows, if any."""
+    with bot_commands.get_db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+            rows = cur.fetchall() if cur.description else []
+        conn.commit()
+    return rows
+
+# === Telegram Stand-ins ===
+class FakeMessage:
+    """Records replies instead of sending them."""
+
+    def __init__(self, text=None):
+        self.text = text
+        self.replies = []
+
+    async def reply_text(self, text=None, **kwargs):
+        self.replies.append(text if text is not None else kwargs.get('text'))
+
+    async def reply_document(self, document=None, filename=None, caption=None, **kwargs):
+        self.replies.append(caption)
+
+def fake_update(user_id, username=None, args=(), text=None):
+    """Builds an (update, context) pair for a command sent by `user_id`."""
+    message = FakeMessage(text)
+    update = SimpleNamespace(
+        effective_user=SimpleNamespace(id=user_id, username=username),
+        effective_chat=SimpleNamespace(id=user_id),
+        message=message,
+        callback_query=None,
+    )
+    context = SimpleNamespace(args=list(args))
+    return update, context
@@ -0,0 +1,75 @@
+# test_cluster.py
+"""Lease assignment and failover for cluster mode.
+
+The heartbeat tests need PostgreSQL (cluster mode refuses SQLite); point
+TEST_POSTGRES_URL at a scratch database to run them. Two instances are
+simulated in one process by switching cluster.INSTANCE_ID between heartbeats.
+"""
+import time
+import pytest
+import bot_commands
+import cluster
+from conftest import use_postgres
+
+JOBS = {"updates": None, "reporting": None, "referral_tree": None, "payment_webhook": None}
+ALL_LEASES = {f"{cluster.SHARD_PREFIX}{shard}" for shard in range(cluster.SHARD_COUNT)} | {
+    f"{cluster.JOB_PREFIX}{name}" for name in JOBS
+}
+
+@pytest.fixture(autouse=True)
+def jobs(monkeypatch):
+    monkeypatch.setattr(cluster, "_jobs", dict(JOBS))
+
+def _desired(instance_id, instances, monkeypatch):
+    monkeypatch.setattr(cluster, "INSTANCE_ID", instance_id)
+    return set(cluster._desired_leases(instances))
+
+# === Assignment ===
+def test_desired_leases_partition_shards_and_jobs(monkeypatch):
+    instances = ["a", "b", "c"]
+    shares = [_desired(instance, instances, monkeypatch) for instance in instances]
+    assert set().union(*shares) == ALL_LEASES
+    assert sum(len(share) for share in shares) == len(ALL_LEASES)
+
+def test_desired_leases_for_unknown_or_sole_instance(monkeypatch):
+    assert _desired("z", ["a", "b"], monkeypatch) == set()
+    assert _desired("a", ["a"], monkeypatch) == ALL_LEASES
+
+# === Heartbeats (PostgreSQL) ===
+@pytest.fixture
+def pg(monkeypatch):
+    use_postgres(monkeypatch)
+    monkeypatch.setattr(cluster, "LEASE_TTL_SECONDS", 2)
+    bot_commands.init_db()
+    with bot_commands.get_db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM cluster_leases")
+            cur.execute("DELETE FROM cluster_instances")
+        conn.commit()
+    yield
+    bot_commands.close_pool()
+
+def _heartbeat(instance_id, monkeypatch):
+    monkeypatch.setattr(cluster, "INSTANCE_ID", instance_id)
+    return cluster._heartbeat()
+
+def test_two_instances_hold_disjoint_leases(pg, monkeypatch):
+    owned = {"a": set(), "b": set()}
+    for _ in range(3):
+        for instance in ("a", "b"):
+            owned[instance] = _heartbeat(instance, monkeypatch)
+            assert not owned["a"] & owned["b"]
+    assert owned["a"] | owned["b"] == ALL_LEASES
+    assert owned["a"] and owned["b"]
+    assert f"{cluster.JOB_PREFIX}updates" in owned["a"] ^ owned["b"]
+
+def test_survivor_takes_over_after_lease_expiry(pg, monkeypatch):
+    for _ in range(2):
+        owned_a = _heartbeat("a", monkeypatch)
+        owned_b = _heartbeat("b", monkeypatch)
+    assert owned_b
+
+    # 'b' stops heartbeating; its leases still block 'a' until they expire.
+    assert _heartbeat("a", monkeypatch) == owned_a
+    time.sleep(cluster.LEASE_TTL_SECONDS + 0.5)
+    assert _heartbeat("a", monkeypatch) == ALL_LEASES
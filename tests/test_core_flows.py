@@ -0,0 +1,266 @@
+# test_core_flows.py
+"""Core flows, run against both storage engines through the `db` fixture.
+
+The reporting rollups use PostgreSQL-only SQL (advisory locks, date_trunc)
+and are disabled on SQLite, where only that guard is checked.
+"""
+import gzip
+import json
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+import bot_commands
+import export
+import lifecycle
+import main
+import notifications
+import outbox
+import reporting
+import start_commands
+import state_cache
+import storage
+import user_commands
+from conftest import fake_update, query
+
+# === Schema ===
+def test_init_db_is_idempotent(db, caplog):
+    bot_commands.init_db()
+    # Forces the DDL to run again over the existing tables.
+    db("DELETE FROM schema_meta")
+    with caplog.at_level(logging.INFO, logger="bot_commands"):
+        bot_commands.init_db()
+        bot_commands.init_db()
+    assert not [r for r in caplog.records if r.levelno >= logging.ERROR]
+    assert "skipping DDL" in caplog.records[-1].getMessage()
+    assert db("SELECT fingerprint FROM schema_meta") == [{'fingerprint': bot_commands.SCHEMA_FINGERPRINT}]
+
+# === /start ===
+def _start(user_id, args=()):
+    update, context = fake_update(user_id, f"user{user_id}", args)
+    asyncio.run(start_commands.start_with_ref(update, context))
+    return update.message.replies
+
+def test_start_registers_user_and_credits_referrer(db):
+    assert _start(1)
+    for referred in (2, 3, 4):
+        _start(referred, [str(1)])
+    # A repeated /start must not count the referral twice.
+    _start(2, [str(1)])
+
+    referrer = db("SELECT tier, referrals, trial_expiry FROM users WHERE user_id = 1")[0]
+    assert referrer['referrals'] == 3
+    assert referrer['tier'] == 'Pro'
+    assert referrer['trial_expiry'] > datetime.now(timezone.utc) + timedelta(days=29)
+    assert db("SELECT tier, source FROM upgrades WHERE user_id = 1") == [{'tier': 'Pro', 'source': 'Referral Bonus'}]
+    assert db("SELECT tier FROM users WHERE user_id = 2") == [{'tier': 'Pro Trial'}]
+    assert db("SELECT COUNT(*) AS n FROM referrals")[0]['n'] == 3
+    assert db("SELECT members FROM referral_downline WHERE user_id = 1 AND depth = 1") == [{'members': 3}]
+    texts = [row['text'] for row in db("SELECT text FROM outbox WHERE chat_id = 1 ORDER BY id")]
+    assert len(texts) == 4
+    assert "upgraded to Pro" in texts[-1]
+
+def test_start_ignores_self_referral(db):
+    _start(5, ["5"])
+    assert db("SELECT referrals FROM users WHERE user_id = 5") == [{'referrals': 0}]
+    assert db("SELECT COUNT(*) AS n FROM referrals")[0]['n'] == 0
+
+# === /status ===
+def test_status_shows_trial_expiry_and_active_signals(db):
+    _start(6)
+    _track(6, "BTCUSDT", "100", "110", "95")
+    _track(6, "ETHUSDT", "10", "12", "9")
+    db("UPDATE signals SET status = 'Stopped' WHERE id = 2")
+    update, context = fake_update(6)
+    asyncio.run(user_commands.status(update, context))
+    reply = update.message.replies[-1]
+    assert "Plan: Pro Trial" in reply
+    assert "expires in 2 day(s)" in reply
+    assert "Active Signals: 1" in reply
+
+def test_status_for_unknown_user(db):
+    update, context = fake_update(404)
+    asyncio.run(user_commands.status(update, context))
+    assert update.message.replies == ["❌ You are not registered."]
+
+# === /track and /export ===
+def _track(user_id, *args):
+    update, context = fake_update(user_id, args=args)
+    asyncio.run(main.track_signal(update, context))
+    return update.message.replies[-1]
+
+def test_track_then_export(db, tmp_path):
+    _start(10)
+    _start(11)
+    assert "created with ID" in _track(10, "btc/usdt", "100", "110", "95", "scalp")
+    _track(10, "ETHUSDT", "10", "12", "9", "swing")
+    _track(11, "SOLUSDT", "1", "2", "0.5")
+
+    path = str(tmp_path / "mine.csv.gz")
+    fmt, filters = export.parse_export_args(["tag=SCALP"])
+    assert export.write_export(path, fmt, 10, filters) == 1
+    with gzip.open(path, 'rt') as f:
+        lines = f.read().splitlines()
+    assert lines[0].split(',') == list(export.EXPORT_COLUMNS)
+    assert "BTCUSDT" in lines[1]
+
+    path = str(tmp_path / "all.json.gz")
+    assert export.write_export(path, 'json', None, {}) == 3
+    with gzip.open(path, 'rt') as f:
+        rows = json.load(f)
+    assert [row['user_id'] for row in rows] == [10, 10, 11]
+
+def test_track_rejects_bad_prices(db):
+    assert "must be numbers" in _track(10, "BTCUSDT", "abc", "110", "95")
+    assert db("SELECT COUNT(*) AS n FROM signals")[0]['n'] == 0
+
+# === Outbox ===
+def test_outbox_settle_batch(db):
+    with bot_commands.get_db_conn() as conn:
+        with conn.cursor() as cur:
+            outbox.enqueue_many(cur, [(1, "sent", False), (2, "retry", False), (3, "dead", True), (4, "digest", False)])
+        conn.commit()
+    rows = {row['text']: row for row in outbox.claim_batch()}
+    assert set(rows) == {"sent", "retry", "dead", "digest"}
+    assert outbox.claim_batch() == []
+
+    outbox.settle_batch(
+        [rows["sent"]['id']],
+        [(rows["retry"]['id'], 'pending', 0, "timed out"), (rows["dead"]['id'], 'dead', 0, "blocked")],
+        [(rows["digest"]['id'], 3600)],
+    )
+    left = {row['text']: row for row in db("SELECT text, status, last_error, attempts FROM outbox")}
+    assert set(left) == {"retry", "dead", "digest"}
+    assert left["retry"]['status'] == 'pending' and left["retry"]['last_error'] == "timed out"
+    assert left["dead"]['status'] == 'dead'
+    assert left["digest"]['status'] == 'digest' and left["digest"]['attempts'] == 0
+    # The digest is not due for an hour; the retry is due again now.
+    assert outbox.claim_digests() == []
+    assert [row['text'] for row in outbox.claim_batch()] == ["retry"]
+
+def test_outbox_full_digest_is_released_early(db):
+    with bot_commands.get_db_conn() as conn:
+        with conn.cursor() as cur:
+            outbox.enqueue_many(cur, [(7, f"alert {n}", False) for n in range(outbox.MAX_DIGEST_ROWS)])
+        conn.commit()
+    claimed = outbox.claim_batch()
+    outbox.settle_batch([], [], [(row['id'], 3600) for row in claimed])
+    digests = outbox.claim_digests()
+    assert len(digests) == outbox.MAX_DIGEST_ROWS
+    assert {row['chat_id'] for row in digests} == {7}
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text):
+        self.sent.append((chat_id, text))
+
+def test_outbox_flush_sends_buffered_digests(db, monkeypatch):
+    bot = FakeBot()
+    monkeypatch.setattr(notifications, "_bot", bot)
+    monkeypatch.setitem(state_cache._digest_windows, 8, 3600)
+    with bot_commands.get_db_conn() as conn:
+        with conn.cursor() as cur:
+            outbox.enqueue_many(cur, [(8, "first", False), (8, "second", False)])
+        conn.commit()
+    # A regular drain only buffers them for the hour-long window.
+    asyncio.run(outbox.drain_once())
+    assert bot.sent == []
+    with bot_commands.get_db_conn() as conn:
+        with conn.cursor() as cur:
+            outbox.enqueue(cur, 8, "third")
+        conn.commit()
+
+    asyncio.run(outbox.flush())
+    assert bot.sent == [(8, "third"), (8, "📬 Digest: 2 update(s)\nfirst\nsecond")]
+    assert db("SELECT id FROM outbox") == []
+
+# === Signal Lifecycle ===
+def _signal_state(signal_id):
+    return lifecycle.SignalState(query(f"SELECT {lifecycle.SIGNAL_COLUMNS} FROM signals WHERE id = %s", (signal_id,))[0])
+
+def test_persist_transitions(db):
+    _start(20)
+    _track(20, "BTCUSDT", "100", "110", "95")
+    _track(20, "ETHUSDT", "10", "12", "9")
+    db("UPDATE signals SET target_price_2 = 120 WHERE id = 1")
+    btc, eth = _signal_state(1), _signal_state(2)
+
+    transitions = [(btc, from_status, to_status, 111.0) for from_status, to_status in btc.evaluate(111.0)]
+    eth.evaluate(10.5)
+    assert lifecycle.persist_transitions(transitions, [eth]) == []
+
+    assert db("SELECT status, last_level FROM signals WHERE id = 1") == [{'status': 'T1 Hit', 'last_level': 1}]
+    assert db("SELECT last_price FROM signals WHERE id = 2") == [{'last_price': 10.5}]
+    assert db("SELECT from_status, to_status, price FROM signal_events WHERE signal_id = 1") == [
+        {'from_status': 'Open', 'to_status': 'T1 Hit', 'price': 111.0}
+    ]
+    assert len(db("SELECT id FROM outbox WHERE chat_id = 20")) == 1
+
+def test_single_target_signal_completes(db):
+    _start(22)
+    _track(22, "BTCUSDT", "100", "110", "95")
+    state = _signal_state(1)
+    lifecycle._add(state)
+
+    transitions = lifecycle.evaluate_prices({"BTCUSDT": 111.0})
+    assert [t[1:3] for t in transitions] == [('Open', 'T1 Hit'), ('T1 Hit', 'Completed')]
+    # No longer evaluated, so a later drop through the stop-loss is never recorded as Stopped.
+    assert state.id not in lifecycle._index
+    assert state.evaluate(90.0) == []
+
+    assert lifecycle.persist_transitions(transitions, []) == []
+    assert db("SELECT status, last_level FROM signals WHERE id = 1") == [{'status': 'Completed', 'last_level': 1}]
+    assert len(db("SELECT id FROM outbox WHERE chat_id = 22")) == 1
+
+def test_signal_left_at_its_last_target_completes_on_next_tick(db):
+    _start(23)
+    _track(23, "BTCUSDT", "100", "110", "95")
+    db("UPDATE signals SET status = 'T1 Hit', last_level = 1 WHERE id = 1")
+    state = _signal_state(1)
+
+    transitions = [(state, from_status, to_status, 90.0) for from_status, to_status in state.evaluate(90.0)]
+    assert [t[1:3] for t in transitions] == [('T1 Hit', 'Completed')]
+    assert lifecycle.persist_transitions(transitions, []) == []
+    assert db("SELECT status FROM signals WHERE id = 1") == [{'status': 'Completed'}]
+
+def test_persist_transitions_skips_cancelled_signal(db):
+    _start(21)
+    _track(21, "BTCUSDT", "100", "110", "95")
+    state = _signal_state(1)
+    assert lifecycle.cancel_signal(21, 1)
+
+    transitions = [(state, from_status, to_status, 90.0) for from_status, to_status in state.evaluate(90.0)]
+    assert lifecycle.persist_transitions(transitions, [state]) == [1]
+    assert db("SELECT status, last_price FROM signals WHERE id = 1") == [{'status': 'Cancelled', 'last_price': None}]
+    assert [row['to_status'] for row in db("SELECT to_status FROM signal_events")] == ['Cancelled']
+    assert db("SELECT id FROM outbox") == []
+
+# === Upgrades ===
+def test_apply_upgrade(db):
+    _start(30)
+    with bot_commands.get_db_conn() as conn:
+        with conn.cursor() as cur:
+            assert not bot_commands.apply_upgrade(cur, 999, 'Pro', 'Manual', 30)
+            assert bot_commands.apply_upgrade(cur, 30, 'Pro', 'Stripe Payment', 30)
+            assert bot_commands.apply_upgrade(cur, 30, 'Pro', 'Stripe Payment', 30)
+        conn.commit()
+    user = db("SELECT tier, trial_expiry FROM users WHERE user_id = 30")[0]
+    assert user['tier'] == 'Pro'
+    # The second upgrade extends the first instead of restarting from today.
+    assert user['trial_expiry'] > datetime.now(timezone.utc) + timedelta(days=59)
+    assert len(db("SELECT id FROM upgrades WHERE user_id = 30")) == 2
+
+# === Reporting ===
+def test_reports(db):
+    if storage.is_sqlite():
+        assert reporting.revenue_report() == reporting.SQLITE_UNSUPPORTED_TEXT
+        assert reporting.cohort_report() == reporting.SQLITE_UNSUPPORTED_TEXT
+        return
+    _start(40)
+    _start(41, ["40"])
+    reporting.run_rollup()
+    report = reporting.revenue_report()
+    assert "Signups: 2" in report
+    assert "Rollups current through" in report
+    assert "2 signups" in reporting.cohort_report()
@@ -0,0 +1,59 @@
+# test_edit_coalescer.py
+import asyncio
+from types import SimpleNamespace
+from edit_coalescer import EditCoalescer
+
+class FakeQuery:
+    """Callback query whose edits are recorded; each edit yields to the loop like a real request."""
+
+    def __init__(self, edits, message_id=1):
+        self.message = SimpleNamespace(chat_id=100, message_id=message_id)
+        self._edits = edits
+
+    async def edit_message_text(self, text, reply_markup=None):
+        await asyncio.sleep(0)
+        self._edits.append(text)
+
+def test_rapid_edits_collapse_into_the_last_one():
+    edits = []
+
+    async def run():
+        coalescer = EditCoalescer(debounce_seconds=0.01)
+        query = FakeQuery(edits)
+        for page in range(5):
+            coalescer.schedule(query, f"page {page}")
+        await asyncio.sleep(0.05)
+        return coalescer
+
+    coalescer = asyncio.run(run())
+    assert edits == ["page 4"]
+    assert not coalescer._seq and not coalescer._locks
+
+def test_final_screen_wins_over_pending_edit():
+    edits = []
+
+    async def run():
+        coalescer = EditCoalescer(debounce_seconds=0.01)
+        query = FakeQuery(edits)
+        coalescer.schedule(query, "selection")
+        await coalescer.edit_now(query, "done")
+        await asyncio.sleep(0.05)
+
+    asyncio.run(run())
+    assert edits == ["done"]
+
+def test_discard_without_a_send_frees_its_entries():
+    edits = []
+
+    async def run():
+        coalescer = EditCoalescer(debounce_seconds=0.01)
+        for message_id in range(10):
+            query = FakeQuery(edits, message_id)
+            coalescer.schedule(query, "menu")
+            coalescer.discard(query)
+        await asyncio.sleep(0.05)
+        return coalescer
+
+    coalescer = asyncio.run(run())
+    assert edits == []
+    assert not coalescer._seq and not coalescer._pending and not coalescer._timers
@@ -0,0 +1,34 @@
+# test_throttle.py
+import asyncio
+import threading
+import psycopg2
+import pytest
+from telegram.ext import ApplicationHandlerStop
+import bot_commands
+import storage
+import throttle
+from conftest import fake_update
+
+def test_every_valid_tier_has_a_quota():
+    assert list(throttle.TIER_MULTIPLIERS) == bot_commands.VALID_TIERS
+
+def test_starved_event_loop_checkout_sheds_load(monkeypatch):
+    monkeypatch.setattr(storage, "ENGINE", "postgres")
+    monkeypatch.setattr(bot_commands, "_loop_slots", threading.BoundedSemaphore(1))
+    monkeypatch.setattr(bot_commands, "_db_wait_ewma", 0.0)
+    monkeypatch.setattr(bot_commands, "_db_wait_sampled_at", 0.0)
+    # A handler still holds the event loop's only connection.
+    bot_commands._loop_slots.acquire()
+
+    async def checkout():
+        with bot_commands.get_db_conn():
+            pass
+
+    with pytest.raises(psycopg2.OperationalError):
+        asyncio.run(checkout())
+    assert bot_commands.db_wait_seconds() > throttle.SHED_DB_WAIT_SECONDS
+
+    update, context = fake_update(50, text="/status")
+    with pytest.raises(ApplicationHandlerStop):
+        asyncio.run(throttle.check_update(update, context))
+    assert update.message.replies == [throttle.BUSY_TEXT]
@@ -0,0 +1,164 @@
+# throttle.py
+import time
+import logging
+from typing import Dict, Optional, Tuple
+from telegram import Update
+from telegram.ext import ContextTypes, ApplicationHandlerStop
+import bot_commands
+import state_cache
+import admin_commands
+
+logger = logging.getLogger(__name__)
+
+# === Command Classes ===
+# Commands that hit the database are 'heavy'; static replies are 'light'.
+HEAVY_COMMANDS = {
+    'start', 'refer', 'status', 'leaderboard', 'track', 'signals', 'export', 'export_all', 'admin', 'digest'
+}
+COMMAND_CLASSES = ('heavy', 'light', 'callback')
+
+# (bucket capacity, tokens refilled per second) for a Free user
+BASE_QUOTAS = {
+    'heavy': (5, 0.2),
+    'light': (10, 1.0),
+    'callback': (20, 2.0),
+}
+
+# Quota multipliers per tier; every tier in bot_commands.VALID_TIERS needs one.
+_MULTIPLIERS = {
+    'Free': 1,
+    'Pro': 2,
+    'VIP': 4,
+}
+_missing = [tier for tier in bot_commands.VALID_TIERS if tier not in _MULTIPLIERS]
+if _missing:
+    raise RuntimeError(f"No quota multiplier for tier(s) {', '.join(_missing)}; add them to throttle._MULTIPLIERS")
+TIER_MULTIPLIERS = {tier: _MULTIPLIERS[tier] for tier in bot_commands.VALID_TIERS}
+
+# === Load Shedding ===
+SHED_DB_WAIT_SECONDS = 0.5
+CACHED_REPLY_TTL_SECONDS = 300
+BUSY_TEXT = "⏳ The bot is very busy right now. Please try again in a moment."
+THROTTLED_TEXT = "🐢 You're sending commands too quickly. Please slow down."
+# Users are told they are throttled at most once per this interval.
+NOTICE_INTERVAL_SECONDS = 10
+
+MAX_BUCKETS = 50000
+IDLE_BUCKET_SECONDS = 600
+
+class TokenBucket:
+    """Classic token bucket: `capacity` burst, refilled continuously at `rate` tokens/second."""
+
+    __slots__ = ('capacity', 'rate', 'tokens', 'updated_at')
+
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def consume(self, now: Optional[float] = None) -> bool:
+        """Takes one token if available; returns False if the caller is over quota."""
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+_buckets: Dict[Tuple[int, str], TokenBucket] = {}
+_last_notice: Dict[int, float] = {}
+_cached_replies: Dict[str, Tuple[float, str]] = {}
+
+def remember_reply(command: str, text: str) -> None:
+    """Stores the latest rendering of a shareable reply, served when shedding load."""
+    _cached_replies[command] = (time.monotonic(), text)
+
+def _cached_reply(command: str) -> Optional[str]:
+    cached = _cached_replies.get(command)
+    if cached and time.monotonic() - cached[0] < CACHED_REPLY_TTL_SECONDS:
+        return cached[1]
+    return None
+
+def _tier_of(user_id: int) -> str:
+    tier = state_cache.get_tier(user_id) or 'Free'
+    # 'Pro Trial' gets the Pro quota.
+    base = tier.split()[0]
+    return base if base in TIER_MULTIPLIERS else 'Free'
+
+def _prune(now: float) -> None:
+    stale = [key for key, bucket in _buckets.items() if now - bucket.updated_at > IDLE_BUCKET_SECONDS]
+    for key in stale:
+        del _buckets[key]
+    for user_id in [u for u, at in _last_notice.items() if now - at > IDLE_BUCKET_SECONDS]:
+        del _last_notice[user_id]
+
+def _on_change(event: dict) -> None:
+    # A tier change resizes the user's buckets on their next command.
+    if event.get('k') == 'tier':
+        for command_class in COMMAND_CLASSES:
+            _buckets.pop((event['u'], command_class), None)
+
+state_cache.subscribe(_on_change)
+
+def allow(user_id: int, command_class: str) -> bool:
+    """Consumes a token for the user's command class; False if over quota."""
+    now = time.monotonic()
+    key = (user_id, command_class)
+    bucket = _buckets.get(key)
+    if bucket is None:
+        if len(_buckets) >= MAX_BUCKETS:
+            _prune(now)
+        capacity, rate = BASE_QUOTAS[command_class]
+        multiplier = TIER_MULTIPLIERS[_tier_of(user_id)]
+        bucket = _buckets[key] = TokenBucket(capacity * multiplier, rate * multiplier)
+    return bucket.consume(now)
+
+def classify(update: Update) -> Tuple[Optional[str], Optional[str]]:
+    """Returns (command class, command name) for an update, or (None, None) if not rate limited."""
+    if update.callback_query:
+        return 'callback', None
+    message = update.message
+    if message and message.text:
+        if message.text.startswith('/'):
+            command = message.text[1:].split()[0].split('@')[0].lower() if len(message.text) > 1 else ''
+            return ('heavy' if command in HEAVY_COMMANDS else 'light'), command
+        # Free text feeds the edit/admin conversations, which write to the database.
+        return 'heavy', None
+    return None, None
+
+async def _reject(update: Update, text: str, user_id: int, always: bool = False) -> None:
+    now = time.monotonic()
+    if not always and now - _last_notice.get(user_id, 0.0) < NOTICE_INTERVAL_SECONDS:
+        if update.callback_query:
+            await update.callback_query.answer()
+        return
+    _last_notice[user_id] = now
+    if update.callback_query:
+        await update.callback_query.answer(text, show_alert=False)
+    elif update.message:
+        await update.message.reply_text(text)
+
+async def check_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Runs before all other handlers; stops the update if the user is throttled or the DB is saturated."""
+    user = update.effective_user
+    if user is None or admin_commands.is_admin(user.id):
+        return
+    command_class, command = classify(update)
+    if command_class is None:
+        return
+
+    if not allow(user.id, command_class):
+        logger.info("Throttled user %s (%s /%s)", user.id, command_class, command or '-')
+        await _reject(update, THROTTLED_TEXT, user.id)
+        raise ApplicationHandlerStop
+
+    if command_class != 'light' and bot_commands.db_wait_seconds() > SHED_DB_WAIT_SECONDS:
+        cached = _cached_reply(command) if command else None
+        logger.warning("Shedding %s update from user %s: DB wait %.3fs", command_class, user.id, bot_commands.db_wait_seconds())
+        if cached:
+            await update.message.reply_text(cached)
+        else:
+            await _reject(update, BUSY_TEXT, user.id, always=True)
+        raise ApplicationHandlerStop
@@ -1,15 +1,24 @@
 # user_commands.py
 
 import os
+import time
+import asyncio
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 import bot_commands # Assuming this contains get_db_conn()
+import throttle
+import statements
+import referral_tree
 
 # Set up logging for this module
 logger = logging.getLogger(__name__)
 
+# The leaderboard is rebuilt at most this often; startup warms it before the first request.
+LEADERBOARD_TTL_SECONDS = 60
+_leaderboard = None
+
 async def plans(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Informs the user about available subscription plans."""
     text = "💰 Plans:\n🔹 Free: Track 1 signal, basic alerts\n🔸 Pro: $9.99/month - Track up to 10 signals, daily stats\n🏆 VIP: $49.99 one-time - Unlimited signals, full analytics"
@@ -17,9 +26,11 @@ async def plans(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def upgrade(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Provides inline keyboard buttons for payment options."""
+    # The user ID travels with the checkout so the payment webhook knows whom to upgrade.
+    user_id = update.effective_user.id
     kb = [
-        [InlineKeyboardButton("Pay with Stripe", url="https://yourdomain.com/pay/stripe")],
-        [InlineKeyboardButton("Pay with Crypto", url="https://yourdomain.com/pay/crypto")]
+        [InlineKeyboardButton("Pay with Stripe", url=f"https://yourdomain.com/pay/stripe?user_id={user_id}")],
+        [InlineKeyboardButton("Pay with Crypto", url=f"https://yourdomain.com/pay/crypto?user_id={user_id}")]
     ]
     await update.message.reply_text("🔐 Upgrade your plan:", reply_markup=InlineKeyboardMarkup(kb))
 
@@ -30,51 +41,55 @@ async def refer(update: Update, context: ContextTypes.DEFAULT_TYPE):
         with conn.cursor() as cur:
             cur.execute("SELECT referrals, tier FROM users WHERE user_id = %s", (user_id,))
             user = cur.fetchone()
-            if not user:
-                # Handle unregistered user gracefully
-                await update.message.reply_text("❌ You are not registered. Please use /start first.")
-                return
-
-            referrals = user['referrals']
-            tier = user['tier']
+            levels = referral_tree.downline(cur, user_id) if user else {}
 
+    if not user:
+        # Handle unregistered user gracefully
+        await update.message.reply_text("❌ You are not registered. Please use /start first.")
+        return
+    referrals = user['referrals']
+    tier = user['tier']
     link = f"https://t.me/TargetHwakBot?start={user_id}"
     await update.message.reply_text(
         f"🎁 Referral Program\n"
         f"Your link: {link}\n"
         f"Referrals: {referrals}\n"
+        f"🌳 Network: {referral_tree.format_levels(levels)}\n"
         f"🎯 {referrals}/3 for Pro • {referrals}/10 for VIP\n"
         f"Invite 3 → 1 month Pro\n"
         f"Invite 10 → VIP Lifetime 💎\n"
+        f"10 at level 2 → 14 days Pro • 25 at level 3 → 1 month Pro\n"
         f"Current Plan: {tier}"
     )
     
 async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Displays the user's current plan and active signals."""
     user_id = update.effective_user.id
-    now = datetime.utcnow()
+    now = datetime.now(timezone.utc)
     with bot_commands.get_db_conn() as conn:
         with conn.cursor() as cur:
-            cur.execute("SELECT tier, trial_expiry FROM users WHERE user_id = %s", (user_id,))
+            statements.execute(cur, "user_lookup", (user_id,))
             user = cur.fetchone()
-            if not user:
-                await update.message.reply_text("❌ You are not registered.")
-                return
-            tier = user['tier']
-            expiry = user['trial_expiry']
+            if user:
+                statements.execute(cur, "count_active_signals", (user_id,))
+                active_signals_count = cur.fetchone()['count']
 
-            cur.execute("SELECT COUNT(*) FROM signals WHERE user_id = %s AND status = 'active'", (user_id,))
-            active_signals_count = cur.fetchone()['count']
-
-            msg = f"📊 Plan: {tier}\n"
-            if expiry:
-                days_left = max((expiry - now).days, 0)
-                msg += f"⏳ Trial expires in {days_left} day(s)\n"
-            msg += f"📈 Active Signals: {active_signals_count}"
+    # Replies are sent after the connection is back in the pool.
+    if not user:
+        await update.message.reply_text("❌ You are not registered.")
+        return
+    tier = user['tier']
+    expiry = user['trial_expiry']
+    msg = f"📊 Plan: {tier}\n"
+    if expiry:
+        days_left = max((expiry - now).days, 0)
+        msg += f"⏳ Trial expires in {days_left} day(s)\n"
+    msg += f"📈 Active Signals: {active_signals_count}"
     await update.message.reply_text(msg)
 
-async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Displays the top 10 users by referral count."""
+def refresh_leaderboard() -> str:
+    """Renders the top 10 referrers and caches the text for LEADERBOARD_TTL_SECONDS."""
+    global _leaderboard
     with bot_commands.get_db_conn() as conn:
         with conn.cursor() as cur:
             cur.execute("SELECT user_id, username, referrals FROM users ORDER BY referrals DESC LIMIT 10")
@@ -84,4 +99,17 @@ async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
     for i, row in enumerate(top, 1):
         name = f"@{row['username']}" if row['username'] else f"ID: {row['user_id']}"
         lines.append(f"{i}. {name} – {row['referrals']} referrals")
-    await update.message.reply_text("\n".join(lines))
+    text = "\n".join(lines)
+    _leaderboard = (time.monotonic(), text)
+    # The leaderboard is the same for everyone, so it can be served from cache under load.
+    throttle.remember_reply("leaderboard", text)
+    return text
+
+async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Displays the top 10 users by referral count."""
+    cached = _leaderboard
+    if cached and time.monotonic() - cached[0] < LEADERBOARD_TTL_SECONDS:
+        text = cached[1]
+    else:
+        text = await asyncio.to_thread(refresh_leaderboard)
+    await update.message.reply_text(text)